@@ -0,0 +1,346 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import random
+import time
+from typing import AsyncIterator, Callable, List
+
+import telebot
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+
+from cache import Broadcast
+from config import config, logger
+from db import close_connections, get_character_by_id, get_model_by_id, init_db, list_characters, save_model_stats
+import llm_cache
+import main
+import openrouter_async
+from openrouter_client import close_session
+from router import Command, Router
+from telemetry import start_persisting, stop_persisting
+from token_budget import clip
+
+FOLLOW_POLL_S = 0.1
+
+# LLM commands run as coroutines here; everything else is handed to the threaded handlers in main
+bot = AsyncTeleBot(config.token)
+router = Router()
+_db_executor = ThreadPoolExecutor(max_workers=config.async_db_workers, thread_name_prefix='db')
+
+
+async def _db(fn: Callable, *args, **kwargs):
+    # sqlite3 calls block, so they run on their own small pool instead of the event loop
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, partial(fn, *args, **kwargs))
+
+
+async def _edit_answer(message: telebot.types.Message, text: str) -> bool:
+    try:
+        await bot.edit_message_text(text, message.chat.id, message.message_id)
+        return True
+
+    except ApiTelegramException as e:
+        logger.debug(f'Skipped answer edit for {message.chat.id}: {e}')
+        return False
+
+
+async def _finish_answer(message: telebot.types.Message, answer: telebot.types.Message, text: str):
+    # Same as main._finish_answer: retry once after a 429, otherwise send the answer as a new message
+    for attempt in range(2):
+        try:
+            await bot.edit_message_text(text, answer.chat.id, answer.message_id)
+            return
+
+        except ApiTelegramException as e:
+            if 'message is not modified' in e.description:
+                return
+
+            retry_after = main._retry_after(e)
+
+            if attempt or retry_after is None or retry_after > main.FINAL_EDIT_MAX_WAIT_S:
+                logger.warning(f'Final answer edit for {answer.chat.id} failed, replying instead: {e}')
+                break
+
+            await asyncio.sleep(retry_after)
+
+    await bot.reply_to(message, text)
+
+
+async def _stream_edits(
+        answer: telebot.types.Message,
+        stream: AsyncIterator[str],
+        sent: str,
+        header: str = '',
+        flight: Broadcast | None = None
+) -> tuple[str, str]:
+    text = ''
+    interval = main._edit_interval(answer.chat)
+    last_edit = time.monotonic()
+
+    async for delta in stream:
+        text += delta
+        partial = clip(header + text)
+
+        if text.strip() and partial != sent and time.monotonic() - last_edit >= interval:
+            if await _edit_answer(answer, partial):
+                sent = partial
+
+            if flight is not None:
+                flight.publish(partial)
+
+            last_edit = time.monotonic()
+
+    return text, sent
+
+
+async def _follow(message: telebot.types.Message, flight: Broadcast):
+    # Same as main._follow, but polls the shared partial: blocking on it would stall the event loop
+    answer = await bot.reply_to(message, main.STREAM_PLACEHOLDER)
+    sent = main.STREAM_PLACEHOLDER
+    interval = main._edit_interval(answer.chat)
+    deadline = time.monotonic() + main.FOLLOW_MAX_WAIT_S
+    last_edit = time.monotonic()
+
+    while not flight.done() and time.monotonic() < deadline:
+        await asyncio.sleep(FOLLOW_POLL_S)
+        partial = flight.partial
+
+        if partial.strip() and partial != sent and not flight.done() and time.monotonic() - last_edit >= interval:
+            if await _edit_answer(answer, partial):
+                sent = partial
+
+            last_edit = time.monotonic()
+
+    # The loop ends once the flight is done or the wait is over, so this never blocks
+    text = main.followed_text(message, flight)
+
+    if text != sent:
+        await _finish_answer(message, answer, text)
+
+
+async def _reply_streaming(
+        message: telebot.types.Message,
+        llm_message: List[dict[str, str]],
+        model_key: str,
+        fallback_keys: List[str] | None = None,
+        bypass: bool = False
+):
+    budget = await _db(main._budget, llm_message, [model_key, *(fallback_keys or [])])
+    llm_message, max_tokens = budget.messages, budget.max_tokens
+    key = llm_cache.cache_key(llm_message, model_key, main.LLM_TEMPERATURE, max_tokens)
+    # Shared with the threaded handlers, so identical questions coalesce across both
+    cached, flight, leader = await _db(llm_cache.claim, key, bypass)
+
+    if cached is not None:
+        await bot.reply_to(message, cached)
+        return
+
+    if not leader:
+        await _follow(message, flight)
+        return
+
+    flight_key = key
+
+    try:
+        answer = await bot.reply_to(message, main.STREAM_PLACEHOLDER)
+
+    except Exception as e:
+        llm_cache.settle(flight_key, error=e)
+        raise
+
+    text = ''
+    sent = main.STREAM_PLACEHOLDER
+    answer_key = None
+    t0 = time.perf_counter()
+
+    try:
+        if fallback_keys:
+            answered_by, stream = await openrouter_async.chat_stream_fallback(
+                llm_message,
+                models=[model_key, *fallback_keys],
+                hedge_after_s=main._hedge_after_s(model_key),
+                temperature=main.LLM_TEMPERATURE,
+                max_tokens=max_tokens
+            )
+
+            if answered_by != model_key:
+                key = llm_cache.cache_key(llm_message, answered_by, main.LLM_TEMPERATURE, max_tokens)
+                model_key = answered_by
+
+        else:
+            stream = openrouter_async.chat_stream(
+                llm_message, model=model_key, temperature=main.LLM_TEMPERATURE, max_tokens=max_tokens
+            )
+
+        text, sent = await _stream_edits(answer, stream, sent, flight=flight)
+        text = clip(text)
+
+        if text:
+            answer_key = key
+
+        else:
+            text = main.EMPTY_ANSWER_TEXT
+
+    except Exception as e:
+        text = main.answer_error(e)
+
+    finally:
+        dt_ms = int((time.perf_counter() - t0) * 1000)
+        await _db(llm_cache.settle, flight_key, text or main.UNEXPECTED_ERROR_TEXT, key=answer_key, model=model_key, dt_ms=dt_ms)
+
+    if text != sent:
+        await _finish_answer(message, answer, text)
+
+
+@router.command('ask')
+async def send_cmd_ask(message: telebot.types.Message, command: Command):
+    text, question, bypass = main.parse_ask(command)
+
+    if not text:
+        llm_message = await _db(main._build_messages, message.from_user.id, question)
+        model_key = await _db(main._pick_model)
+
+        await _reply_streaming(message, llm_message, model_key, await _db(main._fallback_models, model_key), bypass)
+
+    if text:
+        await bot.reply_to(message, text)
+
+    logger.info(f'Sent ask for {message.from_user.id} ({message.from_user.first_name}).')
+
+
+@router.command('ask_model')
+async def send_cmd_ask_model(message: telebot.types.Message, command: Command):
+    model_key = None
+    text, model_id, question, bypass = main.parse_ask_model(command)
+
+    if not text:
+        try:
+            llm_message = await _db(main._build_messages, message.from_user.id, question)
+            model_key = (await _db(get_model_by_id, model_id))['key']
+
+        except ValueError:
+            text = main.UNKNOWN_MODEL_TEXT
+
+        else:
+            await _reply_streaming(message, llm_message, model_key, bypass=bypass)
+
+    if text:
+        await bot.reply_to(message, text)
+
+    logger.info(f'Sent ask {model_key} for {message.from_user.id} ({message.from_user.first_name}).')
+
+
+async def _compare_answer(message: telebot.types.Message, llm_message: List[dict[str, str]], model: dict) -> int:
+    header = f'{model["label"]}:\n'
+    sent = header + main.STREAM_PLACEHOLDER
+    answer = await bot.reply_to(message, sent)
+    t0 = time.perf_counter()
+
+    try:
+        budget = await _db(main._budget, llm_message, [model['key']])
+        stream = openrouter_async.chat_stream(
+            budget.messages, model=model['key'], temperature=main.LLM_TEMPERATURE, max_tokens=budget.max_tokens
+        )
+        text, sent = await _stream_edits(answer, stream, sent, header)
+        text = text.strip() or main.EMPTY_ANSWER_TEXT
+
+    except Exception as e:
+        text = main.answer_error(e)
+
+    dt_ms = int((time.perf_counter() - t0) * 1000)
+    await _finish_answer(message, answer, main.compare_text(model, dt_ms, text))
+
+    return dt_ms
+
+
+@router.command('ask_compare')
+async def send_cmd_ask_compare(message: telebot.types.Message, command: Command):
+    text, ids = main.parse_compare(command)
+
+    if not text:
+        try:
+            models = [await _db(get_model_by_id, id) for id in ids]
+
+        except ValueError:
+            text = main.UNKNOWN_MODEL_TEXT
+
+        else:
+            llm_message = await _db(main._build_messages, message.from_user.id, command.tail)
+            await asyncio.gather(*(_compare_answer(message, llm_message, model) for model in models))
+
+    if text:
+        await bot.reply_to(message, text)
+
+    logger.info(f'Sent ask compare for {message.from_user.id} ({message.from_user.first_name}).')
+
+
+@router.command('ask_random')
+async def send_cmd_ask_random(message: telebot.types.Message, command: Command):
+    text, question, bypass = main.parse_ask(command)
+    characters = await _db(list_characters)
+
+    if not text and not characters:
+        text = 'Каталог персонажей пуст'
+
+    if not text:
+        chosen = random.choice(characters)
+        character = await _db(get_character_by_id, chosen['id'])
+
+        llm_message = await _db(main._build_messages, message.from_user.id, question, character)
+        model_key = await _db(main._pick_model)
+
+        await _reply_streaming(message, llm_message, model_key, await _db(main._fallback_models, model_key), bypass)
+
+    if text:
+        await bot.reply_to(message, text)
+
+    logger.info(f'Sent random ask for {message.from_user.id} ({message.from_user.first_name}).')
+
+
+# Notes, models, characters, weather and buttons keep their threaded handlers and lanes
+@bot.message_handler(func=lambda message: True)
+async def dispatch(message: telebot.types.Message):
+    route = router.resolve(message.text or '')
+
+    if route is None:
+        main.bot.process_new_messages([message])
+        return
+
+    handler, command = route
+    await handler(message, command)
+
+
+@bot.callback_query_handler(func=lambda call: True)
+async def delegate_callback_query(call: telebot.types.CallbackQuery):
+    main.bot.process_new_callback_query([call])
+
+
+async def _run():
+    await _db(init_db)
+    await _db(main._setup_bot_commands, main.bot)
+
+    start_persisting(save_model_stats, config.telemetry_persist_s)
+    main.weather_service.start()
+
+    logger.info('Telegram Bot started (asyncio).')
+
+    try:
+        await bot.remove_webhook()
+        await bot.infinity_polling(skip_pending=True)
+
+    finally:
+        await openrouter_async.close_session()
+        await bot.close_session()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(_run())
+
+    finally:
+        main.bot.close_lanes()
+        main._compare_pool.shutdown(wait=True, cancel_futures=True)
+        stop_persisting(save_model_stats)
+        main.weather_service.stop()
+        close_session()
+        _db_executor.shutdown(wait=True)
+        close_connections()
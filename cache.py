@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+import time
+from typing import Any, Callable, Hashable
+
+
+# Thread-safe LRU cache whose entries expire after ttl_s seconds
+class TTLCache:
+    def __init__(self, maxsize: int = 1024, ttl_s: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+
+            if item is None or item[0] <= time.monotonic():
+                if item is not None:
+                    del self._data[key]
+
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+
+            return item[1]
+
+    def set(self, key: Hashable, value: Any, ttl_s: float | None = None):
+        expires_at = time.monotonic() + (self.ttl_s if ttl_s is None else ttl_s)
+
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict[str, int | float]:
+        with self._lock:
+            total = self.hits + self.misses
+
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+# Concurrent callers with the same key share one in-flight call and its result or error
+# A future whose partial result can be followed while the leader is still producing it
+class Broadcast(Future):
+    def __init__(self):
+        super().__init__()
+        self.partial = ''
+
+        self._changed = threading.Condition()
+        self.add_done_callback(lambda _: self._notify())
+
+    def _notify(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    def publish(self, partial: str):
+        with self._changed:
+            self.partial = partial
+            self._changed.notify_all()
+
+    def follow(self, seen: str, timeout: float) -> str:
+        # Waits until the partial differs from seen or the call is done, returns the latest partial
+        with self._changed:
+            self._changed.wait_for(lambda: self.partial != seen or self.done(), timeout)
+
+            return self.partial
+
+
+class SingleFlight:
+    def __init__(self, factory: Callable[[], Future] = Future):
+        self.coalesced = 0
+
+        self._factory = factory
+
+        self._calls: dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def join(self, key: Hashable) -> tuple[Future, bool]:
+        # Returns the call's future and whether this caller is the leader that must resolve it
+        with self._lock:
+            future = self._calls.get(key)
+
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+
+            future = self._factory()
+            self._calls[key] = future
+
+            return future, True
+
+    def resolve(self, key: Hashable, result: Any = None, error: BaseException | None = None):
+        with self._lock:
+            future = self._calls.pop(key, None)
+
+        if future is None:
+            return
+
+        if error is None:
+            future.set_result(result)
+
+        else:
+            future.set_exception(error)
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        future, leader = self.join(key)
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+
+        except BaseException as e:
+            self.resolve(key, error=e)
+            raise
+
+        self.resolve(key, result)
+
+        return result
@@ -12,6 +12,46 @@ class Config:
     db_path: str
     log_file: str
     log_level: str
+    db_write_behind: bool = False
+    db_write_batch_size: int = 64
+    db_write_batch_ms: int = 10
+    db_synchronous: str = 'FULL'
+    http_pool_size: int = 32
+    openrouter_max_attempts: int = 3
+    openrouter_breaker_threshold: int = 5
+    openrouter_breaker_reset_s: int = 30
+    openrouter_rpm_key: float = 20
+    openrouter_rpm_model: float = 20
+    openrouter_rate_mode: str = 'WAIT'
+    llm_fallback_depth: int = 2
+    llm_hedge_after_s: float = 8.0
+    llm_hedge_percentile: int = 95
+    llm_hedge_min_samples: int = 20
+    llm_routing: str = 'ACTIVE'
+    telemetry_persist_s: int = 300
+    admin_ids: tuple[int, ...] = ()
+    llm_cache_size: int = 512
+    llm_cache_ttl_s: int = 3600
+    llm_cache_persist: bool = False
+    llm_cache_persist_max: int = 10000
+    llm_context_tokens: int = 8192
+    llm_max_input_tokens: int = 1000
+    llm_max_answer_tokens: int = 800
+    llm_compare_max: int = 4
+    llm_compare_workers: int = 8
+    webhook_url: str = ''
+    webhook_secret: str = ''
+    webhook_host: str = '0.0.0.0'
+    webhook_port: int = 8080
+    webhook_max_pending: int = 100
+    dispatch_fast_workers: int = 4
+    dispatch_slow_workers: int = 8
+    async_http_pool_size: int = 100
+    async_db_workers: int = 8
+    weather_cities: tuple[tuple[str, float, float], ...] = (('Москва', 55.7558, 37.6173),)
+    weather_refresh_s: int = 600
+    weather_max_stale_s: int = 3600
+    weather_timeout_s: float = 5.0
 
 
 def setup_logger(filepath: str, level: str = 'INFO') -> logging.Logger:
@@ -40,6 +80,50 @@ def setup_logger(filepath: str, level: str = 'INFO') -> logging.Logger:
     return logger
 
 
+def _flag(value: str | None) -> bool:
+    return (value or '').lower() in ('1', 'true', 'yes')
+
+
+def _choice(value: str, choices: tuple[str, ...]) -> str:
+    value = value.upper()
+
+    if value not in choices:
+        raise ValueError(f'Invalid value: {value}. Expected one of {", ".join(choices)}')
+
+    return value
+
+
+def _webhook_url(url: str | None, secret: str | None) -> str:
+    # Without a secret anyone who finds the URL could post fake updates
+    if url and not secret:
+        raise ValueError('WEBHOOK_SECRET is required when WEBHOOK_URL is set')
+
+    return url or ''
+
+
+def _cities(value: str | None) -> tuple[tuple[str, float, float], ...]:
+    # "Name:latitude:longitude" entries separated by semicolons
+    cities = []
+
+    for entry in (value or '').split(';'):
+        if not entry.strip():
+            continue
+
+        try:
+            name, latitude, longitude = entry.rsplit(':', 2)
+            cities.append((name.strip(), float(latitude), float(longitude)))
+
+        except ValueError:
+            raise ValueError(f'Invalid city: {entry}. Expected Name:latitude:longitude')
+
+    return tuple(cities) or (('Москва', 55.7558, 37.6173),)
+
+
+def _http_pool_size(value: str | None, slow_workers: int, compare_workers: int, fallback_depth: int) -> int:
+    # Every slow-lane handler may hedge up to 1 + fallback_depth streams, every compare worker holds one
+    return int(value) if value else slow_workers * (1 + fallback_depth) + compare_workers
+
+
 def get_config() -> Config:
     dotenv_path = dotenv.find_dotenv()
 
@@ -48,12 +132,58 @@ def get_config() -> Config:
     else:
         raise FileNotFoundError('Could not find .env file')
 
+    llm_fallback_depth = int(os.getenv('LLM_FALLBACK_DEPTH') or 2)
+    llm_compare_workers = int(os.getenv('LLM_COMPARE_WORKERS') or 8)
+    dispatch_slow_workers = int(os.getenv('DISPATCH_SLOW_WORKERS') or 8)
+
     return Config(
         token=os.getenv('TOKEN'),
         openrouter_api_key=os.getenv('OPENROUTER_API_KEY'),
         db_path=os.getenv('DB_PATH'),
         log_file=os.getenv('LOG_FILE') or './bot.log',
         log_level=os.getenv('LOG_LEVEL') or 'INFO',
+        db_write_behind=_flag(os.getenv('DB_WRITE_BEHIND')),
+        db_write_batch_size=int(os.getenv('DB_WRITE_BATCH_SIZE') or 64),
+        db_write_batch_ms=int(os.getenv('DB_WRITE_BATCH_MS') or 10),
+        db_synchronous=_choice(os.getenv('DB_SYNCHRONOUS') or 'FULL', ('OFF', 'NORMAL', 'FULL', 'EXTRA')),
+        http_pool_size=_http_pool_size(
+            os.getenv('HTTP_POOL_SIZE'), dispatch_slow_workers, llm_compare_workers, llm_fallback_depth
+        ),
+        openrouter_max_attempts=int(os.getenv('OPENROUTER_MAX_ATTEMPTS') or 3),
+        openrouter_breaker_threshold=int(os.getenv('OPENROUTER_BREAKER_THRESHOLD') or 5),
+        openrouter_breaker_reset_s=int(os.getenv('OPENROUTER_BREAKER_RESET_S') or 30),
+        openrouter_rpm_key=float(os.getenv('OPENROUTER_RPM_KEY') or 20),
+        openrouter_rpm_model=float(os.getenv('OPENROUTER_RPM_MODEL') or 20),
+        openrouter_rate_mode=_choice(os.getenv('OPENROUTER_RATE_MODE') or 'WAIT', ('WAIT', 'REJECT')),
+        llm_fallback_depth=llm_fallback_depth,
+        llm_hedge_after_s=float(os.getenv('LLM_HEDGE_AFTER_S') or 8.0),
+        llm_hedge_percentile=int(os.getenv('LLM_HEDGE_PERCENTILE') or 95),
+        llm_hedge_min_samples=int(os.getenv('LLM_HEDGE_MIN_SAMPLES') or 20),
+        llm_routing=_choice(os.getenv('LLM_ROUTING') or 'ACTIVE', ('ACTIVE', 'LATENCY')),
+        telemetry_persist_s=int(os.getenv('TELEMETRY_PERSIST_S') or 300),
+        admin_ids=tuple(int(user_id) for user_id in (os.getenv('ADMIN_IDS') or '').replace(',', ' ').split()),
+        llm_cache_size=int(os.getenv('LLM_CACHE_SIZE') or 512),
+        llm_cache_ttl_s=int(os.getenv('LLM_CACHE_TTL_S') or 3600),
+        llm_cache_persist=_flag(os.getenv('LLM_CACHE_PERSIST')),
+        llm_cache_persist_max=int(os.getenv('LLM_CACHE_PERSIST_MAX') or 10000),
+        llm_context_tokens=int(os.getenv('LLM_CONTEXT_TOKENS') or 8192),
+        llm_max_input_tokens=int(os.getenv('LLM_MAX_INPUT_TOKENS') or 1000),
+        llm_max_answer_tokens=int(os.getenv('LLM_MAX_ANSWER_TOKENS') or 800),
+        llm_compare_max=int(os.getenv('LLM_COMPARE_MAX') or 4),
+        llm_compare_workers=llm_compare_workers,
+        webhook_url=_webhook_url(os.getenv('WEBHOOK_URL'), os.getenv('WEBHOOK_SECRET')),
+        webhook_secret=os.getenv('WEBHOOK_SECRET') or '',
+        webhook_host=os.getenv('WEBHOOK_HOST') or '0.0.0.0',
+        webhook_port=int(os.getenv('WEBHOOK_PORT') or 8080),
+        webhook_max_pending=int(os.getenv('WEBHOOK_MAX_PENDING') or 100),
+        dispatch_fast_workers=int(os.getenv('DISPATCH_FAST_WORKERS') or 4),
+        dispatch_slow_workers=dispatch_slow_workers,
+        async_http_pool_size=int(os.getenv('ASYNC_HTTP_POOL_SIZE') or 100),
+        async_db_workers=int(os.getenv('ASYNC_DB_WORKERS') or 8),
+        weather_cities=_cities(os.getenv('WEATHER_CITIES')),
+        weather_refresh_s=int(os.getenv('WEATHER_REFRESH_S') or 600),
+        weather_max_stale_s=int(os.getenv('WEATHER_MAX_STALE_S') or 3600),
+        weather_timeout_s=float(os.getenv('WEATHER_TIMEOUT_S') or 5.0),
     )
 
 
@@ -1,155 +1,363 @@
+from concurrent.futures import Future
+import json
 import sqlite3
+import threading
+from typing import Any, Callable
 
 import telebot
 
+from cache import TTLCache
 from config import config, logger
+from migrations import apply_migrations
+from write_queue import WriteQueue
 
+_local = threading.local()
+_connections: list[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+_generation = 0
+_writer: WriteQueue | None = None
 
-def _connect():
-    conn = sqlite3.connect(config.db_path, timeout=5.0)
+_active_model: tuple[str, dict[str, str | bool]] | None = None
+_active_model_lock = threading.Lock()
+
+CHARACTER_CACHE_TTL_S = 300
+_MISSING = object()
+_characters_cache = TTLCache(maxsize=4, ttl_s=CHARACTER_CACHE_TTL_S)
+_user_characters_cache = TTLCache(maxsize=10000, ttl_s=CHARACTER_CACHE_TTL_S)
+_models_cache = TTLCache(maxsize=4, ttl_s=CHARACTER_CACHE_TTL_S)
+
+
+def _open_connection(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, timeout=5.0, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
     conn.execute('PRAGMA foreign_keys = ON')
     conn.execute('PRAGMA journal_mode = WAL')
     conn.execute('PRAGMA busy_timeout = 5000')
+    conn.create_function('casefold', 1, lambda value: value.casefold() if value else value, deterministic=True)
+
+    return conn
+
+
+def _connect() -> sqlite3.Connection:
+    # One long-lived connection per worker thread: PRAGMAs run once and the statement cache stays warm.
+    # Use it as a context manager (`with _connect() as conn`) for commit/rollback, it is not closed on exit.
+    conn = getattr(_local, 'conn', None)
+    key = (config.db_path, _generation)
+
+    if conn is None or _local.key != key:
+        conn = _open_connection(config.db_path)
+        _local.conn = conn
+        _local.key = key
+
+        with _connections_lock:
+            _connections.append(conn)
 
     return conn
 
 
-def create_notes_table():
-    schema = '''
-        CREATE TABLE IF NOT EXISTS notes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            text TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-        '''
+def close_connections():
+    global _generation
+
+    # Flush queued writes before their connection goes away
+    stop_write_behind()
+
+    with _connections_lock:
+        connections = _connections[:]
+        _connections.clear()
+        _generation += 1
+
+    for conn in connections:
+        try:
+            conn.close()
+
+        except sqlite3.Error as e:
+            logger.error(f'Error closing database connection: {e}')
+
+    logger.info(f'Database connections closed ({len(connections)}).')
+
+
+# The MATCH runs once as a subquery; joined to notes it ran again for every row of the user's index range
+FTS_MATCH = 'n.id IN (SELECT rowid FROM notes_fts WHERE notes_fts MATCH ?)'
+
+
+def _fts_phrase(text: str) -> str | None:
+    text = text.strip()
+
+    # Trigram index can't match queries shorter than 3 characters
+    if len(text) < 3:
+        return None
+
+    return '"' + text.replace('"', '""') + '"'
+
+
+def start_write_behind():
+    global _writer
+
+    if _writer is None:
+        _writer = WriteQueue(
+            lambda: _open_connection(config.db_path),
+            max_batch=config.db_write_batch_size,
+            max_delay_s=config.db_write_batch_ms / 1000,
+            synchronous=config.db_synchronous
+        )
+        logger.info(f'Write-behind enabled (batch {config.db_write_batch_size}, {config.db_write_batch_ms} ms).')
+
+
+def stop_write_behind():
+    global _writer
+
+    writer, _writer = _writer, None
+
+    if writer is not None:
+        writer.close()
+
+
+def _write(op: Callable[..., Any], *args) -> Future:
+    writer = _writer
+
+    if writer is not None:
+        return writer.submit(op, *args)
+
+    future = Future()
 
     with _connect() as conn:
-        conn.executescript(schema)
+        future.set_result(op(conn, *args))
+
+    return future
+
+
+def _insert_note(conn: sqlite3.Connection, user_id: int, text: str) -> int:
+    cur = conn.execute(
+        'INSERT INTO notes(user_id, text) VALUES (?, ?)',
+        (user_id, text)
+    )
+
+    return cur.lastrowid
+
+
+def add_note_async(user_id: int, text: str) -> Future:
+    # Doesn't wait for the commit: bulk imports can queue many notes and collect the ids later
+    return _write(_insert_note, user_id, text)
 
 
 def add_note(user_id: int, text: str) -> int:
-    with _connect() as conn:
-        cur = conn.execute(
-            'INSERT INTO notes(user_id, text) VALUES (?, ?)',
-            (user_id, text)
-        )
+    return _write(_insert_note, user_id, text).result()
+
 
-        return cur.lastrowid
+def _keyset(before_id: int | None, after_id: int | None) -> tuple[str, str, tuple]:
+    # Cursor pagination over (user_id, id): rows older than before_id or newer than after_id
+    if after_id is not None:
+        return 'AND n.id > ?', 'ORDER BY n.id ASC', (after_id,)
 
+    if before_id is not None:
+        return 'AND n.id < ?', 'ORDER BY n.id DESC', (before_id,)
+
+    return '', 'ORDER BY n.id DESC', ()
+
+
+def list_notes(user_id: int, limit: int = 10, before_id: int | None = None, after_id: int | None = None) -> list:
+    cursor, order, cursor_params = _keyset(before_id, after_id)
+
+    # The first page takes its total from note_stats instead of counting every row,
+    # cursor pages don't count at all (see _page)
+    if cursor:
+        total, total_params = 'NULL', ()
+
+    else:
+        total, total_params = 'COALESCE((SELECT count FROM note_stats WHERE user_id = ?), 0)', (user_id,)
 
-def list_notes(user_id: int, limit: int = 10, offset: int = 0) -> list:
     with _connect() as conn:
         cur = conn.execute(
-            '''SELECT id, text, created_at
-            FROM notes
-            WHERE user_id = ?
-            ORDER BY id DESC
-            LIMIT ?
-            OFFSET ?''',
-            (user_id, limit, offset)
+            f'''SELECT n.id, n.text, n.created_at, {total} AS total
+            FROM notes n
+            WHERE n.user_id = ?
+            {cursor}
+            {order}
+            LIMIT ?''',
+            (*total_params, user_id, *cursor_params, limit)
         )
+        rows = cur.fetchall()
 
-        return cur.fetchall()
+    # Pages are always returned newest first
+    return rows[::-1] if after_id is not None else rows
 
 
-def find_note(user_id: int, text: str, limit: int = 10, offset: int = 0) -> list:
+def find_note(
+        user_id: int,
+        text: str,
+        limit: int = 10,
+        before_id: int | None = None,
+        after_id: int | None = None
+) -> list:
+    phrase = _fts_phrase(text)
+    cursor, order, cursor_params = _keyset(before_id, after_id)
+    # The window reads every match, so only the first page pays for the total
+    total = 'NULL' if cursor else 'COUNT(*) OVER ()'
+
     with _connect() as conn:
-        cur = conn.execute(
-            '''SELECT id, text, created_at
-            FROM notes
-            WHERE user_id = ?
-            AND text like '%' || ? || '%' COLLATE NOCASE
-            ORDER BY id DESC
-            LIMIT ?
-            OFFSET ?''',
-            (user_id, text, limit, offset)
-        )
+        if phrase:
+            cur = conn.execute(
+                f'''SELECT n.id, n.text, n.created_at, {total} AS total
+                FROM notes n
+                WHERE {FTS_MATCH}
+                AND n.user_id = ?
+                {cursor}
+                {order}
+                LIMIT ?''',
+                (phrase, user_id, *cursor_params, limit)
+            )
+
+        else:
+            cur = conn.execute(
+                f'''SELECT n.id, n.text, n.created_at, {total} AS total
+                FROM notes n
+                WHERE n.user_id = ?
+                AND instr(casefold(n.text), ?) > 0
+                {cursor}
+                {order}
+                LIMIT ?''',
+                (user_id, text.strip().casefold(), *cursor_params, limit)
+            )
+
+        rows = cur.fetchall()
+
+    return rows[::-1] if after_id is not None else rows
+
+
+def _page(rows: list, limit: int, after_id: int | None) -> tuple[list, int]:
+    # A cursor page reads one row past the page instead of counting every match past the cursor:
+    # its "total" is capped at limit + 1, which is all the keyboard needs to know about a next page
+    if len(rows) > limit:
+        rows = rows[1:] if after_id is not None else rows[:limit]
+        return rows, limit + 1
+
+    if rows and rows[0]['total'] is not None:
+        return rows, rows[0]['total']
+
+    return rows, len(rows)
+
+
+def _page_limit(limit: int, before_id: int | None, after_id: int | None) -> int:
+    return limit if before_id is None and after_id is None else limit + 1
+
+
+def list_notes_page(
+        user_id: int,
+        limit: int = 10,
+        before_id: int | None = None,
+        after_id: int | None = None
+) -> tuple[list, int]:
+    rows = list_notes(user_id, _page_limit(limit, before_id, after_id), before_id, after_id)
+
+    return _page(rows, limit, after_id)
+
+
+def find_note_page(
+        user_id: int,
+        text: str,
+        limit: int = 10,
+        before_id: int | None = None,
+        after_id: int | None = None
+) -> tuple[list, int]:
+    rows = find_note(user_id, text, _page_limit(limit, before_id, after_id), before_id, after_id)
+
+    return _page(rows, limit, after_id)
+
 
-        return cur.fetchall()
+def _update_note(conn: sqlite3.Connection, user_id: int, note_id: int, text: str) -> bool:
+    cur = conn.execute(
+        '''UPDATE notes
+        SET text = ?
+        WHERE user_id = ?
+        AND id = ?''',
+        (text, user_id, note_id)
+    )
+
+    return cur.rowcount > 0
 
 
 def update_note(user_id: int, note_id: int, text: str) -> bool:
-    with _connect() as conn:
-        cur = conn.execute(
-            '''UPDATE notes
-            SET text = ?
-            WHERE user_id = ?
-            AND id = ?''',
-            (text, user_id, note_id)
-        )
+    return _write(_update_note, user_id, note_id, text).result()
 
-        return cur.rowcount > 0
 
+def _delete_note(conn: sqlite3.Connection, user_id: int, note_id: int) -> bool:
+    cur = conn.execute(
+        '''DELETE FROM notes
+        WHERE user_id = ?
+        AND id = ?''',
+        (user_id, note_id)
+    )
+
+    return cur.rowcount > 0
 
-def delete_note(user_id: int, note_id: int) -> bool:
-    with _connect() as conn:
-        cur = conn.execute(
-            '''DELETE FROM notes
-            WHERE user_id = ?
-            AND id = ?''',
-            (user_id, note_id)
-        )
 
-        return cur.rowcount > 0
+def delete_note(user_id: int, note_id: int) -> bool:
+    return _write(_delete_note, user_id, note_id).result()
 
 
 def count_notes(user_id: int, text = '') -> int:
+    phrase = _fts_phrase(text)
+
     with _connect() as conn:
-        cur = conn.execute(
-            '''SELECT COUNT(*)
-            FROM notes
-            WHERE user_id = ?
-            AND text like '%' || ? || '%' COLLATE NOCASE''',
-            (user_id, text)
-        )
+        if not text.strip():
+            cur = conn.execute(
+                '''SELECT COALESCE(
+                    (SELECT count FROM note_stats WHERE user_id = ?),
+                    0
+                )''',
+                (user_id,)
+            )
 
-        return cur.fetchone()[0]
+        elif phrase:
+            cur = conn.execute(
+                f'''SELECT COUNT(*)
+                FROM notes n
+                WHERE {FTS_MATCH}
+                AND n.user_id = ?''',
+                (phrase, user_id)
+            )
 
+        else:
+            cur = conn.execute(
+                '''SELECT COUNT(*)
+                FROM notes
+                WHERE user_id = ?
+                AND instr(casefold(text), ?) > 0''',
+                (user_id, text.strip().casefold())
+            )
 
-def create_models_table():
-    schema = '''
-    CREATE TABLE IF NOT EXISTS models (
-        id INTEGER PRIMARY KEY,
-        key TEXT NOT NULL UNIQUE,
-        label TEXT NOT NULL,
-        active INTEGER NOT NULL DEFAULT 0 CHECK (active IN (0, 1))
-    );
-    
-    CREATE UNIQUE INDEX IF NOT EXISTS ux_models_single_active
-    ON models(active) WHERE active=1;
-    '''
+        return cur.fetchone()[0]
 
-    with _connect() as conn:
-        conn.executescript(schema)
 
+def list_models() -> list[dict[str, str | bool | int | None]]:
+    result = _models_cache.get(config.db_path)
 
-def list_models() -> list[dict[str, str | bool]]:
-    with _connect() as conn:
-        cur = conn.execute(
-            '''SELECT id, key, label, active
-            FROM models
-            ORDER BY id'''
-        )
-        rows = cur.fetchall()
-        result = [
-            {
-                'id': row['id'],
-                'key': row['key'],
-                'label': row['label'],
-                'active': bool(row['active'])
-            }
-            for row in rows
-        ]
+    if result is None:
+        with _connect() as conn:
+            cur = conn.execute(
+                '''SELECT id, key, label, active, context_tokens
+                FROM models
+                ORDER BY id'''
+            )
+            rows = cur.fetchall()
+            result = [
+                {
+                    'id': row['id'],
+                    'key': row['key'],
+                    'label': row['label'],
+                    'active': bool(row['active']),
+                    'context_tokens': row['context_tokens']
+                }
+                for row in rows
+            ]
 
-        return result
+        _models_cache.set(config.db_path, result)
 
+    return [dict(model) for model in result]
 
-def get_active_model() -> dict[str, str | bool]:
-    with _connect() as conn:
-        result = {}
 
+def _load_active_model() -> dict[str, str | bool]:
+    with _connect() as conn:
         cur = conn.execute(
             '''SELECT id, key, label
             FROM models
@@ -166,24 +374,44 @@ def get_active_model() -> dict[str, str | bool]:
             )
             row = cur.fetchone()
 
-        if not row:
-            raise RuntimeError('В реестре моделей нет записей.')
+            if not row:
+                raise RuntimeError('В реестре моделей нет записей.')
 
-        conn.execute(
-            '''UPDATE models
-            SET active = CASE WHEN id=?
-            THEN 1 ELSE 0 END''',
-            (row['id'],)
-        )
+            # Only a registry without an active model needs a write to persist the default
+            conn.execute(
+                '''UPDATE models
+                SET active = CASE WHEN id=?
+                THEN 1 ELSE 0 END''',
+                (row['id'],)
+            )
+            _models_cache.clear()
 
-        result.update({
+        return {
             'id': row['id'],
             'key': row['key'],
             'label': row['label'],
             'active': True
-        })
+        }
+
+
+def invalidate_active_model():
+    global _active_model
+
+    with _active_model_lock:
+        _active_model = None
+
+    _models_cache.clear()
+
+
+def get_active_model() -> dict[str, str | bool]:
+    # Served from an in-process snapshot, refreshed only after set_active_model
+    global _active_model
+
+    with _active_model_lock:
+        if _active_model is None or _active_model[0] != config.db_path:
+            _active_model = (config.db_path, _load_active_model())
 
-        return result
+        return dict(_active_model[1])
 
 
 def get_model_by_id(id: int) -> dict[str, str | bool]:
@@ -225,53 +453,60 @@ def set_active_model(model_id: int) -> dict[str, str | bool]:
 
         conn.commit()
 
-        return get_active_model()
+    invalidate_active_model()
 
+    return get_active_model()
 
-def create_chaeacters_table():
-    schema = '''
-    CREATE TABLE IF NOT EXISTS characters (
-        id INTEGER PRIMARY KEY,
-        name TEXT NOT NULL UNIQUE,
-        prompt TEXT NOT NULL
-    );
-    '''
 
-    with _connect() as conn:
-        conn.executescript(schema)
+def _character_catalog() -> dict[int, dict[str, str | int]]:
+    # The whole catalog is small, so it is cached as one entry
+    catalog = _characters_cache.get(config.db_path)
 
+    if catalog is None:
+        with _connect() as conn:
+            rows = conn.execute(
+                '''SELECT id, name, prompt, prompt_version, system_prompt, system_prompt_template
+                FROM characters
+                ORDER BY id'''
+            ).fetchall()
 
-def list_characters() -> list[dict[str, str | int]]:
-    with _connect() as conn:
-        cur = conn.execute(
-            '''SELECT id, name FROM characters
-            ORDER BY id'''
-        )
-        rows = cur.fetchall()
+        catalog = {
+            row['id']: {
+                'id': row['id'],
+                'name': row['name'],
+                'prompt': row['prompt'],
+                'prompt_version': row['prompt_version'],
+                'system_prompt': row['system_prompt'],
+                'system_prompt_template': row['system_prompt_template']
+            }
+            for row in rows
+        }
+        _characters_cache.set(config.db_path, catalog)
 
-        return [{
-            'id': row['id'],
-            'name': row['name']
-        } for row in rows]
+    return catalog
+
+
+def character_cache_stats() -> dict[str, dict[str, int | float]]:
+    return {
+        'characters': _characters_cache.stats(),
+        'user_character': _user_characters_cache.stats()
+    }
+
+
+def list_characters() -> list[dict[str, str | int]]:
+    return [{
+        'id': character['id'],
+        'name': character['name']
+    } for character in _character_catalog().values()]
 
 
 def get_character_by_id(character_id: int) -> dict[str, str | int]:
-    with _connect() as conn:
-        cur = conn.execute(
-            '''SELECT id, name, prompt FROM characters
-            WHERE id=?''',
-            (character_id,)
-        )
-        row = cur.fetchone()
+    character = _character_catalog().get(character_id)
 
-        if row is None:
-            raise ValueError('Неизвестный ID персонажа.')
+    if character is None:
+        raise ValueError('Неизвестный ID персонажа.')
 
-        return {
-            'id': row['id'],
-            'name': row['name'],
-            'prompt': row['prompt']
-        }
+    return dict(character)
 
 
 def update_character_name_by_id(character_id: int, name: str) -> bool:
@@ -284,25 +519,35 @@ def update_character_name_by_id(character_id: int, name: str) -> bool:
         )
         conn.commit()
 
-        return cur.rowcount > 0
+    _characters_cache.clear()
 
+    return cur.rowcount > 0
 
-def get_character_prompt_for_user(user_id: int) -> str:
-    return get_user_character(user_id)['prompt']
 
+def save_system_prompt(character_id: int, prompt_version: int, template: int, system_prompt: str) -> bool:
+    # Skipped when the character changed since it was read: that version will be compiled again
+    with _connect() as conn:
+        cur = conn.execute(
+            '''UPDATE characters
+            SET system_prompt=?, system_prompt_template=?
+            WHERE id=?
+            AND prompt_version=?''',
+            (system_prompt, template, character_id, prompt_version)
+        )
+        conn.commit()
+
+    if cur.rowcount:
+        character = _character_catalog().get(character_id)
 
-def create_user_character_links_table():
-    schema = '''
-    CREATE TABLE IF NOT EXISTS user_character (
-    user_id INTEGER PRIMARY KEY,
-    character_id INTEGER NOT NULL,
-    active INTEGER NOT NULL DEFAULT 0 CHECK (active IN (0, 1)),
-    FOREIGN KEY(character_id) REFERENCES characters(id)
-    );
-    '''
+        if character is not None and character['prompt_version'] == prompt_version:
+            character['system_prompt'] = system_prompt
+            character['system_prompt_template'] = template
 
-    with _connect() as conn:
-        conn.executescript(schema)
+    return cur.rowcount > 0
+
+
+def get_character_prompt_for_user(user_id: int) -> str:
+    return get_user_character(user_id)['prompt']
 
 
 def set_user_character(user_id: int, character_id: int) -> dict[str, str | int] | None:
@@ -320,57 +565,101 @@ def set_user_character(user_id: int, character_id: int) -> dict[str, str | int]
             (user_id, character_id)
         )
 
+    _user_characters_cache.set((config.db_path, user_id), character_id)
+
     return character
 
 
 def get_user_character(user_id: int) -> dict[str, str | int] | None:
-    with _connect() as conn:
-        row = conn.execute(
-            '''SELECT p.id, p.name, p.prompt
-            FROM user_character up
-            JOIN characters p ON p.id = up.character_id
-            WHERE up.user_id = ?''',
-            (user_id,)
-        ).fetchone()
+    key = (config.db_path, user_id)
+    character_id = _user_characters_cache.get(key, _MISSING)
 
-        if row:
-            return {
-                'id': row['id'],
-                'name': row['name'],
-                'prompt': row['prompt']
-            }
+    if character_id is _MISSING:
+        with _connect() as conn:
+            row = conn.execute(
+                '''SELECT character_id
+                FROM user_character
+                WHERE user_id = ?''',
+                (user_id,)
+            ).fetchone()
 
-        row = conn.execute(
-            '''SELECT id, name, prompt FROM characters
-            WHERE id=1'''
-        ).fetchone()
+        # None is cached too: users without a choice are the common case
+        character_id = row['character_id'] if row else None
+        _user_characters_cache.set(key, character_id)
 
-        if row:
-            return {
-                'id': row['id'],
-                'name': row['name'],
-                'prompt': row['prompt']
-            }
+    catalog = _character_catalog()
+
+    for fallback_id in (character_id, 1):
+        if fallback_id in catalog:
+            return dict(catalog[fallback_id])
+
+    if catalog:
+        return dict(next(iter(catalog.values())))
 
+    raise RuntimeError('Таблица characters пуста.')
+
+
+def get_llm_response(key: str, now: float) -> tuple[str, int] | None:
+    with _connect() as conn:
         row = conn.execute(
-            '''SELECT id, name, prompt FROM characters
-            ORDER BY id LIMIT 1'''
+            '''SELECT response, dt_ms
+            FROM llm_cache
+            WHERE key = ?
+            AND expires_at > ?''',
+            (key, now)
         ).fetchone()
 
-        if row:
-            return {
-                'id': row['id'],
-                'name': row['name'],
-                'prompt': row['prompt']
-            }
+    return (row['response'], row['dt_ms']) if row else None
 
-        raise RuntimeError('Таблица characters пуста.')
+
+def put_llm_response(key: str, model: str, response: str, dt_ms: int, now: float, ttl_s: float, max_rows: int):
+    with _connect() as conn:
+        conn.execute(
+            '''INSERT OR REPLACE INTO llm_cache(key, model, response, dt_ms, created_at, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)''',
+            (key, model, response, dt_ms, now, now + ttl_s)
+        )
+        conn.execute('DELETE FROM llm_cache WHERE expires_at <= ?', (now,))
+        # Size bound: drop the oldest rows beyond max_rows
+        conn.execute(
+            '''DELETE FROM llm_cache
+            WHERE created_at < (
+                SELECT created_at FROM llm_cache
+                ORDER BY created_at DESC
+                LIMIT 1 OFFSET ?
+            )''',
+            (max_rows - 1,)
+        )
+
+
+def save_model_stats(summaries: list[dict]):
+    with _connect() as conn:
+        conn.executemany(
+            '''INSERT OR REPLACE INTO model_stats(
+                model, requests, errors, p50_ms, p95_ms, p99_ms, prompt_tokens, completion_tokens, statuses
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            [
+                (
+                    summary['model'],
+                    summary['requests'],
+                    summary['errors'],
+                    summary['p50_ms'],
+                    summary['p95_ms'],
+                    summary['p99_ms'],
+                    summary['prompt_tokens'],
+                    summary['completion_tokens'],
+                    json.dumps(summary['statuses'])
+                )
+                for summary in summaries
+            ]
+        )
 
 
 def init_db():
-    create_notes_table()
-    create_models_table()
-    create_chaeacters_table()
-    create_user_character_links_table()
+    version = apply_migrations(_connect())
+
+    if config.db_write_behind:
+        start_write_behind()
 
-    logger.info('Database initialized.')
+    logger.info(f'Database initialized (schema version {version}).')
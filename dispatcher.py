@@ -0,0 +1,124 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+from typing import Any, Callable, Hashable
+
+import telebot
+
+from config import logger
+
+
+# Tasks with the same key run one at a time in submission order; different keys share the pool
+class SerialDispatcher:
+    def __init__(self, workers: int, name: str):
+        self.name = name
+
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._queues: dict[Hashable, deque] = {}
+        self._lock = threading.Condition()
+
+    def submit(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        future = Future()
+
+        with self._lock:
+            queue = self._queues.get(key)
+
+            # A key already in the map has a drain scheduled or running, it will pick the task up
+            if queue is not None:
+                queue.append((future, fn, args, kwargs))
+                return future
+
+            self._queues[key] = deque([(future, fn, args, kwargs)])
+
+        self._pool.submit(self._drain, key)
+
+        return future
+
+    def _drain(self, key: Hashable):
+        with self._lock:
+            future, fn, args, kwargs = self._queues[key].popleft()
+
+        try:
+            future.set_result(fn(*args, **kwargs))
+
+        except Exception as e:
+            logger.error(f'Task for {key} in lane {self.name} failed: {e}')
+            future.set_exception(e)
+
+        finally:
+            # One task per turn, so a busy chat can't hold a worker while others wait
+            with self._lock:
+                pending = bool(self._queues[key])
+
+                if not pending:
+                    del self._queues[key]
+                    self._lock.notify_all()
+
+            if pending:
+                self._pool.submit(self._drain, key)
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def close(self):
+        # Queued tasks still run: a drain resubmits itself, so the pool must outlive the queues
+        with self._lock:
+            self._lock.wait_for(lambda: not self._queues)
+
+        self._pool.shutdown(wait=True)
+
+
+def chat_key(update: Any) -> Hashable:
+    message = getattr(update, 'message', None) if isinstance(update, telebot.types.CallbackQuery) else update
+    chat = getattr(message, 'chat', None)
+
+    if chat is not None:
+        return chat.id
+
+    user = getattr(update, 'from_user', None)
+
+    return user.id if user is not None else None
+
+
+# Runs handlers in per-chat order on shared lanes instead of telebot's single worker pool
+class LaneTeleBot(telebot.TeleBot):
+    def __init__(self, token: str, *, lanes: dict[str, int], lane_of: Callable[[Any], str], **kwargs):
+        super().__init__(token, threaded=False, **kwargs)
+
+        self.lanes = {name: SerialDispatcher(workers, f'lane-{name}') for name, workers in lanes.items()}
+        self.lane_of = lane_of
+
+        self._tracked = threading.local()
+
+    def process_new_updates_tracked(self, updates: list[telebot.types.Update]) -> list[Future]:
+        # process_new_updates returns once handlers are queued; the futures tell when they have run
+        self._tracked.futures = futures = []
+
+        try:
+            self.process_new_updates(updates)
+
+        finally:
+            self._tracked.futures = None
+
+        return futures
+
+    def _exec_task(self, task, *args, **kwargs):
+        update = args[0] if args else None
+        future = self.lanes[self.lane_of(update)].submit(chat_key(update), self._run_task, task, *args, **kwargs)
+        futures = getattr(self._tracked, 'futures', None)
+
+        if futures is not None:
+            futures.append(future)
+
+    def _run_task(self, task, *args, **kwargs):
+        try:
+            task(*args, **kwargs)
+
+        except Exception as e:
+            if not self._handle_exception(e):
+                raise
+
+    def close_lanes(self):
+        for lane in self.lanes.values():
+            lane.close()
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import threading
+import time
+from typing import Dict, List
+
+from cache import Broadcast, SingleFlight, TTLCache
+from config import config, logger
+import db
+
+_memory = TTLCache(maxsize=config.llm_cache_size, ttl_s=config.llm_cache_ttl_s)
+inflight = SingleFlight(Broadcast)
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'saved_ms': 0}
+
+
+def cache_key(messages: List[Dict], model: str, temperature: float, max_tokens: int) -> str:
+    raw = json.dumps(
+        {'model': model, 'messages': messages, 'temperature': temperature, 'max_tokens': max_tokens},
+        ensure_ascii=False,
+        sort_keys=True
+    )
+
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _count(hit: bool, saved_ms: int = 0):
+    with _stats_lock:
+        _stats['hits' if hit else 'misses'] += 1
+        _stats['saved_ms'] += saved_ms
+
+
+def lookup(key: str) -> str | None:
+    item = _memory.get(key)
+
+    if item is None and config.llm_cache_persist:
+        item = db.get_llm_response(key, time.time())
+
+        if item is not None:
+            _memory.set(key, item)
+
+    if item is None:
+        _count(False)
+        return None
+
+    text, dt_ms = item
+    _count(True, dt_ms)
+    logger.debug(f'LLM cache hit {key[:12]}, saved {dt_ms} ms.')
+
+    return text
+
+
+def store(key: str, model: str, text: str, dt_ms: int):
+    if not text.strip():
+        return
+
+    _memory.set(key, (text, dt_ms))
+
+    if config.llm_cache_persist:
+        db.put_llm_response(
+            key, model, text, dt_ms, time.time(), config.llm_cache_ttl_s, config.llm_cache_persist_max
+        )
+
+
+def stats() -> dict[str, int | float]:
+    with _stats_lock:
+        total = _stats['hits'] + _stats['misses']
+
+        return {
+            **_stats,
+            'coalesced': inflight.coalesced,
+            'size': len(_memory),
+            'hit_rate': _stats['hits'] / total if total else 0.0
+        }
+
+
+def claim(key: str, bypass: bool = False) -> tuple[str | None, Broadcast | None, bool]:
+    # A cached answer, or else the in-flight call for key and whether this caller leads it.
+    # A bypassed call skips only the lookup, its answer still replaces the cached one
+    cached = None if bypass else lookup(key)
+
+    if cached is not None:
+        return cached, None, False
+
+    flight, leader = inflight.join(key)
+
+    return None, flight, leader
+
+
+def settle(
+        flight_key: str,
+        text: str = '',
+        *,
+        error: BaseException | None = None,
+        key: str | None = None,
+        model: str = '',
+        dt_ms: int = 0
+):
+    # The leader's last step: a real answer is cached under key (the answering model's), then followers get it
+    if key is not None and error is None:
+        store(key, model, text, dt_ms)
+
+    inflight.resolve(flight_key, text, error)
+
+
+def clear():
+    _memory.clear()
@@ -1,18 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
 import random
-from typing import List, Literal
+import time
+from typing import Iterator, List, Literal
+from urllib.parse import urlparse
 
-import requests
 import telebot
 
+from cache import Broadcast
 from config import config, logger
-from db import add_note, count_notes, delete_note, find_note, init_db, list_notes, set_user_character, update_note
+from db import add_note, close_connections, count_notes, delete_note, find_note_page, init_db, list_notes_page, set_user_character, update_note
 from db import get_active_model, get_model_by_id, list_models, set_active_model
 from db import get_character_by_id, get_user_character, list_characters, update_character_name_by_id
-from openrouter_client import chat_once, OpenRouterError
+from db import character_cache_stats, save_model_stats
+from dispatcher import LaneTeleBot
+import llm_cache
+from openrouter_client import chat_stream, chat_stream_fallback, close_session, OpenRouterError
+from prompts import system_prompt, with_cache_marks
+from router import Command, parse, Router
+from telemetry import start_persisting, stop_persisting, telemetry
+from token_budget import Budget, clip, fit_prompt
+from weather import City, WeatherService
+from webhook import WebhookServer
 
 NOTE_MESSAGE_PATTERN = '''Заметка: {{note}}\nСоздана: {{created_at}}'''
-
-bot = telebot.TeleBot(config.token)
+STREAM_PLACEHOLDER = 'Думаю...'
+STREAM_EDIT_INTERVAL_S = 1.5
+# Groups allow about 20 bot messages a minute, edits included
+STREAM_GROUP_EDIT_INTERVAL_S = 3.0
+FINAL_EDIT_MAX_WAIT_S = 30
+# How long a duplicate question follows the leader's answer before giving up on it
+FOLLOW_MAX_WAIT_S = 120
+FOLLOW_TIMEOUT_TEXT = 'Ответ не успел прийти, попробуйте ещё раз'
+EMPTY_ANSWER_TEXT = 'Модель вернула пустой ответ'
+UNEXPECTED_ERROR_TEXT = 'Непредвиденная ошибка'
+UNKNOWN_MODEL_TEXT = 'Неизвестный ID модели. Используйте /models для получения списка моделей'
+# "/ask !Вопрос" asks the model again instead of answering from the cache
+FRESH_PREFIX = '!'
+LLM_TEMPERATURE = 0.2
+
+# Commands that wait on OpenRouter or Open-Meteo get their own lane
+SLOW_COMMANDS = {'ask', 'ask_model', 'ask_random', 'ask_compare', 'weather'}
+SLOW_BUTTONS = {'Погода'}
+
+
+def _lane(update) -> str:
+    text = getattr(update, 'text', None) or ''
+
+    return 'slow' if parse(text).name in SLOW_COMMANDS or text in SLOW_BUTTONS else 'fast'
+
+
+bot = LaneTeleBot(
+    config.token,
+    lanes={'fast': config.dispatch_fast_workers, 'slow': config.dispatch_slow_workers},
+    lane_of=_lane
+)
+router = Router()
+# Shared by all /ask_compare commands, so one comparison can't open an unbounded number of streams
+_compare_pool = ThreadPoolExecutor(max_workers=config.llm_compare_workers, thread_name_prefix='ask-compare')
+weather_service = WeatherService(
+    [City(*city) for city in config.weather_cities],
+    refresh_s=config.weather_refresh_s,
+    max_stale_s=config.weather_max_stale_s,
+    timeout_s=config.weather_timeout_s
+)
 
 
 def _setup_bot_commands(bot: telebot.TeleBot):
@@ -34,6 +84,7 @@ def _setup_bot_commands(bot: telebot.TeleBot):
             telebot.types.BotCommand(command='models', description='Get list of AI models'),
             telebot.types.BotCommand(command='ask', description='Ask the model a question'),
             telebot.types.BotCommand(command='ask_model', description='Ask a question a specific model'),
+            telebot.types.BotCommand(command='ask_compare', description='Ask several models at once'),
             telebot.types.BotCommand(command='ask_random', description='Ask the random character'),
             telebot.types.BotCommand(command='characters', description='Get list of characters'),
             telebot.types.BotCommand(command='character', description='Get active character or set new character'),
@@ -44,27 +95,6 @@ def _setup_bot_commands(bot: telebot.TeleBot):
     logger.info('Bot commands loaded.')
 
 
-def _fetch_weather_moscow_open_meteo() -> str:
-    url = "https://api.open-meteo.com/v1/forecast"
-
-    params = {
-        "latitude": 55.7558,
-        "longitude": 37.6173,
-        "current": "temperature_2m",
-        "timezone": "Europe/Moscow"
-    }
-
-    try:
-        r = requests.get(url, params=params, timeout=5)
-        r.raise_for_status()
-        t = r.json()["current"]["temperature_2m"]
-
-        return f"Москва: сейчас {round(t)}°C"
-
-    except Exception:
-        return "Не удалось получить погоду."
-
-
 def _parse_number(text: str) -> list[int]:
     tokens = text.strip().replace(',', ' ').split()
     numbers = []
@@ -116,57 +146,42 @@ def _create_keyboard() -> telebot.types.ReplyKeyboardMarkup:
 
 def _create_note_keyboard(
         cmd_type: Literal['list', 'find'],
-        count: int,
-        offset: int,
+        notes: list,
+        has_prev: bool,
+        has_next: bool,
         step: int = 10,
         text: str = 'none'
 ) -> telebot.types.InlineKeyboardMarkup:
+    # Buttons carry keyset cursors: the newest note id for "prev" and the oldest one for "next"
     keyboard = telebot.types.InlineKeyboardMarkup()
+    buttons = []
 
-    if offset == 0:
-        keyboard.row(
-            telebot.types.InlineKeyboardButton(
-                text='След. Стр.',
-                callback_data=f'note:{cmd_type}:{count}:{offset + step}:{step}:{text}')
-        )
-
-    elif count - offset > step:
-        keyboard.row(
+    if has_prev:
+        buttons.append(
             telebot.types.InlineKeyboardButton(
                 text='Пред. Стр.',
-                callback_data=f'note:{cmd_type}:{count}:{offset - step}:{step}:{text}'
-            ),
-            telebot.types.InlineKeyboardButton(
-                text='След. Стр.',
-                callback_data=f'note:{cmd_type}:{count}:{offset + step}:{step}:{text}'
+                callback_data=f'note:{cmd_type}:prev:{notes[0][0]}:{step}:{text}'
             )
         )
 
-    else:
-        keyboard.row(
+    if has_next:
+        buttons.append(
             telebot.types.InlineKeyboardButton(
-                text='Пред. Стр.',
-                callback_data=f'note:{cmd_type}:{count}:{offset - step}:{step}:{text}'
+                text='След. Стр.',
+                callback_data=f'note:{cmd_type}:next:{notes[-1][0]}:{step}:{text}'
             )
         )
 
+    keyboard.row(*buttons)
+
     return keyboard
 
 
 def _build_messages(user_id: int, text: str, character: dict | None = None) -> List[dict[str, str]]:
-    if character  is None:
+    if character is None:
         character = get_user_character(user_id)
 
-    system = (
-        f'Ты отвечаешь строго в образе персонажа: {character["name"]}.\n'
-        f'{character["prompt"]}\n'
-        'Правила:\n'
-        '1. Всегда держи стиль и манеру речи выбранного персонажа. При необходимости - переформулируй.\n'
-        '2. Технические ответы давай корректно и по пунктам, но в характерной манере.\n'
-        '3. Не раскрывай, что ты "играешь роль".\n'
-        '4. Не используй длинные дословные цитаты из фильмов/книг (>10 слов).\n'
-        'Если стиль персонажа выражен слабо - переформулируй ответ и усиль характер персонажа, сохраняя фактическую точность.\n'
-    )
+    system = system_prompt(character)
 
     return [
         {'role': 'system', 'content': system},
@@ -174,54 +189,342 @@ def _build_messages(user_id: int, text: str, character: dict | None = None) -> L
     ]
 
 
-@bot.message_handler(commands=['start'])
-def send_start(message: telebot.types.Message):
+def _edit_answer(message: telebot.types.Message, text: str) -> bool:
+    try:
+        bot.edit_message_text(text, message.chat.id, message.message_id)
+        return True
+
+    except telebot.apihelper.ApiTelegramException as e:
+        logger.debug(f'Skipped answer edit for {message.chat.id}: {e}')
+        return False
+
+
+def _edit_interval(chat: telebot.types.Chat) -> float:
+    return STREAM_GROUP_EDIT_INTERVAL_S if chat.type in ('group', 'supergroup') else STREAM_EDIT_INTERVAL_S
+
+
+def _retry_after(e: telebot.apihelper.ApiTelegramException) -> float | None:
+    # Seconds Telegram asks to wait on 429, None for errors a retry won't fix
+    if e.error_code != 429:
+        return None
+
+    return (e.result_json.get('parameters') or {}).get('retry_after', 1)
+
+
+def _finish_answer(message: telebot.types.Message, answer: telebot.types.Message, text: str):
+    # Unlike partial edits the final one must land, or the user is left with a cut-off answer
+    for attempt in range(2):
+        try:
+            bot.edit_message_text(text, answer.chat.id, answer.message_id)
+            return
+
+        except telebot.apihelper.ApiTelegramException as e:
+            if 'message is not modified' in e.description:
+                return
+
+            retry_after = _retry_after(e)
+
+            if attempt or retry_after is None or retry_after > FINAL_EDIT_MAX_WAIT_S:
+                logger.warning(f'Final answer edit for {answer.chat.id} failed, replying instead: {e}')
+                break
+
+            time.sleep(retry_after)
+
+    bot.reply_to(message, text)
+
+
+def _fresh(question: str) -> tuple[str, bool]:
+    if question.startswith(FRESH_PREFIX):
+        return question[len(FRESH_PREFIX):].strip(), True
+
+    return question, False
+
+
+# Argument checks and texts shared with async_main: each returns the error to reply with, or None
+def parse_ask(command: Command) -> tuple[str | None, str, bool]:
+    question, bypass = _fresh(command.text)
+
+    if not question:
+        return 'Отсутствует текст вопроса. Пример использования:\n /ask Вопрос', '', False
+
+    return None, question, bypass
+
+
+def parse_ask_model(command: Command) -> tuple[str | None, int, str, bool]:
+    if not command.text:
+        return 'Отсутствуют аргументы. Пример использования:\n/ask_model <ID> Вопрос', 0, '', False
+
+    if not command.tail:
+        return 'Отсутствуют аргументы или их слишком много. Пример использования:\n/ask_model <ID> Вопрос', 0, '', False
+
+    if not command.head.isdigit():
+        return 'ID не является числом. Пример использования:\n /ask_model 1 Вопрос', 0, '', False
+
+    question, bypass = _fresh(command.tail)
+
+    return None, int(command.head), question, bypass
+
+
+def parse_compare(command: Command) -> tuple[str | None, List[int]]:
+    raw_ids = command.head.split(',') if command.head else []
+
+    if not command.tail:
+        return 'Отсутствуют аргументы. Пример использования:\n/ask_compare 1,2 Вопрос', []
+
+    if not all(id.strip().isdigit() for id in raw_ids):
+        return 'ID не является числом. Пример использования:\n/ask_compare 1,2 Вопрос', []
+
+    # Compared as numbers, so "1,01" is one model
+    ids = list(dict.fromkeys(int(id) for id in raw_ids))
+
+    if not 2 <= len(ids) <= config.llm_compare_max:
+        return f'Для сравнения укажите от 2 до {config.llm_compare_max} разных ID моделей', []
+
+    return None, ids
+
+
+def answer_error(e: Exception) -> str:
+    # Text an answer ends with when its stream fails
+    if isinstance(e, OpenRouterError):
+        return f'Ошибка: {e}'
+
+    logger.error(e)
+
+    return UNEXPECTED_ERROR_TEXT
+
+
+def followed_text(message: telebot.types.Message, flight: Broadcast, timeout: float = 0) -> str:
+    try:
+        return flight.result(timeout=timeout)
+
+    except FutureTimeoutError:
+        return FOLLOW_TIMEOUT_TEXT
+
+    except Exception as e:
+        # The leader already reported its own failure, this user gets the generic text
+        logger.warning(f'Followed answer for {message.chat.id} failed: {e}')
+        return UNEXPECTED_ERROR_TEXT
+
+
+def compare_text(model: dict, dt_ms: int, text: str) -> str:
+    return clip(f'{model["label"]} ({dt_ms} мс):\n{text}')
+
+
+def _pick_model() -> str:
+    active_key = get_active_model()['key']
+
+    if config.llm_routing == 'LATENCY':
+        return telemetry.best_model([model['key'] for model in list_models()]) or active_key
+
+    return active_key
+
+
+def _fallback_models(model_key: str) -> List[str]:
+    # Registry order after the active model
+    others = [model['key'] for model in list_models() if model['key'] != model_key]
+
+    return others[:max(config.llm_fallback_depth, 0)]
+
+
+def _hedge_after_s(model_key: str) -> float:
+    # Waiting past the primary's recent pN means it's in its tail: worth asking the next model
+    latency_ms = telemetry.percentile(model_key, config.llm_hedge_percentile, config.llm_hedge_min_samples)
+
+    return latency_ms / 1000 if latency_ms is not None else config.llm_hedge_after_s
+
+
+def _budget(llm_message: List[dict[str, str]], model_keys: List[str]) -> Budget:
+    # The smallest context in the fallback chain, so every model can take the same prompt
+    contexts = {model['key']: model.get('context_tokens') for model in list_models()}
+    context_tokens = min(contexts.get(key) or config.llm_context_tokens for key in model_keys)
+
+    budget = fit_prompt(
+        llm_message,
+        model=model_keys[0],
+        context_tokens=context_tokens,
+        max_answer_tokens=config.llm_max_answer_tokens,
+        max_input_tokens=config.llm_max_input_tokens
+    )
+
+    if budget.trimmed:
+        logger.debug(f'Trimmed question to {budget.prompt_tokens} prompt tokens for {model_keys[0]}.')
+
+    budget.messages = with_cache_marks(budget.messages, model_keys[0])
+
+    return budget
+
+
+def _stream_edits(
+        answer: telebot.types.Message,
+        stream: Iterator[str],
+        sent: str,
+        header: str = '',
+        flight: Broadcast | None = None
+) -> tuple[str, str]:
+    # Edits the answer with the accumulated text no more often than Telegram allows
+    text = ''
+    interval = _edit_interval(answer.chat)
+    last_edit = time.monotonic()
+
+    for delta in stream:
+        text += delta
+        partial = clip(header + text)
+
+        if text.strip() and partial != sent and time.monotonic() - last_edit >= interval:
+            if _edit_answer(answer, partial):
+                sent = partial
+
+            # Followers of the same question edit their own answers from this
+            if flight is not None:
+                flight.publish(partial)
+
+            last_edit = time.monotonic()
+
+    return text, sent
+
+
+def _follow(message: telebot.types.Message, flight: Broadcast):
+    # Shows the leader's answer as it grows, the final text comes from its result
+    answer = bot.reply_to(message, STREAM_PLACEHOLDER)
+    sent = STREAM_PLACEHOLDER
+    interval = _edit_interval(answer.chat)
+    deadline = time.monotonic() + FOLLOW_MAX_WAIT_S
+
+    while not flight.done() and time.monotonic() < deadline:
+        partial = flight.follow(sent, timeout=deadline - time.monotonic())
+
+        if partial.strip() and partial != sent and not flight.done() and _edit_answer(answer, partial):
+            sent = partial
+
+        wait([flight], timeout=interval)
+
+    text = followed_text(message, flight, max(deadline - time.monotonic(), 0))
+
+    if text != sent:
+        _finish_answer(message, answer, text)
+
+
+def _reply_streaming(
+        message: telebot.types.Message,
+        llm_message: List[dict[str, str]],
+        model_key: str,
+        fallback_keys: List[str] | None = None,
+        bypass: bool = False
+):
+    budget = _budget(llm_message, [model_key, *(fallback_keys or [])])
+    llm_message, max_tokens = budget.messages, budget.max_tokens
+    key = llm_cache.cache_key(llm_message, model_key, LLM_TEMPERATURE, max_tokens)
+    cached, flight, leader = llm_cache.claim(key, bypass)
+
+    if cached is not None:
+        bot.reply_to(message, cached)
+        return
+
+    # An identical question is already being answered: follow that answer instead of asking again
+    if not leader:
+        _follow(message, flight)
+        return
+
+    # Placeholder first, then edits with the accumulated answer no more often than Telegram allows
+    flight_key = key
+
+    try:
+        answer = bot.reply_to(message, STREAM_PLACEHOLDER)
+
+    except Exception as e:
+        llm_cache.settle(flight_key, error=e)
+        raise
+
+    text = ''
+    sent = STREAM_PLACEHOLDER
+    answer_key = None
+    t0 = time.perf_counter()
+
+    try:
+        if fallback_keys:
+            answered_by, stream = chat_stream_fallback(
+                llm_message,
+                models=[model_key, *fallback_keys],
+                hedge_after_s=_hedge_after_s(model_key),
+                temperature=LLM_TEMPERATURE,
+                max_tokens=max_tokens
+            )
+
+            if answered_by != model_key:
+                key = llm_cache.cache_key(llm_message, answered_by, LLM_TEMPERATURE, max_tokens)
+                model_key = answered_by
+
+        else:
+            stream = chat_stream(llm_message, model=model_key, temperature=LLM_TEMPERATURE, max_tokens=max_tokens)
+
+        text, sent = _stream_edits(answer, stream, sent, flight=flight)
+        text = clip(text)
+
+        if text:
+            answer_key = key
+
+        else:
+            text = EMPTY_ANSWER_TEXT
+
+    except Exception as e:
+        text = answer_error(e)
+
+    finally:
+        dt_ms = int((time.perf_counter() - t0) * 1000)
+        llm_cache.settle(flight_key, text or UNEXPECTED_ERROR_TEXT, key=answer_key, model=model_key, dt_ms=dt_ms)
+
+    if text != sent:
+        _finish_answer(message, answer, text)
+
+
+@router.command('start')
+def send_start(message: telebot.types.Message, command: Command):
     bot.reply_to(message, 'Привет! Я простой бот! Напиши /help', reply_markup=_create_keyboard())
     logger.info(f'Sent start message for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['help'])
-def send_help(message: telebot.types.Message):
+@router.command('help')
+def send_help(message: telebot.types.Message, command: Command):
     bot.reply_to(message, '/start - Начать\n/help - Помощь\n/about - О боте\n/sum - Суммирование чисел\n/confirm - Подтвердить действие\n/weather - Погода')
     logger.info(f'Sent help message for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['about'])
-def send_about(message: telebot.types.Message):
+@router.command('about')
+def send_about(message: telebot.types.Message, command: Command):
     bot.reply_to(message, 'Простой телеграм бот в рамках семинарских занятий.\nАвтор: Агаев Арсений Валерьевич 1032221668')
     logger.info(f'Sent about message for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['sum'])
-def send_sum(message: telebot.types.Message):
-    text = _sum_process(message.text.replace('/sum', ''))
+@router.command('sum')
+def send_sum(message: telebot.types.Message, command: Command):
+    text = _sum_process(command.text)
 
     bot.reply_to(message, text)
     logger.info(f'Sent sum message for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['max'])
-def send_max(message: telebot.types.Message):
-    text = _max_process(message.text.replace('/max', ''))
+@router.command('max')
+def send_max(message: telebot.types.Message, command: Command):
+    text = _max_process(command.text)
 
     bot.reply_to(message, text)
     logger.info(f'Sent max message for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['hide'])
-def hide_keyboard(message: telebot.types.Message):
+@router.command('hide')
+def hide_keyboard(message: telebot.types.Message, command: Command):
     bot.send_message(message.chat.id, 'Клавиатура спрятана', reply_markup=telebot.types.ReplyKeyboardRemove())
     logger.info(f'Keyboard remove for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['show'])
-def show_keyboard(message: telebot.types.Message):
+@router.command('show')
+def show_keyboard(message: telebot.types.Message, command: Command):
     bot.send_message(message.chat.id, 'Клавиатура активна', reply_markup=_create_keyboard())
     logger.info(f'Keyboard show for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['confirm'])
-def send_confirm(message: telebot.types.Message):
+@router.command('confirm')
+def send_confirm(message: telebot.types.Message, command: Command):
     keyboard = telebot.types.InlineKeyboardMarkup()
 
     keyboard.add(
@@ -233,17 +536,17 @@ def send_confirm(message: telebot.types.Message):
     logger.info(f'Sent confirm message for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['weather'])
-def send_weather(message: telebot.types.Message):
-    weather = _fetch_weather_moscow_open_meteo()
+@router.command('weather')
+def send_weather(message: telebot.types.Message, command: Command):
+    weather = weather_service.report()
 
     bot.reply_to(message, weather)
     logger.info(f'Sent weather message for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['add_note'])
-def send_add_note(message: telebot.types.Message):
-    note = message.text.replace('/add_note', '')
+@router.command('add_note')
+def send_add_note(message: telebot.types.Message, command: Command):
+    note = command.text
 
     if note:
         note_id = add_note(message.from_user.id, note)
@@ -256,13 +559,12 @@ def send_add_note(message: telebot.types.Message):
     logger.info(f'Sent add note message for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['list_notes'])
-def send_list_notes(message: telebot.types.Message):
-    count = count_notes(message.from_user.id)
+@router.command('list_notes')
+def send_list_notes(message: telebot.types.Message, command: Command):
+    notes, count = list_notes_page(message.from_user.id)
     reply_markup = None
 
     if count > 0:
-        notes = list_notes(message.from_user.id)
         notes_message_text = [
             NOTE_MESSAGE_PATTERN.replace('{{note}}', note[1]).replace('{{created_at}}', note[2])
             for note in notes
@@ -270,7 +572,7 @@ def send_list_notes(message: telebot.types.Message):
         text = '\n\n'.join(notes_message_text)
 
         if count > 10:
-            reply_markup = _create_note_keyboard('list', count, 0)
+            reply_markup = _create_note_keyboard('list', notes, False, True)
 
     else:
         text = 'Список заметок пуст'
@@ -279,14 +581,13 @@ def send_list_notes(message: telebot.types.Message):
     logger.info(f'Sent list notes for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['find_note'])
-def send_find_note(message: telebot.types.Message):
-    message_text = message.text.replace('/find_note', '').strip()
+@router.command('find_note')
+def send_find_note(message: telebot.types.Message, command: Command):
+    message_text = command.text
     reply_markup = None
 
     if message_text:
-        notes = find_note(message.from_user.id, message_text)
-        count = count_notes(message.from_user.id, message_text)
+        notes, count = find_note_page(message.from_user.id, message_text)
 
         if count > 0:
             notes_message_text = [
@@ -296,7 +597,7 @@ def send_find_note(message: telebot.types.Message):
             text ='\n\n'.join(notes_message_text)
 
             if count > 10:
-                reply_markup = _create_note_keyboard('find', count, 0, text=message_text)
+                reply_markup = _create_note_keyboard('find', notes, False, True, text=message_text)
 
         else:
             text = 'Ничего не найдено'
@@ -308,13 +609,11 @@ def send_find_note(message: telebot.types.Message):
     logger.info(f'Sent find note message for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['edit_note'])
-def send_edit_note(message: telebot.types.Message):
-    tokens = message.text.replace('/edit_note', '').strip().split(maxsplit=1)
-
-    if tokens:
-        if len(tokens) == 2:
-            note_id, note_text = tokens
+@router.command('edit_note')
+def send_edit_note(message: telebot.types.Message, command: Command):
+    if command.text:
+        if command.tail:
+            note_id, note_text = command.head, command.tail
 
             if note_id.isdigit():
                 note_id = int(note_id)
@@ -339,9 +638,9 @@ def send_edit_note(message: telebot.types.Message):
     logger.info(f'Sent edit note message for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['delete_note'])
-def send_delete_note(message: telebot.types.Message):
-    note_id = message.text.replace('/delete_note', '').strip()
+@router.command('delete_note')
+def send_delete_note(message: telebot.types.Message, command: Command):
+    note_id = command.text
 
     if note_id.isdigit():
         note_id = int(note_id)
@@ -360,16 +659,16 @@ def send_delete_note(message: telebot.types.Message):
     logger.info(f'Sent delete note message for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['count_notes'])
-def send_count_notes(message: telebot.types.Message):
+@router.command('count_notes')
+def send_count_notes(message: telebot.types.Message, command: Command):
     count = count_notes(message.from_user.id)
 
     bot.reply_to(message, f'Сохранено заметок: {count}')
     logger.info(f'Sent count notes for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['models'])
-def send_cmd_models(message: telebot.types.Message):
+@router.command('models')
+def send_cmd_models(message: telebot.types.Message, command: Command):
     items = list_models()
 
     if items:
@@ -389,9 +688,9 @@ def send_cmd_models(message: telebot.types.Message):
     logger.info(f'Sent models for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['model'])
-def send_cmd_model(message: telebot.types.Message):
-    token = message.text.replace('/model', '').strip()
+@router.command('model')
+def send_cmd_model(message: telebot.types.Message, command: Command):
+    token = command.text
 
     if not token:
         active_model = get_active_model()
@@ -408,104 +707,119 @@ def send_cmd_model(message: telebot.types.Message):
     logger.info(f'Sent model for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['ask'])
-def send_cmd_ask(message: telebot.types.Message):
-    token = message.text.replace('/ask', '').strip()
+@router.command('ask')
+def send_cmd_ask(message: telebot.types.Message, command: Command):
+    text, question, bypass = parse_ask(command)
 
-    if not token:
-        text = 'Отсутствует текст вопроса. Пример использования:\n /ask Вопрос'
+    if not text:
+        llm_message = _build_messages(message.from_user.id, question)
+        model_key = _pick_model()
 
-    else:
-        llm_message = _build_messages(message.from_user.id, token[:600])
-        model_key = get_active_model()['key']
+        _reply_streaming(message, llm_message, model_key, _fallback_models(model_key), bypass)
 
+    if text:
+        bot.reply_to(message, text)
+
+    logger.info(f'Sent ask for {message.from_user.id} ({message.from_user.first_name}).')
+
+
+@router.command('ask_model')
+def send_cmd_ask_model(message: telebot.types.Message, command: Command):
+    model_key = None
+    text, model_id, question, bypass = parse_ask_model(command)
+
+    if not text:
         try:
-            text, ms = chat_once(llm_message, model=model_key, temperature=0.2, max_tokens=400)
-            text = text.strip()[:4096]
+            llm_message = _build_messages(message.from_user.id, question)
+            model_key = get_model_by_id(model_id)['key']
 
-        except OpenRouterError as e:
-            text = f'Ошибка: {e}'
+        except ValueError:
+            text = UNKNOWN_MODEL_TEXT
 
-        except Exception as e:
-            text = 'Непредвиденная ошибка'
-            logger.error(e)
+        else:
+            _reply_streaming(message, llm_message, model_key, bypass=bypass)
 
-    bot.reply_to(message, text)
-    logger.info(f'Sent ask for {message.from_user.id} ({message.from_user.first_name}).')
+    if text:
+        bot.reply_to(message, text)
 
+    logger.info(f'Sent ask {model_key} for {message.from_user.id} ({message.from_user.first_name}).')
 
-@bot.message_handler(commands=['ask_model'])
-def send_cmd_ask_model(message: telebot.types.Message):
-    tokens = message.text.replace('/ask_model', '').strip().split(maxsplit=1)
-    model_key = None
 
-    if not tokens:
-        text = 'Отсутствуют аргументы. Пример использования:\n/ask_model <ID> Вопрос'
+def _compare_answer(message: telebot.types.Message, llm_message: List[dict[str, str]], model: dict) -> int:
+    header = f'{model["label"]}:\n'
+    sent = header + STREAM_PLACEHOLDER
+    answer = bot.reply_to(message, sent)
+    t0 = time.perf_counter()
 
-    elif len(tokens) != 2:
-        text = 'Отсутствуют аргументы или их слишком много. Пример использования:\n/ask_model <ID> Вопрос'
+    # No response cache and no fallback: the point is this model's own answer and latency
+    try:
+        budget = _budget(llm_message, [model['key']])
+        stream = chat_stream(
+            budget.messages, model=model['key'], temperature=LLM_TEMPERATURE, max_tokens=budget.max_tokens
+        )
+        text, sent = _stream_edits(answer, stream, sent, header)
+        text = text.strip() or EMPTY_ANSWER_TEXT
 
-    elif not tokens[0].isdigit():
-        text = 'ID не является числом. Пример использования:\n /ask_model 1 Вопрос'
+    except Exception as e:
+        text = answer_error(e)
 
-    else:
-        try:
-            llm_message = _build_messages(message.from_user.id, tokens[1][:600])
-            model_key = get_model_by_id(int(tokens[0]))['key']
+    dt_ms = int((time.perf_counter() - t0) * 1000)
+    _finish_answer(message, answer, compare_text(model, dt_ms, text))
 
-            try:
-                text, ms = chat_once(llm_message, model=model_key, temperature=0.2, max_tokens=400)
-                text = text.strip()[:4096]
+    return dt_ms
 
-            except OpenRouterError as e:
-                text = f'Ошибка: {e}'
 
-            except Exception as e:
-                text = 'Непредвиденная ошибка'
-                logger.error(e)
+@router.command('ask_compare')
+def send_cmd_ask_compare(message: telebot.types.Message, command: Command):
+    text, ids = parse_compare(command)
+
+    if not text:
+        try:
+            models = [get_model_by_id(id) for id in ids]
 
         except ValueError:
-            text = 'Неизвестный ID модели. Используйте /models для получения списка моделей'
+            text = UNKNOWN_MODEL_TEXT
 
-    bot.reply_to(message, text)
-    logger.info(f'Sent ask {model_key} for {message.from_user.id} ({message.from_user.first_name}).')
+        else:
+            llm_message = _build_messages(message.from_user.id, command.tail)
+            t0 = time.perf_counter()
+            # All models at once: the command takes as long as the slowest one
+            futures = [_compare_pool.submit(_compare_answer, message, llm_message, model) for model in models]
+            wait(futures)
 
+            logger.debug(f'Compared {len(models)} models in {int((time.perf_counter() - t0) * 1000)} ms.')
 
-@bot.message_handler(commands=['ask_random'])
-def send_cmd_ask_random(message: telebot.types.Message):
-    token = message.text.replace('/ask_random', '').strip()
-    characters = list_characters()
+    if text:
+        bot.reply_to(message, text)
 
-    if not token:
-        text = 'Отсутствует текст вопроса. Пример использования:\n /ask Вопрос'
+    logger.info(f'Sent ask compare for {message.from_user.id} ({message.from_user.first_name}).')
+
+
+@router.command('ask_random')
+def send_cmd_ask_random(message: telebot.types.Message, command: Command):
+    text, question, bypass = parse_ask(command)
+    characters = list_characters()
 
-    elif not characters:
+    if not text and not characters:
         text = 'Каталог персонажей пуст'
 
-    else:
+    if not text:
         chosen = random.choice(characters)
         character = get_character_by_id(chosen['id'])
 
-        llm_message = _build_messages(message.from_user.id, token, character)
-        model_key = get_active_model()['key']
-
-        try:
-            text, ms = chat_once(llm_message, model=model_key, temperature=0.2, max_tokens=400)
-            text = text.strip()[:4096]
+        llm_message = _build_messages(message.from_user.id, question, character)
+        model_key = _pick_model()
 
-        except OpenRouterError as e:
-            text = f'Ошибка: {e}'
+        _reply_streaming(message, llm_message, model_key, _fallback_models(model_key), bypass)
 
-        except Exception as e:
-            text = 'Непредвиденная ошибка'
-            logger.error(e)
+    if text:
+        bot.reply_to(message, text)
 
-    bot.reply_to(message, text)
     logger.info(f'Sent random ask for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['characters'])
-def send_cmd_characters(message: telebot.types.Message):
+@router.command('characters')
+def send_cmd_characters(message: telebot.types.Message, command: Command):
     characters = list_characters()
 
     if not characters:
@@ -531,9 +845,9 @@ def send_cmd_characters(message: telebot.types.Message):
     logger.info(f'Sent characters for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['character'])
-def send_cmd_character(message: telebot.types.Message):
-    token = message.text.replace('/character', '').strip()
+@router.command('character')
+def send_cmd_character(message: telebot.types.Message, command: Command):
+    token = command.text
 
     if not token:
         character = get_user_character(message.from_user.id)
@@ -554,21 +868,19 @@ def send_cmd_character(message: telebot.types.Message):
     logger.info(f'Sent character for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['character_name'])
-def send_cmd_character_name(message: telebot.types.Message):
-    tokens = message.text.replace('/character_name', '').strip().split(maxsplit=1)
-
-    if not tokens:
+@router.command('character_name')
+def send_cmd_character_name(message: telebot.types.Message, command: Command):
+    if not command.text:
         text = 'Отсутствуют аргументы. Пример использования:\n/character_name <ID> Имя'
 
-    elif len(tokens) != 2:
+    elif not command.tail:
         text = 'Отсутствуют аргументы или их слишком много. Пример использования:\n/character_name <ID> Имя'
 
-    elif not tokens[0].isdigit():
+    elif not command.head.isdigit():
         text = 'ID не является числом. Пример использования:\n /character_name 1 Имя'
 
     else:
-        if update_character_name_by_id(int(tokens[0]), tokens[1]):
+        if update_character_name_by_id(int(command.head), command.tail):
             text = 'Имя персонажа успешно изменено.'
 
         else:
@@ -578,8 +890,8 @@ def send_cmd_character_name(message: telebot.types.Message):
     logger.info(f'Sent character for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(commands=['whoami'])
-def send_cmd_whoami(message: telebot.types.Message):
+@router.command('whoami')
+def send_cmd_whoami(message: telebot.types.Message, command: Command):
     character = get_user_character(message.from_user.id)
     model = get_active_model()
 
@@ -587,34 +899,69 @@ def send_cmd_whoami(message: telebot.types.Message):
     logger.info(f'Sent whoami for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(func=lambda message: message.text == 'Помощь')
-def send_help_button(message: telebot.types.Message):
-    send_help(message)
+@router.command('stats')
+def send_cmd_stats(message: telebot.types.Message, command: Command):
+    if message.from_user.id not in config.admin_ids:
+        text = 'Команда доступна только администраторам.'
+
+    else:
+        lines = ['Модели за последний час:']
+
+        for summary in telemetry.summaries():
+            statuses = ', '.join(f'{status}: {count}' for status, count in sorted(summary['statuses'].items()))
+            lines.append(
+                f'{summary["model"]}\n'
+                f'  запросов {summary["requests"]}, ошибок {summary["error_rate"]:.0%} ({statuses})\n'
+                f'  p50 {summary["p50_ms"]} мс, p95 {summary["p95_ms"]} мс, p99 {summary["p99_ms"]} мс\n'
+                f'  токены: {summary["prompt_tokens"]} вход, {summary["completion_tokens"]} выход'
+            )
+
+        if len(lines) == 1:
+            lines.append('Запросов не было.')
+
+        cache = llm_cache.stats()
+        lines.append(
+            f'\nКэш ответов: {cache["hits"]} попаданий, {cache["misses"]} промахов '
+            f'({cache["hit_rate"]:.0%}), сэкономлено {cache["saved_ms"]} мс, '
+            f'объединено одинаковых запросов {cache["coalesced"]}'
+        )
+
+        for title, cache in zip(('Кэш персонажей', 'Кэш выбора персонажа'), character_cache_stats().values()):
+            lines.append(f'{title}: {cache["hits"]} попаданий, {cache["misses"]} промахов ({cache["hit_rate"]:.0%})')
+        text = '\n'.join(lines)
+
+    bot.reply_to(message, text[:4096])
+    logger.info(f'Sent stats for {message.from_user.id} ({message.from_user.first_name}).')
+
+
+@router.button('Помощь')
+def send_help_button(message: telebot.types.Message, command: Command):
+    send_help(message, command)
     logger.info(f'Process keyboard button "Помощь" for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(func=lambda message: message.text == 'О боте')
-def send_about_button(message: telebot.types.Message):
-    send_about(message)
+@router.button('О боте')
+def send_about_button(message: telebot.types.Message, command: Command):
+    send_about(message, command)
     logger.info(f'Process keyboard button "О боте" for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(func=lambda message: message.text == 'Сумма')
-def send_sum_button(message: telebot.types.Message):
+@router.button('Сумма')
+def send_sum_button(message: telebot.types.Message, command: Command):
     bot.send_message(message.chat.id, 'Введите числа через пробел или запятую:')
     bot.register_next_step_handler(message, send_text_sum)
     logger.info(f'Process keyboard button "Сумма" for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(func=lambda message: message.text == 'Скрыть клавиатуру')
-def hide_keyboard_button(message: telebot.types.Message):
-    hide_keyboard(message)
+@router.button('Скрыть клавиатуру')
+def hide_keyboard_button(message: telebot.types.Message, command: Command):
+    hide_keyboard(message, command)
     logger.info(f'Process keyboard button "Скрыть клавиатуру" for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.message_handler(func=lambda message: message.text == 'Погода')
-def send_weather_button(message: telebot.types.Message):
-    send_weather(message)
+@router.button('Погода')
+def send_weather_button(message: telebot.types.Message, command: Command):
+    send_weather(message, command)
     logger.info(f'Process keyboard button "Погода" for {message.from_user.id} ({message.from_user.first_name}).')
 
 
@@ -625,7 +972,7 @@ def send_text_sum(message: telebot.types.Message):
     logger.info(f'Summarization from text for {message.from_user.id} ({message.from_user.first_name}).')
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('confirm:'))
+@router.callback('confirm')
 def send_confirm_yes_button(call: telebot.types.CallbackQuery):
     choice = call.data.split(':', 1)[1]
 
@@ -636,35 +983,120 @@ def send_confirm_yes_button(call: telebot.types.CallbackQuery):
     logger.info(f'Process inline keyboard button "{call.data}" for {call.message.chat.id}.')
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('note:'))
+@router.callback('note')
 def send_notes(call: telebot.types.CallbackQuery):
-    # note:{cmd_type}:{count}:{offset}:{step}:{text}
-    _, cmd_type, count, offset, step, find_text = call.data.split(':')
+    # note:{cmd_type}:{direction}:{cursor}:{step}:{text}
+    _, cmd_type, direction, cursor, step, find_text = call.data.split(':', 5)
+    step = int(step)
+    cursor = {'before_id' if direction == 'next' else 'after_id': int(cursor)}
 
+    # remaining is capped at step + 1: enough to tell whether another page follows
     if cmd_type == 'list':
-        notes = list_notes(call.from_user.id, int(step), int(offset))
+        notes, remaining = list_notes_page(call.from_user.id, step, **cursor)
 
     elif cmd_type == 'find':
-        notes = find_note(call.from_user.id, find_text, int(step), int(offset))
+        notes, remaining = find_note_page(call.from_user.id, find_text, step, **cursor)
 
     else:
         return
 
+    if not notes:
+        bot.answer_callback_query(call.id, 'Заметок больше нет')
+        return
+
+    if direction == 'next':
+        has_prev, has_next = True, remaining > step
+
+    else:
+        has_prev, has_next = remaining > step, True
+
     notes_message_text = [
         NOTE_MESSAGE_PATTERN.replace('{{note}}', note[1]).replace('{{created_at}}', note[2])
         for note in notes
     ]
     text = '\n\n'.join(notes_message_text)
-    reply_markup = _create_note_keyboard(cmd_type, int(count), int(offset), int(step), find_text)
+    reply_markup = _create_note_keyboard(cmd_type, notes, has_prev, has_next, step, find_text)
 
     bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=reply_markup)
     logger.info(f'Process inline keyboard button "{call.data}" for {call.message.chat.id}.')
 
 
+# The only handlers telebot sees: routing is a dict lookup in router instead of a predicate per handler
+@bot.message_handler(func=lambda message: True)
+def dispatch(message: telebot.types.Message):
+    route = router.resolve(message.text or '')
+
+    if route is not None:
+        handler, command = route
+        handler(message, command)
+
+
+@bot.callback_query_handler(func=lambda call: True)
+def dispatch_callback(call: telebot.types.CallbackQuery):
+    handler = router.resolve_callback(call.data or '')
+
+    if handler is not None:
+        handler(call)
+
+
+def _start_webhook() -> WebhookServer | None:
+    # Polling stays the fallback when the endpoint can't start or Telegram doesn't accept it
+    try:
+        server = WebhookServer(
+            bot,
+            host=config.webhook_host,
+            port=config.webhook_port,
+            path=urlparse(config.webhook_url).path or '/',
+            secret_token=config.webhook_secret,
+            max_pending=config.webhook_max_pending
+        )
+
+    except OSError as e:
+        logger.error(f'Webhook server failed to start, falling back to polling: {e}')
+        return None
+
+    try:
+        bot.set_webhook(url=config.webhook_url, secret_token=config.webhook_secret, drop_pending_updates=True)
+
+    except Exception as e:
+        logger.error(f'Webhook registration failed, falling back to polling: {e}')
+        server.stop()
+        return None
+
+    logger.info(f'Webhook listening on {config.webhook_host}:{server.port}.')
+
+    return server
+
+
 if __name__ == '__main__':
     init_db()
 
     _setup_bot_commands(bot)
 
+    start_persisting(save_model_stats, config.telemetry_persist_s)
+    weather_service.start()
+
     logger.info('Telegram Bot started.')
-    bot.infinity_polling(skip_pending=True)
+
+    try:
+        server = _start_webhook() if config.webhook_url else None
+
+        if server is not None:
+            try:
+                server.serve_forever()
+
+            finally:
+                server.stop()
+
+        else:
+            # getUpdates is refused while a webhook from an earlier run is still registered
+            bot.remove_webhook()
+            bot.infinity_polling(skip_pending=True)
+
+    finally:
+        bot.close_lanes()
+        _compare_pool.shutdown(wait=True, cancel_futures=True)
+        stop_persisting(save_model_stats)
+        weather_service.stop()
+        close_session()
+        close_connections()
@@ -0,0 +1,190 @@
+from dataclasses import dataclass
+import sqlite3
+
+from config import logger
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    statements: tuple[str, ...]
+
+
+# Append new steps to the end, never edit a step that has already shipped
+MIGRATIONS = (
+    Migration(1, 'Base schema', (
+        '''CREATE TABLE IF NOT EXISTS notes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS models (
+            id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL UNIQUE,
+            label TEXT NOT NULL,
+            active INTEGER NOT NULL DEFAULT 0 CHECK (active IN (0, 1))
+        )''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS ux_models_single_active
+        ON models(active) WHERE active=1''',
+        '''CREATE TABLE IF NOT EXISTS characters (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            prompt TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS user_character (
+            user_id INTEGER PRIMARY KEY,
+            character_id INTEGER NOT NULL,
+            active INTEGER NOT NULL DEFAULT 0 CHECK (active IN (0, 1)),
+            FOREIGN KEY(character_id) REFERENCES characters(id)
+        )''',
+    )),
+    Migration(2, 'Indexes for notes pagination and character links', (
+        '''CREATE INDEX IF NOT EXISTS ix_notes_user_id
+        ON notes(user_id, id)''',
+        '''CREATE INDEX IF NOT EXISTS ix_user_character_character_id
+        ON user_character(character_id)''',
+    )),
+    Migration(3, 'Notes full-text search index', (
+        # Trigram tokenizer: substring search with Unicode case folding (Cyrillic included)
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            text,
+            content='notes',
+            content_rowid='id',
+            tokenize='trigram'
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS notes_fts_ai AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts(rowid, text) VALUES (new.id, new.text);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS notes_fts_ad AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS notes_fts_au AFTER UPDATE OF text ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO notes_fts(rowid, text) VALUES (new.id, new.text);
+        END''',
+        "INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')",
+    )),
+    Migration(4, 'Per-user note counters', (
+        # Kept by triggers, so counting notes is a primary key lookup
+        '''CREATE TABLE IF NOT EXISTS note_stats (
+            user_id INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0,
+            last_note_id INTEGER,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS note_stats_ai AFTER INSERT ON notes BEGIN
+            INSERT INTO note_stats(user_id, count, last_note_id, updated_at)
+            VALUES (new.user_id, 1, new.id, CURRENT_TIMESTAMP)
+            ON CONFLICT (user_id) DO UPDATE SET
+                count = count + 1,
+                last_note_id = excluded.last_note_id,
+                updated_at = excluded.updated_at;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS note_stats_ad AFTER DELETE ON notes BEGIN
+            UPDATE note_stats SET
+                count = count - 1,
+                last_note_id = (SELECT MAX(id) FROM notes WHERE user_id = old.user_id),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = old.user_id;
+        END''',
+        '''INSERT OR REPLACE INTO note_stats(user_id, count, last_note_id)
+        SELECT user_id, COUNT(*), MAX(id)
+        FROM notes
+        GROUP BY user_id''',
+    )),
+    Migration(5, 'Refresh query planner statistics', (
+        'ANALYZE',
+    )),
+    Migration(6, 'Persistent LLM response cache', (
+        '''CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            dt_ms INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )''',
+        '''CREATE INDEX IF NOT EXISTS ix_llm_cache_created_at
+        ON llm_cache(created_at)''',
+    )),
+    Migration(7, 'Model telemetry snapshots', (
+        '''CREATE TABLE IF NOT EXISTS model_stats (
+            model TEXT NOT NULL,
+            recorded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            requests INTEGER NOT NULL,
+            errors INTEGER NOT NULL,
+            p50_ms INTEGER,
+            p95_ms INTEGER,
+            p99_ms INTEGER,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            statuses TEXT NOT NULL,
+            PRIMARY KEY (model, recorded_at)
+        )''',
+    )),
+    Migration(8, 'Per-model context window', (
+        # NULL means the LLM_CONTEXT_TOKENS default
+        'ALTER TABLE models ADD COLUMN context_tokens INTEGER',
+    )),
+    Migration(9, 'Compiled character system prompts', (
+        'ALTER TABLE characters ADD COLUMN prompt_version INTEGER NOT NULL DEFAULT 1',
+        'ALTER TABLE characters ADD COLUMN system_prompt TEXT',
+        'ALTER TABLE characters ADD COLUMN system_prompt_template INTEGER',
+        # Any change to the character makes the compiled prompt stale
+        '''CREATE TRIGGER IF NOT EXISTS characters_prompt_au AFTER UPDATE OF name, prompt ON characters BEGIN
+            UPDATE characters SET
+                prompt_version = prompt_version + 1,
+                system_prompt = NULL,
+                system_prompt_template = NULL
+            WHERE id = new.id;
+        END''',
+    )),
+)
+
+
+def _current_version(conn: sqlite3.Connection) -> int:
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def apply_migrations(conn: sqlite3.Connection, migrations: tuple[Migration, ...] = MIGRATIONS) -> int:
+    conn.execute(
+        '''CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )'''
+    )
+    conn.commit()
+
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if migration.version <= _current_version(conn):
+            continue
+
+        # Each step is one transaction: a failed step leaves the database at the previous version
+        conn.execute('BEGIN IMMEDIATE')
+
+        try:
+            # Another process may have applied it while we waited for the write lock
+            if migration.version <= _current_version(conn):
+                conn.rollback()
+                continue
+
+            for statement in migration.statements:
+                conn.execute(statement)
+
+            conn.execute(
+                'INSERT INTO schema_version(version, description) VALUES (?, ?)',
+                (migration.version, migration.description)
+            )
+            conn.commit()
+
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f'Migration {migration.version} ({migration.description}) failed: {e}')
+            raise
+
+        logger.info(f'Migration {migration.version} applied: {migration.description}.')
+
+    return _current_version(conn)
@@ -0,0 +1,239 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Dict, List, Tuple
+
+import aiohttp
+
+from config import config, logger
+from openrouter_client import OPENROUTER_API_URL, OpenRouterError, RETRY_POLICY, _friendly, _headers, _limiter, get_breaker
+from telemetry import telemetry
+import token_budget
+
+# Same retry policy, breakers, rate limits and telemetry as the threaded client, but no thread per request
+_session: aiohttp.ClientSession | None = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    # Created lazily inside the running loop; the connector keeps connections alive like the requests pool
+    global _session
+
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=config.async_http_pool_size)
+        _session = aiohttp.ClientSession(connector=connector)
+
+    return _session
+
+
+async def close_session():
+    global _session
+
+    session, _session = _session, None
+
+    if session is not None:
+        await session.close()
+
+
+async def _post(payload: Dict, *, timeout_s: float) -> aiohttp.ClientResponse:
+    # Retries share one deadline with timeout_s, as in openrouter_client._post
+    headers = _headers()
+    breaker = get_breaker(payload['model'])
+    deadline = time.monotonic() + timeout_s
+    attempt = 0
+
+    while True:
+        if not breaker.allow():
+            raise OpenRouterError(503, 'Модель временно недоступна. Попробуйте позднее.')
+
+        while wait := _limiter.try_acquire(config.openrouter_api_key, payload['model']):
+            if config.openrouter_rate_mode != 'WAIT' or time.monotonic() + wait > deadline:
+                raise OpenRouterError(429, 'Превышен лимит запросов к OpenRouter. Попробуйте позднее.')
+
+            await asyncio.sleep(wait)
+
+        remaining = deadline - time.monotonic()
+        retry_after = None
+        t0 = time.perf_counter()
+
+        try:
+            response = await get_session().post(
+                OPENROUTER_API_URL,
+                json=payload,
+                headers=headers,
+                # Per-read like the requests timeout, so a long answer can keep streaming
+                timeout=aiohttp.ClientTimeout(total=None, connect=max(remaining, 0.1), sock_read=max(remaining, 0.1))
+            )
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            breaker.failure()
+            telemetry.record(payload['model'], int((time.perf_counter() - t0) * 1000), 0)
+            error = OpenRouterError(504, _friendly(504))
+            logger.warning(f'OpenRouter request to {payload["model"]} failed: {e}')
+
+        else:
+            status = response.status
+
+            if status // 100 == 2:
+                breaker.success()
+                return response
+
+            response.release()
+            telemetry.record(payload['model'], int((time.perf_counter() - t0) * 1000), status)
+            error = OpenRouterError(status, _friendly(status))
+
+            if status >= 500:
+                breaker.failure()
+
+            if status not in RETRY_POLICY.retry_statuses:
+                raise error
+
+            retry_after = response.headers.get('Retry-After')
+
+        attempt += 1
+        delay = RETRY_POLICY.delay(attempt - 1, retry_after)
+
+        if attempt >= RETRY_POLICY.max_attempts or time.monotonic() + delay >= deadline:
+            raise error
+
+        logger.info(f'Retrying OpenRouter request to {payload["model"]} in {delay:.2f} s ({error}).')
+        await asyncio.sleep(delay)
+
+
+async def chat_stream(messages: List[Dict],
+                      *,
+                      model: str,
+                      temperature: float = 0.2,
+                      max_tokens: int = 400,
+                      timeout_s: int = 30
+) -> AsyncIterator[str]:
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True,
+        "usage": {"include": True},
+    }
+    usage = None
+    t0 = time.perf_counter()
+    response = await _post(payload, timeout_s=timeout_s)
+
+    try:
+        async for raw_line in response.content:
+            line = raw_line.decode('utf-8').strip()
+
+            if not line.startswith('data:'):
+                continue
+
+            data = line[len('data:'):].strip()
+
+            if data == '[DONE]':
+                break
+
+            try:
+                chunk = json.loads(data)
+
+            except ValueError:
+                raise OpenRouterError(500, "Неожиданная структура ответа OpenRouter.")
+
+            if 'error' in chunk:
+                status = chunk['error'].get('code', 500) if isinstance(chunk['error'], dict) else 500
+                status = status if isinstance(status, int) else 500
+                telemetry.record(model, int((time.perf_counter() - t0) * 1000), status)
+                raise OpenRouterError(status, _friendly(status))
+
+            usage = chunk.get('usage') or usage
+
+            if not chunk.get('choices'):
+                continue
+
+            try:
+                delta = chunk["choices"][0]["delta"].get("content")
+
+            except (KeyError, IndexError, AttributeError):
+                raise OpenRouterError(500, "Неожиданная структура ответа OpenRouter.")
+
+            if delta:
+                yield delta
+
+    # Same as openrouter_client.chat_stream: a broken stream counts as a failed connection
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        get_breaker(model).failure()
+        telemetry.record(model, int((time.perf_counter() - t0) * 1000), 0)
+        logger.warning(f'OpenRouter stream from {model} broke: {e}')
+        raise OpenRouterError(504, _friendly(504))
+
+    finally:
+        response.release()
+
+    telemetry.record(model, int((time.perf_counter() - t0) * 1000), response.status, usage)
+    token_budget.calibrate(model, messages, (usage or {}).get('prompt_tokens'))
+
+
+async def _prepend(first: str, stream: AsyncIterator[str]) -> AsyncIterator[str]:
+    if first:
+        yield first
+
+    async for delta in stream:
+        yield delta
+
+
+async def chat_stream_fallback(messages: List[Dict],
+                               *,
+                               models: List[str],
+                               hedge_after_s: float,
+                               temperature: float = 0.2,
+                               max_tokens: int = 400,
+                               timeout_s: int = 30
+) -> Tuple[str, AsyncIterator[str]]:
+    # Same hedging as openrouter_client.chat_stream_fallback, with tasks instead of threads
+    pending = list(models)
+    running: dict[asyncio.Task, tuple[str, AsyncIterator[str]]] = {}
+    error: Exception | None = None
+    deadline = time.monotonic() + timeout_s
+
+    def start(model: str):
+        stream = chat_stream(messages, model=model, temperature=temperature, max_tokens=max_tokens, timeout_s=timeout_s)
+        running[asyncio.ensure_future(anext(stream, ''))] = (model, stream)
+
+    async def close_losers():
+        for task, (_, stream) in running.items():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await stream.aclose()
+
+    start(pending.pop(0))
+
+    try:
+        while running:
+            remaining = deadline - time.monotonic()
+            timeout = max(0.0, min(hedge_after_s, remaining) if pending else remaining)
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                if pending and remaining > 0:
+                    logger.info(f'No answer within {hedge_after_s} s, hedging with {pending[0]}.')
+                    start(pending.pop(0))
+                    continue
+
+                raise OpenRouterError(504, _friendly(504))
+
+            for task in done:
+                model, stream = running.pop(task)
+
+                if task.exception() is None:
+                    return model, _prepend(task.result(), stream)
+
+                error = task.exception()
+                logger.warning(f'Model {model} failed: {error}')
+
+                if pending:
+                    start(pending.pop(0))
+
+    finally:
+        await close_losers()
+
+    if isinstance(error, OpenRouterError):
+        raise error
+
+    raise OpenRouterError(503, _friendly(503))
@@ -1,13 +1,25 @@
 from dataclasses import dataclass
+import itertools
+import json
+import queue
+import random
+import threading
 import time
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from config import config
+from config import config, logger
+from rate_limit import RateLimiter
+from telemetry import telemetry
+import token_budget
 
 OPENROUTER_API_URL = 'https://openrouter.ai/api/v1/chat/completions'
 
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
 
 @dataclass
 class OpenRouterError(Exception):
@@ -18,6 +30,90 @@ class OpenRouterError(Exception):
         return f'[{self.status}] {self.msg}'
 
 
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 3
+    base_delay_s: float = 0.5
+    max_delay_s: float = 8.0
+    retry_statuses: tuple[int, ...] = (429, 500, 502, 503, 504)
+
+    def delay(self, attempt: int, retry_after: str | None = None) -> float:
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+
+            except ValueError:
+                pass
+
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay_s, self.base_delay_s * 2 ** attempt))
+
+
+class CircuitBreaker:
+    # Opens after `threshold` consecutive upstream failures, lets one probe through after reset_s
+    def __init__(self, threshold: int = 5, reset_s: float = 30.0):
+        self.threshold = threshold
+        self.reset_s = reset_s
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.probing = False
+        self.probed_at = 0.0
+
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+
+            now = time.monotonic()
+
+            if now - self.opened_at < self.reset_s:
+                return False
+
+            # Half-open: the first caller probes, the rest are turned away until it reports back.
+            # A probe that never reports (a 4xx, a local 429) is replaced after another reset_s
+            if self.probing and now - self.probed_at < self.reset_s:
+                return False
+
+            self.probing = True
+            self.probed_at = now
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+
+            # Still at the threshold while half-open, so a failed probe reopens it right away
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+RETRY_POLICY = RetryPolicy(max_attempts=config.openrouter_max_attempts)
+_limiter = RateLimiter(config.openrouter_rpm_key, config.openrouter_rpm_model)
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+_sleep = time.sleep
+
+
+def get_breaker(model: str) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(model)
+
+        if breaker is None:
+            breaker = CircuitBreaker(config.openrouter_breaker_threshold, config.openrouter_breaker_reset_s)
+            _breakers[model] = breaker
+
+        return breaker
+
+
 def _friendly(status: int) -> str:
     dict_friendly = {
         400: 'Неверный формат запроса.',
@@ -34,21 +130,116 @@ def _friendly(status: int) -> str:
     return dict_friendly.get(status, 'Сервис недоступен. Повторите попытку позже.')
 
 
-def chat_once(messages: List[Dict],
-              *,
-              model: str,
-              temperature: float = 0.2,
-              max_tokens: int = 400,
-              timeout_s: int = 30
-) -> Tuple[str, int]:
+def get_session() -> requests.Session:
+    # One keep-alive session for all handler threads: TCP+TLS handshakes are paid once per pooled connection
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.http_pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+
+    return _session
+
+
+def close_session():
+    global _session
+
+    with _session_lock:
+        session, _session = _session, None
+
+    if session is not None:
+        session.close()
+
+
+def _headers() -> Dict[str, str]:
     if not config.openrouter_api_key:
         raise OpenRouterError(401, "Отсутствует OPENROUTER_API_KEY (.env).")
 
-    headers = {
+    return {
         "Authorization": f"Bearer {config.openrouter_api_key}",
         "Content-Type": "application/json",
     }
 
+
+def _post(payload: Dict, *, timeout_s: float, stream: bool = False) -> requests.Response:
+    # Retries share one deadline with timeout_s, so a call never takes longer than the caller allowed
+    headers = _headers()
+    breaker = get_breaker(payload['model'])
+    deadline = time.monotonic() + timeout_s
+    attempt = 0
+
+    while True:
+        if not breaker.allow():
+            raise OpenRouterError(503, 'Модель временно недоступна. Попробуйте позднее.')
+
+        remaining = deadline - time.monotonic()
+        wait_s = remaining if config.openrouter_rate_mode == 'WAIT' else 0.0
+
+        # Paced locally so requests over the free-tier quota don't cost a round trip
+        if not _limiter.acquire(config.openrouter_api_key, payload['model'], wait_s):
+            raise OpenRouterError(429, 'Превышен лимит запросов к OpenRouter. Попробуйте позднее.')
+
+        remaining = deadline - time.monotonic()
+        retry_after = None
+        t0 = time.perf_counter()
+
+        try:
+            request = get_session().post(
+                OPENROUTER_API_URL,
+                json=payload,
+                headers=headers,
+                timeout=max(remaining, 0.1),
+                stream=stream
+            )
+
+        except (requests.ConnectionError, requests.Timeout) as e:
+            breaker.failure()
+            # Status 0 marks a network error in telemetry
+            telemetry.record(payload['model'], int((time.perf_counter() - t0) * 1000), 0)
+            error = OpenRouterError(504, _friendly(504))
+            logger.warning(f'OpenRouter request to {payload["model"]} failed: {e}')
+
+        else:
+            status = request.status_code
+
+            if status // 100 == 2:
+                breaker.success()
+                return request
+
+            request.close()
+            telemetry.record(payload['model'], int((time.perf_counter() - t0) * 1000), status)
+            error = OpenRouterError(status, _friendly(status))
+
+            if status >= 500:
+                breaker.failure()
+
+            if status not in RETRY_POLICY.retry_statuses:
+                raise error
+
+            retry_after = request.headers.get('Retry-After')
+
+        attempt += 1
+        delay = RETRY_POLICY.delay(attempt - 1, retry_after)
+
+        if attempt >= RETRY_POLICY.max_attempts or time.monotonic() + delay >= deadline:
+            raise error
+
+        logger.info(f'Retrying OpenRouter request to {payload["model"]} in {delay:.2f} s ({error}).')
+        _sleep(delay)
+
+
+def chat_once(messages: List[Dict],
+              *,
+              model: str,
+              temperature: float = 0.2,
+              max_tokens: int = 400,
+              timeout_s: int = 30
+) -> Tuple[str, int]:
     payload = {
         "model": model,
         "messages": messages,
@@ -58,23 +249,174 @@ def chat_once(messages: List[Dict],
 
     t0 = time.perf_counter()
 
-    request = requests.post(
-        OPENROUTER_API_URL,
-        json=payload,
-        headers=headers,
-        timeout=timeout_s
-    )
+    request = _post(payload, timeout_s=timeout_s)
 
     dt_ms = int((time.perf_counter() - t0) * 1000)
 
-    if request.status_code // 100 != 2:
-        raise OpenRouterError(request.status_code, _friendly(request.status_code))
-
     try:
         data = request.json()
         text = data["choices"][0]["message"]["content"]
 
     except Exception:
+        telemetry.record(model, dt_ms, 500)
         raise OpenRouterError(500, "Неожиданная структура ответа OpenRouter.")
 
+    telemetry.record(model, dt_ms, request.status_code, data.get("usage"))
+    token_budget.calibrate(model, messages, (data.get("usage") or {}).get("prompt_tokens"))
+
     return text, dt_ms
+
+
+def chat_stream(messages: List[Dict],
+                *,
+                model: str,
+                temperature: float = 0.2,
+                max_tokens: int = 400,
+                timeout_s: int = 30
+) -> Iterator[str]:
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True,
+        "usage": {"include": True},
+    }
+    usage = None
+    t0 = time.perf_counter()
+
+    # Only the connection phase is retried, a stream that broke halfway is reported as is
+    with _post(payload, timeout_s=timeout_s, stream=True) as request:
+        try:
+            # Server-sent events: "data: {...}" chunks, ": comment" keep-alives, "data: [DONE]" at the end
+            for raw_line in request.iter_lines():
+                line = raw_line.decode('utf-8')
+
+                if not line.startswith('data:'):
+                    continue
+
+                data = line[len('data:'):].strip()
+
+                if data == '[DONE]':
+                    break
+
+                try:
+                    chunk = json.loads(data)
+
+                except ValueError:
+                    raise OpenRouterError(500, "Неожиданная структура ответа OpenRouter.")
+
+                if 'error' in chunk:
+                    status = chunk['error'].get('code', 500) if isinstance(chunk['error'], dict) else 500
+                    status = status if isinstance(status, int) else 500
+                    telemetry.record(model, int((time.perf_counter() - t0) * 1000), status)
+                    raise OpenRouterError(status, _friendly(status))
+
+                # The final chunk carries token usage and may have no choices
+                usage = chunk.get('usage') or usage
+
+                if not chunk.get('choices'):
+                    continue
+
+                try:
+                    delta = chunk["choices"][0]["delta"].get("content")
+
+                except (KeyError, IndexError, AttributeError):
+                    raise OpenRouterError(500, "Неожиданная структура ответа OpenRouter.")
+
+                if delta:
+                    yield delta
+
+        # A stream that breaks halfway counts like a failed connection: telemetry, breaker and 504
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            get_breaker(model).failure()
+            telemetry.record(model, int((time.perf_counter() - t0) * 1000), 0)
+            logger.warning(f'OpenRouter stream from {model} broke: {e}')
+            raise OpenRouterError(504, _friendly(504))
+
+    telemetry.record(model, int((time.perf_counter() - t0) * 1000), request.status_code, usage)
+    token_budget.calibrate(model, messages, (usage or {}).get('prompt_tokens'))
+
+
+def _close_losers(results: queue.Queue, count: int, timeout_s: float):
+    # Losing attempts report their first chunk later; close their streams so the connections are released
+    for _ in range(count):
+        try:
+            _, stream, _, _ = results.get(timeout=timeout_s)
+
+        except queue.Empty:
+            return
+
+        if stream is not None:
+            stream.close()
+
+
+def chat_stream_fallback(messages: List[Dict],
+                         *,
+                         models: List[str],
+                         hedge_after_s: float,
+                         temperature: float = 0.2,
+                         max_tokens: int = 400,
+                         timeout_s: int = 30
+) -> Tuple[str, Iterator[str]]:
+    # Tries models in order: the next one starts when the current one fails
+    # or has not produced its first chunk within hedge_after_s. The first model to answer wins.
+    results: queue.Queue = queue.Queue()
+    pending = list(models)
+    running = 0
+    error: Exception | None = None
+    deadline = time.monotonic() + timeout_s
+
+    def start(model: str):
+        stream = chat_stream(messages, model=model, temperature=temperature, max_tokens=max_tokens, timeout_s=timeout_s)
+
+        def run():
+            try:
+                results.put((model, stream, next(stream, ''), None))
+
+            except Exception as e:
+                results.put((model, None, None, e))
+
+        threading.Thread(target=run, name=f'llm-hedge-{model}', daemon=True).start()
+
+    start(pending.pop(0))
+    running += 1
+
+    while running:
+        remaining = deadline - time.monotonic()
+
+        try:
+            model, stream, first, e = results.get(timeout=max(0.0, min(hedge_after_s, remaining) if pending else remaining))
+
+        except queue.Empty:
+            if pending and remaining > 0:
+                logger.info(f'No answer within {hedge_after_s} s, hedging with {pending[0]}.')
+                start(pending.pop(0))
+                running += 1
+                continue
+
+            raise OpenRouterError(504, _friendly(504))
+
+        running -= 1
+
+        if e is not None:
+            error = e
+            logger.warning(f'Model {model} failed: {e}')
+
+            if pending:
+                start(pending.pop(0))
+                running += 1
+
+            continue
+
+        if running:
+            threading.Thread(
+                target=_close_losers, args=(results, running, timeout_s), name='llm-hedge-cleanup', daemon=True
+            ).start()
+
+        return model, itertools.chain([first] if first else [], stream)
+
+    if isinstance(error, OpenRouterError):
+        raise error
+
+    raise OpenRouterError(503, _friendly(503))
@@ -0,0 +1,59 @@
+from typing import Dict, List
+
+from config import logger
+import db
+
+# Bump when the template below changes: stored prompts compiled from an older template are rebuilt
+TEMPLATE_VERSION = 1
+
+# Providers behind OpenRouter that take explicit cache breakpoints; OpenAI-style models cache prefixes on their own
+CACHE_CONTROL_PREFIXES = ('anthropic/', 'google/gemini')
+
+
+def compile_system_prompt(character: dict) -> str:
+    return (
+        f'Ты отвечаешь строго в образе персонажа: {character["name"]}.\n'
+        f'{character["prompt"]}\n'
+        'Правила:\n'
+        '1. Всегда держи стиль и манеру речи выбранного персонажа. При необходимости - переформулируй.\n'
+        '2. Технические ответы давай корректно и по пунктам, но в характерной манере.\n'
+        '3. Не раскрывай, что ты "играешь роль".\n'
+        '4. Не используй длинные дословные цитаты из фильмов/книг (>10 слов).\n'
+        'Если стиль персонажа выражен слабо - переформулируй ответ и усиль характер персонажа, сохраняя фактическую точность.\n'
+    )
+
+
+def system_prompt(character: dict) -> str:
+    # Compiled once per character version and kept next to the characters row
+    if character.get('system_prompt') and character.get('system_prompt_template') == TEMPLATE_VERSION:
+        return character['system_prompt']
+
+    compiled = compile_system_prompt(character)
+
+    if 'prompt_version' in character:
+        try:
+            db.save_system_prompt(character['id'], character['prompt_version'], TEMPLATE_VERSION, compiled)
+
+        except Exception as e:
+            logger.error(f'Failed to store system prompt for character {character["id"]}: {e}')
+
+    return compiled
+
+
+def with_cache_marks(messages: List[Dict], model: str) -> List[Dict]:
+    # Marks the system message as the stable prefix for providers with explicit prompt caching
+    if not model.startswith(CACHE_CONTROL_PREFIXES):
+        return messages
+
+    marked = []
+
+    for message in messages:
+        if message['role'] == 'system' and isinstance(message['content'], str):
+            message = {
+                'role': 'system',
+                'content': [{'type': 'text', 'text': message['content'], 'cache_control': {'type': 'ephemeral'}}]
+            }
+
+        marked.append(message)
+
+    return marked
@@ -0,0 +1,98 @@
+import threading
+import time
+
+
+# Token bucket: `capacity` requests at once, refilled at rate_per_s
+class TokenBucket:
+    def __init__(self, rate_per_s: float, capacity: float):
+        self.rate_per_s = rate_per_s
+        self.capacity = capacity
+        self.tokens = capacity
+
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate_per_s)
+        self._updated_at = now
+
+    def try_acquire(self) -> float:
+        # 0 when a token was taken, otherwise seconds until the next one is available
+        with self._lock:
+            self._refill(time.monotonic())
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+
+            return (1 - self.tokens) / self.rate_per_s
+
+    def acquire(self, timeout_s: float = 0.0) -> bool:
+        deadline = time.monotonic() + timeout_s
+
+        while True:
+            wait = self.try_acquire()
+
+            if wait == 0:
+                return True
+
+            if time.monotonic() + wait > deadline:
+                return False
+
+            time.sleep(wait)
+
+    def refund(self):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class RateLimiter:
+    def __init__(self, per_key_rpm: float, per_model_rpm: float):
+        self.per_key_rpm = per_key_rpm
+        self.per_model_rpm = per_model_rpm
+
+        self._buckets: dict[tuple[str, str], TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, scope: str, name: str, rpm: float) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get((scope, name))
+
+            if bucket is None:
+                bucket = TokenBucket(rpm / 60, max(1.0, rpm / 6))
+                self._buckets[(scope, name)] = bucket
+
+            return bucket
+
+    def try_acquire(self, api_key: str, model: str) -> float:
+        # Non-blocking variant for the asyncio client: 0 when taken, otherwise seconds to wait
+        key_bucket = self._bucket('key', api_key, self.per_key_rpm) if self.per_key_rpm > 0 else None
+        model_bucket = self._bucket('model', model, self.per_model_rpm) if self.per_model_rpm > 0 else None
+        wait = key_bucket.try_acquire() if key_bucket else 0.0
+
+        if wait:
+            return wait
+
+        wait = model_bucket.try_acquire() if model_bucket else 0.0
+
+        if wait and key_bucket:
+            key_bucket.refund()
+
+        return wait
+
+    def acquire(self, api_key: str, model: str, timeout_s: float = 0.0) -> bool:
+        # Both the key-wide and the model bucket must have a token; rpm <= 0 disables a level
+        deadline = time.monotonic() + timeout_s
+        key_bucket = self._bucket('key', api_key, self.per_key_rpm) if self.per_key_rpm > 0 else None
+        model_bucket = self._bucket('model', model, self.per_model_rpm) if self.per_model_rpm > 0 else None
+
+        if key_bucket and not key_bucket.acquire(timeout_s):
+            return False
+
+        if model_bucket and not model_bucket.acquire(max(0.0, deadline - time.monotonic())):
+            if key_bucket:
+                key_bucket.refund()
+
+            return False
+
+        return True
@@ -0,0 +1,69 @@
+from dataclasses import dataclass
+from typing import Callable
+
+
+@dataclass(frozen=True)
+class Command:
+    name: str | None
+    # Everything after the command, then the same split once into the first word and the rest
+    text: str = ''
+    head: str = ''
+    tail: str = ''
+
+
+def parse(text: str) -> Command:
+    parts = text.split(maxsplit=1)
+
+    if not parts or not parts[0].startswith('/'):
+        return Command(None, text.strip())
+
+    # /cmd@bot_name in group chats
+    name = parts[0][1:].split('@', 1)[0]
+    rest = parts[1].strip() if len(parts) > 1 else ''
+    args = rest.split(maxsplit=1)
+
+    return Command(name, rest, args[0] if args else '', args[1].strip() if len(args) > 1 else '')
+
+
+# Dispatch tables: one dict lookup per update however many commands and buttons there are
+class Router:
+    def __init__(self):
+        self.commands: dict[str, Callable] = {}
+        self.buttons: dict[str, Callable] = {}
+        self.callbacks: dict[str, Callable] = {}
+
+    def _register(self, table: dict[str, Callable], keys: tuple[str, ...]) -> Callable:
+        def register(handler: Callable) -> Callable:
+            for key in keys:
+                if key in table:
+                    raise ValueError(f'Handler for {key} is already registered')
+
+                table[key] = handler
+
+            return handler
+
+        return register
+
+    def command(self, *names: str) -> Callable:
+        return self._register(self.commands, names)
+
+    def button(self, *texts: str) -> Callable:
+        return self._register(self.buttons, texts)
+
+    def callback(self, *prefixes: str) -> Callable:
+        # Callback data is "prefix:payload"
+        return self._register(self.callbacks, prefixes)
+
+    def resolve(self, text: str) -> tuple[Callable, Command] | None:
+        if text.startswith('/'):
+            command = parse(text)
+            handler = self.commands.get(command.name)
+
+        else:
+            command = Command(None, text)
+            handler = self.buttons.get(text)
+
+        return (handler, command) if handler is not None else None
+
+    def resolve_callback(self, data: str) -> Callable | None:
+        return self.callbacks.get(data.split(':', 1)[0])
@@ -0,0 +1,161 @@
+from collections import Counter, deque
+from dataclasses import dataclass
+import threading
+import time
+from typing import Callable
+
+from config import logger
+
+LATENCY_BUCKETS_MS = (250, 500, 1000, 2000, 5000, 10000, 30000)
+
+
+@dataclass
+class Sample:
+    at: float
+    latency_ms: int
+    status: int
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+# Rolling window of OpenRouter calls per model
+class ModelTelemetry:
+    def __init__(self, window_s: float = 3600.0, max_samples: int = 1000):
+        self.window_s = window_s
+        self.max_samples = max_samples
+
+        self._samples: dict[str, deque[Sample]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, latency_ms: int, status: int, usage: dict | None = None):
+        usage = usage or {}
+        sample = Sample(
+            time.time(),
+            latency_ms,
+            status,
+            int(usage.get('prompt_tokens') or 0),
+            int(usage.get('completion_tokens') or 0)
+        )
+
+        with self._lock:
+            samples = self._samples.setdefault(model, deque(maxlen=self.max_samples))
+            samples.append(sample)
+
+    def _recent(self, model: str) -> list[Sample]:
+        cutoff = time.time() - self.window_s
+        samples = self._samples.get(model, ())
+
+        return [sample for sample in samples if sample.at >= cutoff]
+
+    def summary(self, model: str) -> dict:
+        with self._lock:
+            samples = self._recent(model)
+
+        ok = sorted(sample.latency_ms for sample in samples if sample.status // 100 == 2)
+        errors = sum(1 for sample in samples if sample.status // 100 != 2)
+        histogram = Counter()
+
+        for latency in ok:
+            bound = next((bound for bound in LATENCY_BUCKETS_MS if latency <= bound), None)
+            histogram[f'<={bound}' if bound else f'>{LATENCY_BUCKETS_MS[-1]}'] += 1
+
+        return {
+            'model': model,
+            'requests': len(samples),
+            'errors': errors,
+            'error_rate': errors / len(samples) if samples else 0.0,
+            'p50_ms': _percentile(ok, 50),
+            'p95_ms': _percentile(ok, 95),
+            'p99_ms': _percentile(ok, 99),
+            'prompt_tokens': sum(sample.prompt_tokens for sample in samples),
+            'completion_tokens': sum(sample.completion_tokens for sample in samples),
+            'statuses': dict(Counter(sample.status for sample in samples)),
+            'histogram': dict(histogram)
+        }
+
+    def percentile(self, model: str, percent: int, min_samples: int = 1) -> int | None:
+        # Successful calls only; None until there are min_samples of them
+        with self._lock:
+            ok = sorted(sample.latency_ms for sample in self._recent(model) if sample.status // 100 == 2)
+
+        return _percentile(ok, percent) if len(ok) >= max(min_samples, 1) else None
+
+    def summaries(self) -> list[dict]:
+        with self._lock:
+            models = list(self._samples)
+
+        return [summary for summary in map(self.summary, models) if summary['requests']]
+
+    def best_model(self, candidates: list[str], min_samples: int = 5, max_error_rate: float = 0.5) -> str | None:
+        # Lowest recent p50 weighted by error rate; models without enough data are not ranked
+        ranked = []
+
+        for model in candidates:
+            summary = self.summary(model)
+
+            if summary['requests'] < min_samples or summary['error_rate'] > max_error_rate:
+                continue
+
+            if summary['p50_ms'] is None:
+                continue
+
+            ranked.append((summary['p50_ms'] * (1 + summary['error_rate']), model))
+
+        return min(ranked)[1] if ranked else None
+
+
+def _percentile(values: list[int], percent: int) -> int | None:
+    if not values:
+        return None
+
+    index = min(len(values) - 1, round(percent / 100 * (len(values) - 1)))
+
+    return values[index]
+
+
+telemetry = ModelTelemetry()
+
+_persist_stop = threading.Event()
+_persist_thread: threading.Thread | None = None
+
+
+def start_persisting(save: Callable[[list[dict]], None], interval_s: float):
+    global _persist_thread
+
+    if interval_s <= 0 or _persist_thread is not None:
+        return
+
+    _persist_stop.clear()
+
+    def run():
+        while not _persist_stop.wait(interval_s):
+            persist(save)
+
+    _persist_thread = threading.Thread(target=run, name='telemetry-persist', daemon=True)
+    _persist_thread.start()
+
+
+def stop_persisting(save: Callable[[list[dict]], None] | None = None):
+    global _persist_thread
+
+    _persist_stop.set()
+
+    if _persist_thread is not None:
+        _persist_thread.join()
+        _persist_thread = None
+
+    if save is not None:
+        persist(save)
+
+
+def persist(save: Callable[[list[dict]], None]):
+    summaries = telemetry.summaries()
+
+    if not summaries:
+        return
+
+    try:
+        save(summaries)
+
+    except Exception as e:
+        logger.error(f'Failed to persist model telemetry: {e}')
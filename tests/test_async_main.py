@@ -0,0 +1,131 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+
+@pytest.fixture()
+def async_main(main_module, monkeypatch):
+    import async_main
+
+    main_module.llm_cache.clear()
+    monkeypatch.setattr(async_main, 'bot', AsyncMock())
+    monkeypatch.setattr(main_module, 'STREAM_EDIT_INTERVAL_S', 0)
+
+    return async_main
+
+
+def _stream(*deltas, delay=0.0, closed=None):
+    async def stream(messages, *, model, **kwargs):
+        try:
+            for delta in deltas:
+                await asyncio.sleep(delay)
+                yield delta
+
+        finally:
+            if closed is not None:
+                closed.append(model)
+
+    return stream
+
+
+def test_async_reply_streams_and_caches(async_main, monkeypatch):
+    monkeypatch.setattr(async_main.openrouter_async, 'chat_stream', _stream('Пер', 'вый ', 'ответ'))
+    llm_message = [{'role': 'user', 'content': 'Асинхронный вопрос'}]
+
+    asyncio.run(async_main._reply_streaming(MagicMock(), llm_message, 'm:free'))
+
+    edits = [call.args[0] for call in async_main.bot.edit_message_text.call_args_list]
+    assert edits == ['Пер', 'Первый', 'Первый ответ']
+
+    monkeypatch.setattr(async_main.openrouter_async, 'chat_stream', MagicMock(side_effect=AssertionError('cache miss')))
+    asyncio.run(async_main._reply_streaming(MagicMock(), llm_message, 'm:free'))
+
+    assert async_main.bot.reply_to.call_args.args[1] == 'Первый ответ'
+
+
+def test_async_follower_follows_threaded_leader(async_main, main_module, monkeypatch):
+    monkeypatch.setattr(async_main, 'FOLLOW_POLL_S', 0.001)
+    monkeypatch.setattr(async_main.openrouter_async, 'chat_stream', MagicMock(side_effect=AssertionError('duplicate call')))
+    llm_message = [{'role': 'user', 'content': 'Общий вопрос'}]
+    budget = main_module._budget(llm_message, ['m:free'])
+    key = main_module.llm_cache.cache_key(budget.messages, 'm:free', main_module.LLM_TEMPERATURE, budget.max_tokens)
+    flight, _ = main_module.llm_cache.inflight.join(key)
+
+    async def run():
+        follower = asyncio.create_task(async_main._reply_streaming(MagicMock(), llm_message, 'm:free'))
+
+        while not async_main.bot.reply_to.called:
+            await asyncio.sleep(0.001)
+
+        flight.publish('Общий')
+
+        while not async_main.bot.edit_message_text.called:
+            await asyncio.sleep(0.001)
+
+        main_module.llm_cache.inflight.resolve(key, 'Общий ответ')
+        await asyncio.wait_for(follower, 1)
+
+    asyncio.run(run())
+
+    assert async_main.bot.reply_to.call_args.args[1] == main_module.STREAM_PLACEHOLDER
+    edits = [call.args[0] for call in async_main.bot.edit_message_text.call_args_list]
+    assert edits == ['Общий', 'Общий ответ']
+
+
+def test_async_fallback_hedges_and_closes_loser(monkeypatch):
+    import openrouter_async
+
+    closed = []
+    streams = {'slow:free': _stream('медленно', delay=0.5, closed=closed), 'fast:free': _stream('быстро', closed=closed)}
+    monkeypatch.setattr(openrouter_async, 'chat_stream', lambda messages, *, model, **kwargs: streams[model](messages, model=model))
+
+    async def run():
+        model, stream = await openrouter_async.chat_stream_fallback(
+            [{'role': 'user', 'content': 'q'}], models=['slow:free', 'fast:free'], hedge_after_s=0.05
+        )
+
+        return model, [delta async for delta in stream]
+
+    assert asyncio.run(run()) == ('fast:free', ['быстро'])
+    assert 'slow:free' in closed
+
+
+def test_async_fallback_moves_on_after_failure(monkeypatch):
+    import openrouter_async
+
+    async def failing(messages, *, model, **kwargs):
+        raise openrouter_async.OpenRouterError(503, 'Сервис недоступен')
+        yield
+
+    streams = {'bad:free': failing, 'good:free': _stream('ответ')}
+    monkeypatch.setattr(openrouter_async, 'chat_stream', lambda messages, *, model, **kwargs: streams[model](messages, model=model))
+
+    async def run():
+        model, stream = await openrouter_async.chat_stream_fallback(
+            [{'role': 'user', 'content': 'q'}], models=['bad:free', 'good:free'], hedge_after_s=5
+        )
+
+        return model, [delta async for delta in stream]
+
+    assert asyncio.run(run()) == ('good:free', ['ответ'])
+
+
+def test_other_commands_go_to_threaded_handlers(async_main, main_module, monkeypatch):
+    process = MagicMock()
+    monkeypatch.setattr(main_module.bot, 'process_new_messages', process)
+    message = MagicMock(text='/list_notes')
+
+    asyncio.run(async_main.dispatch(message))
+
+    process.assert_called_once_with([message])
+
+
+def test_llm_commands_stay_on_the_event_loop(async_main, main_module, monkeypatch):
+    process = MagicMock()
+    monkeypatch.setattr(main_module.bot, 'process_new_messages', process)
+
+    asyncio.run(async_main.dispatch(MagicMock(text='/ask')))
+
+    assert not process.called
+    assert async_main.bot.reply_to.call_args.args[1].startswith('Отсутствует текст вопроса')
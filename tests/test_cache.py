@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from cache import Broadcast, SingleFlight, TTLCache
+
+
+def test_ttl_cache_counts_hits_and_misses():
+    cache = TTLCache(maxsize=10, ttl_s=60)
+
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['size']) == (1, 1, 1)
+    assert stats['hit_rate'] == 0.5
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl_s=60)
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(maxsize=10, ttl_s=0.01)
+
+    cache.set('a', 1)
+    time.sleep(0.02)
+
+    assert cache.get('a', 'missing') == 'missing'
+    assert len(cache) == 0
+
+
+def test_single_flight_shares_result_and_error():
+    flight = SingleFlight()
+
+    future, leader = flight.join('k')
+    follower, follower_leader = flight.join('k')
+    assert (leader, follower_leader) == (True, False)
+    assert follower is future
+
+    flight.resolve('k', 'ответ')
+    assert follower.result() == 'ответ'
+    assert flight.join('k')[1] is True
+
+    flight.resolve('k', error=ValueError('boom'))
+    assert flight.coalesced == 1
+
+    def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        flight.do('other', fail)
+
+    assert flight.join('other')[1] is True
+
+
+def test_broadcast_followers_see_partials_and_result():
+    flight = SingleFlight(Broadcast)
+    future, _ = flight.join('k')
+    follower, _ = flight.join('k')
+    seen = []
+
+    def follow():
+        partial = ''
+
+        while not follower.done():
+            partial = follower.follow(partial, timeout=1)
+            seen.append(partial)
+
+    thread = threading.Thread(target=follow)
+    thread.start()
+    future.publish('Час')
+    time.sleep(0.05)
+    future.publish('Частичный')
+    time.sleep(0.05)
+    flight.resolve('k', 'Частичный ответ')
+    thread.join(1)
+
+    assert not thread.is_alive()
+    assert seen[:2] == ['Час', 'Частичный']
+    assert follower.result() == 'Частичный ответ'
@@ -75,3 +75,218 @@ def test_set_user_character_rejects_unknown_id(db_module):
         db.set_user_character(uid, unknown_id)
 
     assert 'Неизвестный ID персонажа' in str(excinfo.value)
+
+
+def test_connect_reuses_connection_per_thread(db_module):
+    import threading
+
+    db = db_module
+
+    assert db._connect() is db._connect()
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(db._connect()))
+    thread.start()
+    thread.join()
+    assert other[0] is not db._connect()
+
+    db.close_connections()
+    conn = db._connect()
+    assert conn.execute('SELECT 1').fetchone()[0] == 1
+
+
+def test_find_note_is_case_insensitive_for_cyrillic(db_module):
+    db = db_module
+
+    uid = 880001
+    bread_id = db.add_note(uid, 'Купить Хлеб')
+    db.add_note(uid, 'Купить молоко')
+    db.add_note(880002, 'Хлеб другого пользователя')
+
+    found = db.find_note(uid, 'хлеб')
+    assert [note['id'] for note in found] == [bread_id]
+    assert db.count_notes(uid, 'КУПИТЬ') == 2
+    assert db.count_notes(uid, 'хл') == 1
+
+    db.update_note(uid, bread_id, 'Купить батон')
+    assert db.count_notes(uid, 'хлеб') == 0
+    assert db.count_notes(uid, 'батон') == 1
+
+    db.delete_note(uid, bread_id)
+    assert db.find_note(uid, 'батон') == []
+
+
+def test_fts_search_runs_match_once(db_module):
+    db = db_module
+
+    uid = 880051
+    for i in range(5):
+        db.add_note(uid, f'Купить хлеб {i}')
+
+    conn = db._connect()
+    statements = []
+    conn.set_trace_callback(statements.append)
+
+    try:
+        db.find_note_page(uid, 'хлеб', 2, before_id=10 ** 9)
+        assert db.count_notes(uid, 'хлеб') == 5
+
+    finally:
+        conn.set_trace_callback(None)
+
+    selects = [sql for sql in statements if 'notes_fts MATCH' in sql]
+    assert len(selects) == 2
+
+    for sql in selects:
+        plan = {row[0]: (row[1], row[3]) for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)}
+        scans = [(parent, detail) for parent, detail in plan.values() if 'notes_fts' in detail]
+
+        # The FTS scan belongs to a one-off LIST SUBQUERY, not to a loop over the user's notes
+        assert scans
+        assert all(parent in plan and 'LIST SUBQUERY' in plan[parent][1] for parent, _ in scans)
+
+
+def test_list_notes_keyset_pagination(db_module):
+    db = db_module
+
+    uid = 880101
+    ids = [db.add_note(uid, f'Заметка {i}') for i in range(25)]
+
+    first = db.list_notes(uid, 10)
+    assert [note['id'] for note in first] == ids[::-1][:10]
+
+    second = db.list_notes(uid, 10, before_id=first[-1]['id'])
+    assert [note['id'] for note in second] == ids[::-1][10:20]
+
+    back = db.list_notes(uid, 10, after_id=second[0]['id'])
+    assert [note['id'] for note in back] == [note['id'] for note in first]
+
+    found = db.find_note(uid, 'заметка', 10, before_id=second[-1]['id'])
+    assert [note['id'] for note in found] == ids[::-1][20:]
+
+
+def test_notes_page_returns_rows_and_total(db_module):
+    db = db_module
+
+    uid = 880201
+    for i in range(15):
+        db.add_note(uid, f'Покупка {i}' if i % 3 else f'Задача {i}')
+
+    notes, total = db.list_notes_page(uid)
+    assert len(notes) == 10
+    assert total == 15
+
+    notes, total = db.find_note_page(uid, 'ПОКУПКА', 4)
+    assert len(notes) == 4
+    assert total == db.count_notes(uid, 'покупка') == 10
+
+    assert db.find_note_page(uid, 'отсутствует') == ([], 0)
+
+
+def test_cursor_pages_fetch_one_extra_row_instead_of_counting(db_module):
+    db = db_module
+
+    uid = 880251
+    ids = [db.add_note(uid, f'Покупка {i}') for i in range(25)]
+
+    notes, remaining = db.list_notes_page(uid, 10, before_id=ids[15])
+    assert [note['id'] for note in notes] == ids[14:4:-1]
+    assert remaining == 11
+
+    notes, remaining = db.list_notes_page(uid, 10, before_id=ids[5])
+    assert [note['id'] for note in notes] == ids[4::-1]
+    assert remaining == 5
+
+    notes, remaining = db.find_note_page(uid, 'покупка', 10, after_id=ids[2])
+    assert [note['id'] for note in notes] == ids[12:2:-1]
+    assert remaining == 11
+
+    notes, remaining = db.find_note_page(uid, 'покупка', 10, after_id=ids[20])
+    assert [note['id'] for note in notes] == ids[:20:-1]
+    assert remaining == 4
+
+
+def test_note_stats_follow_inserts_and_deletes(db_module):
+    db = db_module
+
+    uid = 880301
+    assert db.count_notes(uid) == 0
+
+    first = db.add_note(uid, 'Первая')
+    last = db.add_note(uid, 'Вторая')
+    assert db.count_notes(uid) == 2
+
+    db.delete_note(uid, last)
+    assert db.count_notes(uid) == 1
+
+    with db._connect() as conn:
+        row = conn.execute(
+            'SELECT count, last_note_id FROM note_stats WHERE user_id = ?',
+            (uid,)
+        ).fetchone()
+    assert (row['count'], row['last_note_id']) == (1, first)
+
+
+def test_get_active_model_is_served_from_snapshot(db_module):
+    db = db_module
+
+    with db._connect() as conn:
+        conn.execute('DELETE FROM models WHERE id IN (900001, 900002)')
+        conn.execute("INSERT INTO models(id, key, label) VALUES (900001, 'a/one:free', 'One'), (900002, 'a/two:free', 'Two')")
+
+    db.set_active_model(900001)
+    assert db.get_active_model()['id'] == 900001
+
+    with db._connect() as conn:
+        conn.execute('UPDATE models SET active = 0 WHERE id = 900001')
+        conn.execute('UPDATE models SET active = 1 WHERE id = 900002')
+
+    assert db.get_active_model()['id'] == 900001
+
+    db.invalidate_active_model()
+    assert db.get_active_model()['id'] == 900002
+
+    assert db.set_active_model(900001)['id'] == 900001
+    assert db.get_active_model()['id'] == 900001
+
+
+def test_character_cache_invalidated_on_rename(db_module):
+    db = db_module
+
+    with db._connect() as conn:
+        conn.execute('DELETE FROM user_character WHERE character_id = 900101')
+        conn.execute('DELETE FROM characters WHERE id = 900101')
+        conn.execute("INSERT INTO characters(id, name, prompt) VALUES (900101, 'Кэш', 'Проверка кэша')")
+    db._characters_cache.clear()
+
+    uid = 880401
+    assert db.set_user_character(uid, 900101)['name'] == 'Кэш'
+
+    hits = db.character_cache_stats()['user_character']['hits']
+    assert db.get_user_character(uid)['id'] == 900101
+    assert db.character_cache_stats()['user_character']['hits'] == hits + 1
+
+    assert db.update_character_name_by_id(900101, 'Новое имя')
+    assert db.get_user_character(uid)['name'] == 'Новое имя'
+    assert db.get_character_by_id(900101)['name'] == 'Новое имя'
+
+
+def test_note_writes_go_through_write_behind_queue(db_module):
+    db = db_module
+
+    uid = 880501
+    db.start_write_behind()
+
+    try:
+        futures = [db.add_note_async(uid, f'Пакет {i}') for i in range(10)]
+        ids = [future.result(timeout=5) for future in futures]
+        assert len(set(ids)) == 10
+
+        assert db.update_note(uid, ids[0], 'Изменено')
+        assert db.delete_note(uid, ids[1])
+
+    finally:
+        db.stop_write_behind()
+
+    assert db.count_notes(uid) == 9
+    assert db.count_notes(uid, 'изменено') == 1
@@ -0,0 +1,71 @@
+import threading
+import time
+from unittest.mock import MagicMock
+
+from dispatcher import LaneTeleBot, SerialDispatcher, chat_key
+
+
+def test_serial_dispatcher_keeps_order_per_key():
+    dispatcher = SerialDispatcher(workers=4, name='test')
+    seen = {1: [], 2: []}
+
+    def task(key, index):
+        time.sleep(0.001)
+        seen[key].append(index)
+
+    for index in range(20):
+        dispatcher.submit(1, task, 1, index)
+        dispatcher.submit(2, task, 2, index)
+
+    dispatcher.close()
+
+    assert seen == {1: list(range(20)), 2: list(range(20))}
+
+
+def test_serial_dispatcher_runs_other_keys_while_one_is_busy():
+    dispatcher = SerialDispatcher(workers=2, name='test')
+    release = threading.Event()
+    done = threading.Event()
+
+    dispatcher.submit('slow', release.wait, 5)
+    dispatcher.submit('fast', done.set)
+
+    assert done.wait(1)
+    release.set()
+    dispatcher.close()
+
+
+def test_serial_dispatcher_returns_task_futures():
+    dispatcher = SerialDispatcher(workers=1, name='test')
+
+    ok = dispatcher.submit(1, lambda: 'done')
+    failed = dispatcher.submit(1, lambda: 1 / 0)
+
+    assert ok.result(1) == 'done'
+    assert isinstance(failed.exception(1), ZeroDivisionError)
+    dispatcher.close()
+
+
+def test_lane_bot_routes_slow_commands_to_their_own_lane():
+    bot = LaneTeleBot(
+        '123:test',
+        lanes={'fast': 1, 'slow': 1},
+        lane_of=lambda update: 'slow' if update.text == '/ask' else 'fast'
+    )
+    release = threading.Event()
+    done = threading.Event()
+    slow, fast = MagicMock(text='/ask'), MagicMock(text='/list_notes')
+    slow.chat.id, fast.chat.id = 1, 2
+
+    bot._exec_task(lambda message: release.wait(5), slow)
+    bot._exec_task(lambda message: done.set(), fast)
+
+    assert done.wait(1)
+    release.set()
+    bot.close_lanes()
+
+
+def test_chat_key_falls_back_for_updates_without_chat():
+    assert chat_key(MagicMock(chat=MagicMock(id=5))) == 5
+    assert chat_key(MagicMock(spec=['from_user'], from_user=MagicMock(id=9))) == 9
+    assert chat_key([1, 2]) is None
@@ -0,0 +1,91 @@
+import pytest
+
+
+@pytest.fixture()
+def llm_cache(db_module, monkeypatch):
+    import llm_cache
+
+    llm_cache.clear()
+    return llm_cache
+
+
+def test_claim_serves_settled_answer_from_cache(llm_cache):
+    key = llm_cache.cache_key([{'role': 'user', 'content': 'Что такое кэш?'}], 'm:free', 0.7, 100)
+    before = llm_cache.stats()
+
+    cached, flight, leader = llm_cache.claim(key)
+    assert cached is None and leader
+
+    llm_cache.settle(key, 'Ответ', key=key, model='m:free', dt_ms=120)
+
+    assert llm_cache.claim(key) == ('Ответ', None, False)
+
+    # A bypassed call leads a fresh flight despite the cached answer
+    cached, flight, leader = llm_cache.claim(key, bypass=True)
+    assert cached is None and leader
+    llm_cache.settle(key, 'Новый ответ', key=key, model='m:free', dt_ms=100)
+    assert llm_cache.claim(key)[0] == 'Новый ответ'
+
+    after = llm_cache.stats()
+    assert after['hits'] - before['hits'] == 2
+    assert after['saved_ms'] - before['saved_ms'] == 220
+
+
+def test_claim_followers_share_the_leader_answer(llm_cache):
+    key = llm_cache.cache_key([{'role': 'user', 'content': 'Одновременный вопрос'}], 'm:free', 0.7, 100)
+
+    _, flight, leader = llm_cache.claim(key)
+    followers = [llm_cache.claim(key) for _ in range(3)]
+
+    assert leader
+    assert all(not follower_leader and follower is flight for _, follower, follower_leader in followers)
+
+    llm_cache.settle(key, 'Ответ', key=key, model='m:free', dt_ms=100)
+
+    assert flight.result(timeout=1) == 'Ответ'
+
+
+def test_settle_error_reaches_followers_and_is_not_cached(llm_cache):
+    key = llm_cache.cache_key([{'role': 'user', 'content': 'Вопрос с ошибкой'}], 'm:free', 0.7, 100)
+    _, flight, _ = llm_cache.claim(key)
+    _, follower, _ = llm_cache.claim(key)
+
+    llm_cache.settle(key, error=RuntimeError('boom'), key=key, model='m:free')
+
+    with pytest.raises(RuntimeError, match='boom'):
+        follower.result(timeout=1)
+
+    assert llm_cache.lookup(key) is None
+
+
+def test_settle_without_key_is_not_cached(llm_cache):
+    key = llm_cache.cache_key([{'role': 'user', 'content': 'Пустой ответ'}], 'm:free', 0.7, 100)
+    _, flight, _ = llm_cache.claim(key)
+
+    llm_cache.settle(key, 'Модель вернула пустой ответ')
+
+    assert flight.result(timeout=1) == 'Модель вернула пустой ответ'
+    assert llm_cache.lookup(key) is None
+
+
+def test_persistent_tier_survives_memory_clear(llm_cache, monkeypatch):
+    monkeypatch.setattr(llm_cache.config, 'llm_cache_persist', True)
+    key = llm_cache.cache_key([{'role': 'user', 'content': 'x'}], 'm:free', 0.2, 400)
+
+    llm_cache.store(key, 'm:free', 'Сохранено', 50)
+    llm_cache.clear()
+
+    assert llm_cache.lookup(key) == 'Сохранено'
+
+
+def test_persistent_tier_is_size_bounded(db_module):
+    db = db_module
+
+    for i in range(5):
+        db.put_llm_response(f'bound-{i}', 'm:free', 'x', 1, 1000.0 + i, 3600, 3)
+
+    assert db.get_llm_response('bound-0', 1000.0) is None
+    assert db.get_llm_response('bound-4', 1000.0) == ('x', 1)
+
+    with db._connect() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0] == 3
@@ -1,5 +1,11 @@
+import threading
+import time
 from unittest.mock import MagicMock
 
+import telebot
+
+from cache import Broadcast
+
 
 def test_parse_number_integers(main_module):
     assert main_module._parse_number("1 2 3") == [1, 2, 3]
@@ -90,4 +96,277 @@ def test_max_process_logging(main_module, monkeypatch):
 
     assert mock_logger.debug.called
     args, _ = mock_logger.debug.call_args
-    assert "Maximum numbers" in args[0]
\ No newline at end of file
+    assert "Maximum numbers" in args[0]
+
+def test_reply_streaming_throttles_edits(main_module, monkeypatch):
+    main_module.llm_cache.clear()
+    bot = MagicMock()
+    monkeypatch.setattr(main_module, 'bot', bot)
+    monkeypatch.setattr(main_module, 'STREAM_EDIT_INTERVAL_S', 0)
+    monkeypatch.setattr(main_module, 'chat_stream', lambda *args, **kwargs: iter(['Пер', 'вый ', 'ответ']))
+
+    main_module._reply_streaming(MagicMock(), [{'role': 'user', 'content': 'q'}], 'm:free')
+
+    bot.reply_to.assert_called_once()
+    edits = [call.args[0] for call in bot.edit_message_text.call_args_list]
+    assert edits == ['Пер', 'Первый', 'Первый ответ']
+
+
+def test_reply_streaming_reports_openrouter_error(main_module, monkeypatch):
+    main_module.llm_cache.clear()
+    bot = MagicMock()
+    monkeypatch.setattr(main_module, 'bot', bot)
+
+    def failing_stream(*args, **kwargs):
+        raise main_module.OpenRouterError(503, 'Сервис недоступен')
+        yield
+
+    monkeypatch.setattr(main_module, 'chat_stream', failing_stream)
+
+    main_module._reply_streaming(MagicMock(), [{'role': 'user', 'content': 'q'}], 'm:free')
+
+    assert bot.edit_message_text.call_args.args[0] == 'Ошибка: [503] Сервис недоступен'
+
+
+def test_reply_streaming_answers_from_cache(main_module, monkeypatch):
+    main_module.llm_cache.clear()
+    bot = MagicMock()
+    monkeypatch.setattr(main_module, 'bot', bot)
+    monkeypatch.setattr(main_module, 'chat_stream', lambda *args, **kwargs: iter(['Ответ']))
+    llm_message = [{'role': 'user', 'content': 'Повтор'}]
+
+    main_module._reply_streaming(MagicMock(), llm_message, 'm:free')
+    monkeypatch.setattr(main_module, 'chat_stream', MagicMock(side_effect=AssertionError('cache miss')))
+    main_module._reply_streaming(MagicMock(), llm_message, 'm:free')
+
+    assert bot.reply_to.call_args.args[1] == 'Ответ'
+
+
+def test_ask_with_fresh_prefix_bypasses_cache(main_module, monkeypatch):
+    main_module.llm_cache.clear()
+    bot = MagicMock()
+    monkeypatch.setattr(main_module, 'bot', bot)
+    monkeypatch.setattr(main_module, '_build_messages', lambda user_id, text: [{'role': 'user', 'content': text}])
+    monkeypatch.setattr(main_module, '_pick_model', lambda: 'm:free')
+    monkeypatch.setattr(main_module, '_fallback_models', lambda model_key: [])
+    monkeypatch.setattr(main_module, 'chat_stream', lambda *args, **kwargs: iter(['Старый']))
+
+    main_module.dispatch(MagicMock(text='/ask Ещё раз'))
+    monkeypatch.setattr(main_module, 'chat_stream', lambda *args, **kwargs: iter(['Новый']))
+
+    main_module.dispatch(MagicMock(text='/ask Ещё раз'))
+    assert bot.reply_to.call_args.args[1] == 'Старый'
+
+    main_module.dispatch(MagicMock(text='/ask !Ещё раз'))
+    assert bot.edit_message_text.call_args.args[0] == 'Новый'
+
+    # The fresh answer replaced the cached one
+    main_module.dispatch(MagicMock(text='/ask Ещё раз'))
+    assert bot.reply_to.call_args.args[1] == 'Новый'
+
+
+def _lead(main_module, text):
+    llm_message = [{'role': 'user', 'content': text}]
+    budget = main_module._budget(llm_message, ['m:free'])
+    key = main_module.llm_cache.cache_key(budget.messages, 'm:free', main_module.LLM_TEMPERATURE, budget.max_tokens)
+    flight, leader = main_module.llm_cache.inflight.join(key)
+    assert leader
+
+    return llm_message, key, flight
+
+
+def test_reply_streaming_follower_follows_leader(main_module, monkeypatch):
+    main_module.llm_cache.clear()
+    bot = MagicMock()
+    monkeypatch.setattr(main_module, 'bot', bot)
+    monkeypatch.setattr(main_module, 'STREAM_EDIT_INTERVAL_S', 0.01)
+    monkeypatch.setattr(main_module, 'chat_stream', MagicMock(side_effect=AssertionError('duplicate call')))
+
+    # A leader is already streaming the same question
+    llm_message, key, flight = _lead(main_module, 'Одновременно')
+    follower = threading.Thread(target=main_module._reply_streaming, args=(MagicMock(), llm_message, 'm:free'))
+    follower.start()
+
+    while not bot.reply_to.called:
+        time.sleep(0.001)
+
+    assert bot.reply_to.call_args.args[1] == main_module.STREAM_PLACEHOLDER
+
+    flight.publish('Общий')
+
+    while not bot.edit_message_text.called:
+        time.sleep(0.001)
+
+    main_module.llm_cache.inflight.resolve(key, 'Общий ответ')
+    follower.join(1)
+
+    assert not follower.is_alive()
+    edits = [call.args[0] for call in bot.edit_message_text.call_args_list]
+    assert edits == ['Общий', 'Общий ответ']
+
+
+def test_reply_streaming_follower_gives_up_on_stuck_leader(main_module, monkeypatch):
+    main_module.llm_cache.clear()
+    bot = MagicMock()
+    monkeypatch.setattr(main_module, 'bot', bot)
+    monkeypatch.setattr(main_module, 'FOLLOW_MAX_WAIT_S', 0.05)
+    llm_message, key, _ = _lead(main_module, 'Зависший вопрос')
+
+    main_module._reply_streaming(MagicMock(), llm_message, 'm:free')
+    main_module.llm_cache.inflight.resolve(key, error=RuntimeError('boom'))
+
+    assert bot.edit_message_text.call_args.args[0] == main_module.FOLLOW_TIMEOUT_TEXT
+
+
+def test_follower_does_not_reraise_leader_error(main_module, monkeypatch):
+    bot = MagicMock()
+    monkeypatch.setattr(main_module, 'bot', bot)
+    flight = Broadcast()
+    flight.set_exception(RuntimeError('reply_to failed'))
+
+    main_module._follow(MagicMock(), flight)
+
+    assert bot.edit_message_text.call_args.args[0] == 'Непредвиденная ошибка'
+
+
+def test_ask_compare_streams_models_concurrently(main_module, monkeypatch):
+    bot = MagicMock()
+    monkeypatch.setattr(main_module, 'bot', bot)
+    monkeypatch.setattr(main_module, '_build_messages', lambda user_id, text: [{'role': 'user', 'content': text}])
+    models = {1: {'key': 'a:free', 'label': 'A'}, 2: {'key': 'b:free', 'label': 'B'}}
+    monkeypatch.setattr(main_module, 'get_model_by_id', lambda id: models[id])
+
+    def slow_stream(messages, *, model, **kwargs):
+        time.sleep(0.2)
+        yield f'Ответ {model}'
+
+    monkeypatch.setattr(main_module, 'chat_stream', slow_stream)
+    message = MagicMock()
+    message.text = '/ask_compare 1,2 Вопрос'
+
+    t0 = time.perf_counter()
+    main_module.dispatch(message)
+
+    assert time.perf_counter() - t0 < 0.35
+    finals = sorted(call.args[0] for call in bot.edit_message_text.call_args_list)
+    assert finals[0].startswith('A (') and finals[0].endswith('мс):\nОтвет a:free')
+    assert finals[1].startswith('B (') and finals[1].endswith('мс):\nОтвет b:free')
+
+
+def test_ask_compare_validates_ids(main_module, monkeypatch):
+    bot = MagicMock()
+    monkeypatch.setattr(main_module, 'bot', bot)
+    message = MagicMock()
+
+    message.text = '/ask_compare 1 Вопрос'
+    main_module.dispatch(message)
+    assert bot.reply_to.call_args.args[1].startswith('Для сравнения укажите от 2')
+
+    message.text = '/ask_compare 1,x Вопрос'
+    main_module.dispatch(message)
+    assert bot.reply_to.call_args.args[1].startswith('ID не является числом')
+
+    # The same model written twice is still one model
+    message.text = '/ask_compare 1,01 Вопрос'
+    main_module.dispatch(message)
+    assert bot.reply_to.call_args.args[1].startswith('Для сравнения укажите от 2')
+
+
+def test_parse_helpers_shared_with_async_handlers(main_module):
+    parse = main_module.parse
+
+    assert main_module.parse_ask(parse('/ask !Вопрос')) == (None, 'Вопрос', True)
+    assert main_module.parse_ask(parse('/ask'))[0].startswith('Отсутствует текст вопроса')
+    assert main_module.parse_ask_model(parse('/ask_model 2 Вопрос')) == (None, 2, 'Вопрос', False)
+    assert main_module.parse_ask_model(parse('/ask_model x Вопрос'))[0].startswith('ID не является числом')
+    assert main_module.parse_compare(parse('/ask_compare 2,1,02 Вопрос')) == (None, [2, 1])
+    assert main_module.parse_compare(parse('/ask_compare 1,01 Вопрос'))[0].startswith('Для сравнения укажите')
+
+
+def test_lane_sends_llm_and_weather_commands_to_slow_lane(main_module):
+    assert main_module._lane(MagicMock(text='/ask Вопрос')) == 'slow'
+    assert main_module._lane(MagicMock(text='/ask_model@bot 1 Вопрос')) == 'slow'
+    assert main_module._lane(MagicMock(text='Погода')) == 'slow'
+    assert main_module._lane(MagicMock(text='/list_notes')) == 'fast'
+    assert main_module._lane(MagicMock(spec=['data'])) == 'fast'
+
+
+def test_dispatch_routes_commands_and_buttons(main_module, monkeypatch):
+    bot = MagicMock()
+    monkeypatch.setattr(main_module, 'bot', bot)
+
+    main_module.dispatch(MagicMock(text='/sum@test_bot 1, 2 3'))
+    assert bot.reply_to.call_args.args[1] == 'Сумма: 6'
+
+    main_module.dispatch(MagicMock(text='О боте'))
+    assert bot.reply_to.call_args.args[1].startswith('Простой телеграм бот')
+
+    bot.reset_mock()
+    main_module.dispatch(MagicMock(text='/unknown'))
+    main_module.dispatch(MagicMock(text='просто текст'))
+    assert not bot.reply_to.called
+
+
+def test_stats_shows_cache_counters_to_admins(main_module, monkeypatch):
+    bot = MagicMock()
+    monkeypatch.setattr(main_module, 'bot', bot)
+    monkeypatch.setattr(main_module.config, 'admin_ids', (42,))
+    message = MagicMock(text='/stats')
+
+    message.from_user.id = 7
+    main_module.dispatch(message)
+    assert bot.reply_to.call_args.args[1] == 'Команда доступна только администраторам.'
+
+    message.from_user.id = 42
+    main_module.dispatch(message)
+    text = bot.reply_to.call_args.args[1]
+    assert 'Кэш ответов:' in text
+    assert 'Кэш персонажей:' in text
+    assert 'Кэш выбора персонажа:' in text
+
+
+def _telegram_error(code, description, **parameters):
+    result_json = {'error_code': code, 'description': description, 'parameters': parameters}
+
+    return telebot.apihelper.ApiTelegramException('editMessageText', None, result_json)
+
+
+def test_final_edit_waits_for_retry_after(main_module, monkeypatch):
+    bot = MagicMock()
+    bot.edit_message_text.side_effect = [_telegram_error(429, 'Too Many Requests', retry_after=0.01), None]
+    monkeypatch.setattr(main_module, 'bot', bot)
+
+    main_module._finish_answer(MagicMock(), MagicMock(), 'Полный ответ')
+
+    assert bot.edit_message_text.call_count == 2
+    assert not bot.reply_to.called
+
+
+def test_final_edit_falls_back_to_reply(main_module, monkeypatch):
+    bot = MagicMock()
+    bot.edit_message_text.side_effect = _telegram_error(400, 'Bad Request: message to edit not found')
+    monkeypatch.setattr(main_module, 'bot', bot)
+    message = MagicMock()
+
+    main_module._finish_answer(message, MagicMock(), 'Полный ответ')
+
+    bot.reply_to.assert_called_once_with(message, 'Полный ответ')
+
+
+def test_group_chats_get_slower_edits(main_module):
+    assert main_module._edit_interval(MagicMock(type='supergroup')) == main_module.STREAM_GROUP_EDIT_INTERVAL_S
+    assert main_module._edit_interval(MagicMock(type='private')) == main_module.STREAM_EDIT_INTERVAL_S
+
+
+def test_hedge_delay_follows_primary_latency(main_module, monkeypatch):
+    stats = main_module.telemetry.__class__()
+    monkeypatch.setattr(main_module, 'telemetry', stats)
+    monkeypatch.setattr(main_module.config, 'llm_hedge_min_samples', 5)
+    monkeypatch.setattr(main_module.config, 'llm_hedge_percentile', 95)
+
+    assert main_module._hedge_after_s('m:free') == main_module.config.llm_hedge_after_s
+
+    for latency in (1000, 1200, 1500, 2000, 2500):
+        stats.record('m:free', latency, 200)
+
+    assert main_module._hedge_after_s('m:free') == 2.5
@@ -0,0 +1,55 @@
+import sqlite3
+
+import pytest
+
+
+def _connect(path):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+
+    return conn
+
+
+def test_apply_migrations_upgrades_existing_database(tmp_path):
+    from migrations import MIGRATIONS, apply_migrations
+
+    conn = _connect(str(tmp_path / 'legacy.db'))
+    conn.execute(
+        '''CREATE TABLE notes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )'''
+    )
+    conn.executemany('INSERT INTO notes(user_id, text) VALUES (?, ?)', [(1, 'Хлеб'), (1, 'Молоко'), (2, 'Чай')])
+    conn.commit()
+
+    version = apply_migrations(conn)
+    assert version == MIGRATIONS[-1].version
+
+    indexes = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'ix_notes_user_id', 'ix_user_character_character_id'} <= indexes
+
+    assert conn.execute('SELECT count FROM note_stats WHERE user_id = 1').fetchone()[0] == 2
+    assert conn.execute("SELECT COUNT(*) FROM notes_fts WHERE notes_fts MATCH '\"хлеб\"'").fetchone()[0] == 1
+
+    assert apply_migrations(conn) == version
+    assert conn.execute('SELECT COUNT(*) FROM schema_version').fetchone()[0] == len(MIGRATIONS)
+
+
+def test_failed_migration_is_rolled_back(tmp_path):
+    from migrations import Migration, apply_migrations
+
+    conn = _connect(str(tmp_path / 'broken.db'))
+    migrations = (
+        Migration(1, 'Create table', ('CREATE TABLE t (id INTEGER PRIMARY KEY)',)),
+        Migration(2, 'Broken step', ('CREATE TABLE u (id INTEGER PRIMARY KEY)', 'INSERT INTO missing VALUES (1)')),
+    )
+
+    with pytest.raises(sqlite3.OperationalError):
+        apply_migrations(conn, migrations)
+
+    tables = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert 't' in tables and 'u' not in tables
+    assert conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] == 1
@@ -1,7 +1,9 @@
 import json
 from importlib import reload
 import os
+import threading
 import time
+from unittest.mock import MagicMock
 
 import pytest
 import responses
@@ -97,3 +99,250 @@ def test_chat_once_5xx_raises_openrouter_error(openrouter_module, monkeypatch):
     err = excinfo.value
     assert err.status == 503
     assert 'Сервис OpenRouter недоступен. Попробуйте позднее.' in str(err)
+
+
+@responses.activate
+def test_chat_once_reuses_session(openrouter_module, monkeypatch):
+    url = 'https://openrouter.ai/api/v1/chat/completions'
+    payload = {'choices': [{'message': {'content': 'OK'}}]}
+    responses.add(responses.POST, url, json=payload, status=200)
+    responses.add(responses.POST, url, json=payload, status=200)
+
+    monkeypatch.setenv('OPENROUTER_API_KEY', 'key')
+    reload(config_module)
+    openrouter = reload(openrouter_module)
+
+    session = openrouter.get_session()
+    for _ in range(2):
+        text, _ = openrouter.chat_once([{'role': 'user', 'content': 'ping'}], model='m:free')
+        assert text == 'OK'
+
+    assert openrouter.get_session() is session
+    assert len(responses.calls) == 2
+
+    openrouter.close_session()
+    assert openrouter.get_session() is not session
+
+
+@responses.activate
+def test_chat_stream_yields_deltas(openrouter_module, monkeypatch):
+    url = 'https://openrouter.ai/api/v1/chat/completions'
+    body = (
+        ': OPENROUTER PROCESSING\n\n'
+        'data: {"choices": [{"delta": {"role": "assistant"}}]}\n\n'
+        'data: {"choices": [{"delta": {"content": "При"}}]}\n\n'
+        'data: {"choices": [{"delta": {"content": "вет"}}]}\n\n'
+        'data: [DONE]\n\n'
+    )
+    responses.add(responses.POST, url, body=body.encode(), status=200, content_type='text/event-stream')
+
+    monkeypatch.setenv('OPENROUTER_API_KEY', 'key')
+    reload(config_module)
+    openrouter = reload(openrouter_module)
+
+    deltas = list(openrouter.chat_stream([{'role': 'user', 'content': 'ping'}], model='m:free'))
+    assert deltas == ['При', 'вет']
+
+    sent = json.loads(responses.calls[0].request.body.decode())
+    assert sent['stream'] is True
+
+
+@responses.activate
+def test_chat_stream_error_raises_openrouter_error(openrouter_module, monkeypatch):
+    url = 'https://openrouter.ai/api/v1/chat/completions'
+    responses.add(responses.POST, url, json={'error': 'bad'}, status=429)
+
+    monkeypatch.setenv('OPENROUTER_API_KEY', 'key')
+    reload(config_module)
+    openrouter = reload(openrouter_module)
+
+    with pytest.raises(openrouter.OpenRouterError) as excinfo:
+        list(openrouter.chat_stream([{'role': 'user', 'content': 'ping'}], model='m:free'))
+
+    assert excinfo.value.status == 429
+
+
+def test_chat_stream_broken_midway_raises_openrouter_error(openrouter_module, monkeypatch):
+    import requests
+
+    def broken_lines():
+        yield 'data: {"choices": [{"delta": {"content": "При"}}]}'.encode()
+        raise requests.exceptions.ChunkedEncodingError('Connection broken')
+
+    response = MagicMock(status_code=200)
+    response.__enter__.return_value = response
+    response.iter_lines.return_value = broken_lines()
+    monkeypatch.setattr(openrouter_module, '_post', lambda payload, **kwargs: response)
+    breaker = openrouter_module.get_breaker('broken:free')
+    failures = breaker.failures
+
+    stream = openrouter_module.chat_stream([{'role': 'user', 'content': 'ping'}], model='broken:free')
+    assert next(stream) == 'При'
+
+    with pytest.raises(openrouter_module.OpenRouterError) as excinfo:
+        next(stream)
+
+    assert excinfo.value.status == 504
+    assert breaker.failures == failures + 1
+    assert openrouter_module.telemetry.summary('broken:free')['statuses'] == {0: 1}
+
+
+@responses.activate
+def test_chat_once_retries_transient_errors(openrouter_module, monkeypatch):
+    url = 'https://openrouter.ai/api/v1/chat/completions'
+    responses.add(responses.POST, url, json={'error': 'busy'}, status=429, headers={'Retry-After': '2'})
+    responses.add(responses.POST, url, json={'error': 'down'}, status=502)
+    responses.add(responses.POST, url, json={'choices': [{'message': {'content': 'OK'}}]}, status=200)
+
+    monkeypatch.setenv('OPENROUTER_API_KEY', 'key')
+    reload(config_module)
+    openrouter = reload(openrouter_module)
+    delays = []
+    monkeypatch.setattr(openrouter, '_sleep', delays.append)
+
+    text, _ = openrouter.chat_once([{'role': 'user', 'content': 'ping'}], model='m:free', timeout_s=30)
+
+    assert text == 'OK'
+    assert len(responses.calls) == 3
+    assert delays[0] == 2.0
+    assert 0 <= delays[1] <= openrouter.RETRY_POLICY.base_delay_s * 2
+
+
+def test_circuit_breaker_half_open_lets_one_probe_through(openrouter_module):
+    breaker = openrouter_module.CircuitBreaker(threshold=1, reset_s=0.05)
+    breaker.failure()
+    assert breaker.allow() is False
+
+    time.sleep(0.06)
+    barrier = threading.Barrier(2)
+    results = []
+
+    def probe():
+        barrier.wait()
+        results.append(breaker.allow())
+
+    threads = [threading.Thread(target=probe) for _ in range(2)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == [False, True]
+
+    # A failed probe reopens the breaker, a successful one closes it
+    breaker.failure()
+    assert breaker.allow() is False
+
+    time.sleep(0.06)
+    assert breaker.allow() is True
+    breaker.success()
+    assert breaker.allow() is True
+    assert breaker.allow() is True
+
+
+@responses.activate
+def test_circuit_breaker_fails_fast(openrouter_module, monkeypatch):
+    url = 'https://openrouter.ai/api/v1/chat/completions'
+    responses.add(responses.POST, url, json={'error': 'down'}, status=503)
+
+    monkeypatch.setenv('OPENROUTER_API_KEY', 'key')
+    reload(config_module)
+    openrouter = reload(openrouter_module)
+    monkeypatch.setattr(openrouter, '_sleep', lambda delay: None)
+    monkeypatch.setattr(openrouter, '_limiter', openrouter.RateLimiter(per_key_rpm=0, per_model_rpm=0))
+
+    for _ in range(2):
+        with pytest.raises(openrouter.OpenRouterError):
+            openrouter.chat_once([{'role': 'user', 'content': 'ping'}], model='down:free')
+
+    calls = len(responses.calls)
+    assert calls == openrouter.get_breaker('down:free').threshold
+
+    with pytest.raises(openrouter.OpenRouterError) as excinfo:
+        openrouter.chat_once([{'role': 'user', 'content': 'ping'}], model='down:free')
+
+    assert 'временно недоступна' in str(excinfo.value)
+    assert len(responses.calls) == calls
+
+
+def test_chat_stream_fallback_switches_on_error(openrouter_module, monkeypatch):
+    def fake_stream(messages, *, model, **kwargs):
+        if model == 'primary':
+            raise openrouter_module.OpenRouterError(503, 'down')
+
+        yield 'Ответ '
+        yield model
+
+    monkeypatch.setattr(openrouter_module, 'chat_stream', fake_stream)
+
+    model, stream = openrouter_module.chat_stream_fallback(
+        [{'role': 'user', 'content': 'ping'}], models=['primary', 'backup'], hedge_after_s=5
+    )
+
+    assert model == 'backup'
+    assert ''.join(stream) == 'Ответ backup'
+
+
+def test_chat_stream_fallback_hedges_slow_model(openrouter_module, monkeypatch):
+    release = threading.Event()
+    closed = threading.Event()
+
+    def fake_stream(messages, *, model, **kwargs):
+        try:
+            if model == 'slow':
+                release.wait(5)
+
+            yield model
+
+        finally:
+            if model == 'slow':
+                closed.set()
+
+    monkeypatch.setattr(openrouter_module, 'chat_stream', fake_stream)
+
+    model, stream = openrouter_module.chat_stream_fallback(
+        [{'role': 'user', 'content': 'ping'}], models=['slow', 'fast'], hedge_after_s=0.05
+    )
+
+    assert model == 'fast'
+    assert list(stream) == ['fast']
+
+    release.set()
+    assert closed.wait(5)
+
+
+def test_chat_stream_fallback_raises_last_error(openrouter_module, monkeypatch):
+    def fake_stream(messages, *, model, **kwargs):
+        raise openrouter_module.OpenRouterError(429, model)
+        yield
+
+    monkeypatch.setattr(openrouter_module, 'chat_stream', fake_stream)
+
+    with pytest.raises(openrouter_module.OpenRouterError) as excinfo:
+        openrouter_module.chat_stream_fallback(
+            [{'role': 'user', 'content': 'ping'}], models=['a', 'b'], hedge_after_s=5
+        )
+
+    assert excinfo.value.msg == 'b'
+
+
+@responses.activate
+def test_chat_once_rejects_over_local_rate_limit(openrouter_module, monkeypatch):
+    url = 'https://openrouter.ai/api/v1/chat/completions'
+    responses.add(responses.POST, url, json={'choices': [{'message': {'content': 'OK'}}]}, status=200)
+
+    monkeypatch.setenv('OPENROUTER_API_KEY', 'key')
+    reload(config_module)
+    openrouter = reload(openrouter_module)
+    monkeypatch.setattr(openrouter.config, 'openrouter_rate_mode', 'REJECT')
+    monkeypatch.setattr(openrouter, '_limiter', openrouter.RateLimiter(per_key_rpm=0, per_model_rpm=6))
+
+    openrouter.chat_once([{'role': 'user', 'content': 'ping'}], model='paced:free')
+
+    with pytest.raises(openrouter.OpenRouterError) as excinfo:
+        openrouter.chat_once([{'role': 'user', 'content': 'ping'}], model='paced:free')
+
+    assert excinfo.value.status == 429
+    assert len(responses.calls) == 1
@@ -0,0 +1,57 @@
+import pytest
+
+
+@pytest.fixture()
+def prompts(db_module):
+    import prompts
+
+    with db_module._connect() as conn:
+        conn.execute('DELETE FROM user_character WHERE character_id = 900201')
+        conn.execute('DELETE FROM characters WHERE id = 900201')
+        conn.execute("INSERT INTO characters(id, name, prompt) VALUES (900201, 'Шаблон', 'Говорит кратко')")
+    db_module._characters_cache.clear()
+
+    return prompts
+
+
+def test_system_prompt_is_compiled_once_and_stored(prompts, db_module, monkeypatch):
+    character = db_module.get_character_by_id(900201)
+    compiled = prompts.system_prompt(character)
+
+    assert 'Шаблон' in compiled and 'Говорит кратко' in compiled
+    stored = db_module.get_character_by_id(900201)
+    assert stored['system_prompt'] == compiled
+    assert stored['system_prompt_template'] == prompts.TEMPLATE_VERSION
+
+    monkeypatch.setattr(prompts, 'compile_system_prompt', lambda character: pytest.fail('recompiled'))
+    assert prompts.system_prompt(db_module.get_character_by_id(900201)) == compiled
+
+    db_module._characters_cache.clear()
+    assert prompts.system_prompt(db_module.get_character_by_id(900201)) == compiled
+
+
+def test_rename_invalidates_compiled_prompt(prompts, db_module):
+    character = db_module.get_character_by_id(900201)
+    prompts.system_prompt(character)
+
+    assert db_module.update_character_name_by_id(900201, 'Переименованный шаблон')
+    renamed = db_module.get_character_by_id(900201)
+
+    assert renamed['prompt_version'] == character['prompt_version'] + 1
+    assert renamed['system_prompt'] is None
+    assert 'Переименованный шаблон' in prompts.system_prompt(renamed)
+
+    # A compile of the old version must not overwrite the new one
+    assert not db_module.save_system_prompt(900201, character['prompt_version'], prompts.TEMPLATE_VERSION, 'old')
+    assert 'Переименованный шаблон' in db_module.get_character_by_id(900201)['system_prompt']
+
+
+def test_cache_marks_only_for_explicit_cache_providers(prompts):
+    messages = [{'role': 'system', 'content': 'Правила'}, {'role': 'user', 'content': 'Вопрос'}]
+
+    assert prompts.with_cache_marks(messages, 'deepseek/deepseek-chat:free') is messages
+
+    marked = prompts.with_cache_marks(messages, 'anthropic/claude-3.5-haiku')
+    assert marked[0]['content'] == [{'type': 'text', 'text': 'Правила', 'cache_control': {'type': 'ephemeral'}}]
+    assert marked[1] == messages[1]
+    assert messages[0]['content'] == 'Правила'
@@ -0,0 +1,42 @@
+import time
+
+from rate_limit import RateLimiter, TokenBucket
+
+
+def test_token_bucket_rejects_when_empty():
+    bucket = TokenBucket(rate_per_s=1, capacity=2)
+
+    assert bucket.acquire()
+    assert bucket.acquire()
+    assert not bucket.acquire()
+
+
+def test_token_bucket_waits_within_deadline():
+    bucket = TokenBucket(rate_per_s=20, capacity=1)
+    assert bucket.acquire()
+
+    t0 = time.monotonic()
+    assert bucket.acquire(timeout_s=1)
+    assert time.monotonic() - t0 >= 0.03
+
+
+def test_rate_limiter_refunds_key_token_when_model_is_limited():
+    limiter = RateLimiter(per_key_rpm=60, per_model_rpm=6)
+
+    assert limiter.acquire('key', 'a:free')
+    assert not limiter.acquire('key', 'a:free')
+    assert limiter.acquire('key', 'b:free')
+
+
+def test_rate_limiter_disabled_with_zero_rpm():
+    limiter = RateLimiter(per_key_rpm=0, per_model_rpm=0)
+
+    assert all(limiter.acquire('key', 'a:free') for _ in range(100))
+
+
+def test_rate_limiter_try_acquire_reports_wait():
+    limiter = RateLimiter(per_key_rpm=60, per_model_rpm=6)
+
+    assert limiter.try_acquire('key', 'a:free') == 0
+    assert limiter.try_acquire('key', 'a:free') > 0
+    assert limiter.try_acquire('key', 'b:free') == 0
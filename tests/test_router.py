@@ -0,0 +1,38 @@
+import pytest
+
+from router import Command, parse, Router
+
+
+def test_parse_splits_command_once():
+    assert parse('/edit_note@my_bot  12   Новый  текст ') == Command('edit_note', '12   Новый  текст', '12', 'Новый  текст')
+    assert parse('/ask') == Command('ask')
+    assert parse('Погода') == Command(None, 'Погода')
+    assert parse('') == Command(None)
+
+
+def test_router_resolves_commands_buttons_and_callbacks():
+    router = Router()
+
+    @router.command('help')
+    @router.button('Помощь')
+    def send_help(message, command):
+        return command
+
+    @router.callback('note')
+    def send_notes(call):
+        return call
+
+    assert router.resolve('/help extra') == (send_help, Command('help', 'extra', 'extra'))
+    assert router.resolve('Помощь') == (send_help, Command(None, 'Помощь'))
+    assert router.resolve('/other') is None
+    assert router.resolve('помощь') is None
+    assert router.resolve_callback('note:list:next:10:10:none') is send_notes
+    assert router.resolve_callback('confirm:yes') is None
+
+
+def test_router_rejects_duplicate_registration():
+    router = Router()
+    router.command('help')(lambda message, command: None)
+
+    with pytest.raises(ValueError):
+        router.command('help')(lambda message, command: None)
@@ -0,0 +1,60 @@
+from telemetry import ModelTelemetry
+
+
+def test_summary_percentiles_errors_and_tokens():
+    stats = ModelTelemetry()
+
+    for latency in (100, 200, 300, 400, 5000):
+        stats.record('m:free', latency, 200, {'prompt_tokens': 10, 'completion_tokens': 5})
+
+    stats.record('m:free', 50, 429)
+
+    summary = stats.summary('m:free')
+    assert summary['requests'] == 6
+    assert summary['errors'] == 1
+    assert summary['p50_ms'] == 300
+    assert summary['p99_ms'] == 5000
+    assert summary['prompt_tokens'] == 50
+    assert summary['statuses'] == {200: 5, 429: 1}
+    assert summary['histogram'] == {'<=250': 2, '<=500': 2, '<=5000': 1}
+
+
+def test_percentile_needs_enough_successful_samples():
+    stats = ModelTelemetry()
+
+    for latency in (100, 200, 300, 400):
+        stats.record('m:free', latency, 200)
+
+    stats.record('m:free', 50, 503)
+
+    assert stats.percentile('m:free', 95, min_samples=5) is None
+    assert stats.percentile('m:free', 95, min_samples=4) == 400
+    assert stats.percentile('m:free', 50) == 300
+    assert stats.percentile('unknown', 50) is None
+
+
+def test_best_model_prefers_fast_and_reliable():
+    stats = ModelTelemetry()
+
+    for _ in range(5):
+        stats.record('fast', 300, 200)
+        stats.record('slow', 3000, 200)
+        stats.record('broken', 100, 503)
+
+    stats.record('new', 10, 200)
+
+    assert stats.best_model(['slow', 'fast', 'broken', 'new']) == 'fast'
+    assert stats.best_model(['broken', 'new']) is None
+
+
+def test_persisted_summaries_reach_database(db_module):
+    db = db_module
+    stats = ModelTelemetry()
+    stats.record('persist:free', 120, 200, {'prompt_tokens': 3, 'completion_tokens': 4})
+
+    db.save_model_stats(stats.summaries())
+
+    with db._connect() as conn:
+        row = conn.execute("SELECT requests, p50_ms, statuses FROM model_stats WHERE model = 'persist:free'").fetchone()
+
+    assert (row['requests'], row['p50_ms'], row['statuses']) == (1, 120, '{"200": 1}')
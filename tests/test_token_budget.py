@@ -0,0 +1,72 @@
+import pytest
+
+import token_budget
+
+
+@pytest.fixture(autouse=True)
+def clean_calibration():
+    token_budget.reset_calibration()
+    yield
+    token_budget.reset_calibration()
+
+
+def test_estimate_counts_cyrillic_denser_than_latin():
+    assert token_budget.estimate_tokens('a' * 40) == 10
+    assert token_budget.estimate_tokens('я' * 40) == 16
+    assert token_budget.estimate_tokens('') == 0
+
+
+def test_calibration_scales_estimates_per_model():
+    messages = [{'role': 'user', 'content': 'a' * 400}]
+    raw = token_budget.estimate_messages(messages)
+
+    token_budget.calibrate('m:free', messages, raw * 2)
+
+    assert token_budget.estimate_messages(messages, 'm:free') == raw * 2
+    assert token_budget.estimate_messages(messages, 'other:free') == raw
+
+    token_budget.calibrate('m:free', messages, raw)
+    assert raw < token_budget.estimate_messages(messages, 'm:free') < raw * 2
+
+
+def test_trim_keeps_whole_words():
+    text = ' '.join(['слово'] * 100)
+    trimmed = token_budget.trim_to_tokens(text, 20)
+
+    assert trimmed.endswith('…')
+    assert all(word == 'слово' for word in trimmed[:-1].split())
+    assert token_budget.estimate_tokens(trimmed[:-1]) <= 20
+    assert token_budget.trim_to_tokens('коротко', 20) == 'коротко'
+
+
+def test_clip_cuts_at_word_boundary():
+    text = 'слово ' * 1000
+    clipped = token_budget.clip(text)
+
+    assert len(clipped) <= token_budget.TELEGRAM_MESSAGE_LIMIT
+    assert clipped.endswith('слово…')
+    assert token_budget.clip('  ответ  ') == 'ответ'
+
+
+def test_fit_prompt_budgets_input_and_answer():
+    messages = [
+        {'role': 'system', 'content': 'Ты помощник.'},
+        {'role': 'user', 'content': 'вопрос ' * 2000}
+    ]
+
+    budget = token_budget.fit_prompt(
+        messages, model='m:free', context_tokens=1000, max_answer_tokens=800, max_input_tokens=5000
+    )
+
+    assert budget.trimmed
+    assert messages[1]['content'] == 'вопрос ' * 2000
+    assert budget.prompt_tokens + token_budget.MIN_ANSWER_TOKENS <= 1000
+    assert budget.max_tokens == max(token_budget.MIN_ANSWER_TOKENS, 1000 - budget.prompt_tokens)
+
+    small = token_budget.fit_prompt(
+        messages[:1] + [{'role': 'user', 'content': 'Привет'}],
+        model='m:free', context_tokens=8192, max_answer_tokens=800, max_input_tokens=1000
+    )
+
+    assert not small.trimmed
+    assert small.max_tokens == 800
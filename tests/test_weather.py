@@ -0,0 +1,151 @@
+import threading
+import time
+
+import pytest
+import responses
+
+from weather import City, OPEN_METEO_URL, Reading, WEATHER_UNAVAILABLE, WeatherService
+
+MOSCOW = City('Москва', 55.7558, 37.6173)
+SPB = City('Санкт-Петербург', 59.9343, 30.3351)
+
+
+@pytest.fixture()
+def service():
+    service = WeatherService([MOSCOW, SPB], refresh_s=60, max_stale_s=600, timeout_s=1)
+    yield service
+    service.stop()
+
+
+def _batch(*temperatures):
+    return [{'current': {'temperature_2m': t}} for t in temperatures]
+
+
+@responses.activate
+def test_fetch_batches_all_cities_in_one_request(service):
+    responses.add(responses.GET, OPEN_METEO_URL, json=_batch(-3.4, 1.6))
+
+    assert service.report() == 'Москва: сейчас -3°C\nСанкт-Петербург: сейчас 2°C'
+    assert len(responses.calls) == 1
+
+    params = responses.calls[0].request.params
+    assert params['latitude'] == '55.7558,59.9343'
+    assert params['longitude'] == '37.6173,30.3351'
+
+
+@responses.activate
+def test_single_city_response_is_an_object():
+    service = WeatherService([MOSCOW], refresh_s=60, max_stale_s=600)
+    responses.add(responses.GET, OPEN_METEO_URL, json={'current': {'temperature_2m': 20.2}})
+
+    assert service.report() == 'Москва: сейчас 20°C'
+
+
+@responses.activate
+def test_fresh_readings_are_served_from_memory(service):
+    responses.add(responses.GET, OPEN_METEO_URL, json=_batch(1, 2))
+
+    for _ in range(100):
+        service.report()
+
+    assert service.fetches == 1
+
+
+@responses.activate
+def test_stale_reading_is_served_while_refreshing(service):
+    responses.add(responses.GET, OPEN_METEO_URL, json=_batch(5, 6))
+    stale = time.monotonic() - service.refresh_s - 1
+    service._readings.set(MOSCOW.name, Reading(1, stale))
+    service._readings.set(SPB.name, Reading(2, stale))
+
+    assert service.report() == 'Москва: сейчас 1°C\nСанкт-Петербург: сейчас 2°C'
+
+    deadline = time.monotonic() + 2
+    while service.fetches == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # Let the refresh thread store the readings
+    with service._refresh_lock:
+        pass
+
+    assert service.report() == 'Москва: сейчас 5°C\nСанкт-Петербург: сейчас 6°C'
+
+
+@responses.activate
+def test_concurrent_cold_reports_share_one_fetch(service):
+    responses.add(responses.GET, OPEN_METEO_URL, json=_batch(1, 2))
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(service.report())) for _ in range(8)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert service.fetches == 1
+    assert set(results) == {'Москва: сейчас 1°C\nСанкт-Петербург: сейчас 2°C'}
+
+
+@responses.activate
+def test_failed_refresh_keeps_stale_readings(service):
+    responses.add(responses.GET, OPEN_METEO_URL, status=500)
+    stale = time.monotonic() - service.refresh_s - 1
+    service._readings.set(MOSCOW.name, Reading(1, stale))
+    service._readings.set(SPB.name, Reading(2, stale))
+
+    assert service.refresh() is False
+    assert service.report().startswith('Москва: сейчас 1°C')
+
+
+@responses.activate
+def test_failure_without_readings(service):
+    responses.add(responses.GET, OPEN_METEO_URL, json={'error': True, 'reason': 'bad'})
+
+    assert service.report() == WEATHER_UNAVAILABLE
+
+
+@responses.activate
+def test_background_refresh_fills_cache(service):
+    responses.add(responses.GET, OPEN_METEO_URL, json=_batch(1, 2))
+    service.start()
+
+    deadline = time.monotonic() + 2
+    while service.fetches == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    service.stop()
+
+    assert service.report() == 'Москва: сейчас 1°C\nСанкт-Петербург: сейчас 2°C'
+    assert service.fetches == 1
+
+
+@responses.activate
+def test_failed_fetch_is_not_repeated_by_waiting_callers(service):
+    responses.add(responses.GET, OPEN_METEO_URL, status=503)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(service.report())) for _ in range(5)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert results == [WEATHER_UNAVAILABLE] * 5
+    assert len(responses.calls) == 1
+
+    # Still backing off: answered at once without another request
+    assert service.report() == WEATHER_UNAVAILABLE
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_fetch_is_retried_after_backoff():
+    service = WeatherService([MOSCOW], refresh_s=60, max_stale_s=600, backoff_s=0.05)
+    responses.add(responses.GET, OPEN_METEO_URL, status=503)
+    responses.add(responses.GET, OPEN_METEO_URL, json={'current': {'temperature_2m': 3}})
+
+    assert service.report() == WEATHER_UNAVAILABLE
+    time.sleep(0.06)
+    assert service.report() == 'Москва: сейчас 3°C'
@@ -0,0 +1,140 @@
+import http.client
+import json
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from dispatcher import LaneTeleBot
+from webhook import SECRET_HEADER, WebhookServer
+
+UPDATE = {
+    'update_id': 1001,
+    'message': {
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': 42, 'type': 'private'},
+        'from': {'id': 42, 'is_bot': False, 'first_name': 'Тест'},
+        'text': '/start'
+    }
+}
+
+
+@pytest.fixture()
+def server():
+    bot = MagicMock()
+    server = WebhookServer(bot, host='127.0.0.1', port=0, path='/hook', secret_token='s3cret', max_pending=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.stop()
+    thread.join(1)
+
+
+def _post(server, path='/hook', secret='s3cret', body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+    headers = {SECRET_HEADER: secret, 'Content-Type': 'application/json'}
+    conn.request('POST', path, body=json.dumps(UPDATE if body is None else body), headers=headers)
+    status = conn.getresponse().status
+    conn.close()
+
+    return status
+
+
+def test_webhook_hands_update_to_bot(server):
+    assert _post(server) == 200
+
+    for _ in range(100):
+        if server.bot.process_new_updates.called:
+            break
+
+        time.sleep(0.01)
+
+    update = server.bot.process_new_updates.call_args.args[0][0]
+    assert update.update_id == 1001
+    assert update.message.text == '/start'
+
+
+def test_webhook_rejects_wrong_secret_and_path(server):
+    assert _post(server, secret='wrong') == 403
+    assert _post(server, path='/other') == 404
+    assert not server.bot.process_new_updates.called
+
+
+def test_webhook_asks_to_retry_when_queue_is_full(server):
+    release = threading.Event()
+    server.bot.process_new_updates.side_effect = lambda updates: release.wait(5)
+
+    assert [_post(server) for _ in range(3)] == [200, 200, 503]
+
+    release.set()
+
+
+def test_webhook_slot_is_held_until_lane_handler_finishes():
+    bot = LaneTeleBot('123:test', lanes={'main': 2}, lane_of=lambda update: 'main')
+    release = threading.Event()
+    handled = []
+
+    @bot.message_handler(func=lambda message: True)
+    def handler(message):
+        release.wait(5)
+        handled.append(message.chat.id)
+
+    server = WebhookServer(bot, host='127.0.0.1', port=0, path='/hook', secret_token='s3cret', max_pending=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        # Handing off to the lane is instant, but the queued handlers still count against max_pending
+        assert [_post(server) for _ in range(3)] == [200, 200, 503]
+
+        release.set()
+
+        for _ in range(100):
+            if len(handled) == 2:
+                break
+
+            time.sleep(0.01)
+
+        assert _post(server) == 200
+
+    finally:
+        server.stop()
+        thread.join(1)
+        bot.close_lanes()
+
+
+def test_webhook_keeps_chat_updates_in_order():
+    bot = LaneTeleBot('123:test', lanes={'main': 4}, lane_of=lambda update: 'main')
+    handled = []
+
+    @bot.message_handler(func=lambda message: True)
+    def handler(message):
+        time.sleep(0.01)
+        handled.append(message.text)
+
+    server = WebhookServer(bot, host='127.0.0.1', port=0, path='/hook', secret_token='s3cret', max_pending=10)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    texts = [f'Сообщение {i}' for i in range(5)]
+
+    try:
+        for i, text in enumerate(texts):
+            update = {**UPDATE, 'update_id': 2000 + i, 'message': {**UPDATE['message'], 'message_id': i, 'text': text}}
+            assert _post(server, body=update) == 200
+
+        for _ in range(100):
+            if len(handled) == len(texts):
+                break
+
+            time.sleep(0.01)
+
+        assert handled == texts
+
+    finally:
+        server.stop()
+        thread.join(1)
+        bot.close_lanes()
@@ -0,0 +1,105 @@
+import sqlite3
+import threading
+
+import pytest
+
+from write_queue import WriteQueue
+
+
+def _insert(conn, value):
+    return conn.execute('INSERT INTO t(value) VALUES (?)', (value,)).lastrowid
+
+
+def _fail(conn):
+    conn.execute('INSERT INTO missing VALUES (1)')
+
+
+@pytest.fixture()
+def db_path(tmp_path):
+    path = str(tmp_path / 'queue.db')
+
+    with sqlite3.connect(path) as conn:
+        conn.execute('CREATE TABLE t (id INTEGER PRIMARY KEY, value TEXT)')
+
+    return path
+
+
+def test_write_queue_batches_and_returns_results(db_path):
+    writer = WriteQueue(lambda: sqlite3.connect(db_path, check_same_thread=False), max_batch=8, max_delay_s=0.05)
+
+    futures = [writer.submit(_insert, f'v{i}') for i in range(20)]
+    ids = [future.result(timeout=5) for future in futures]
+    writer.close()
+
+    assert ids == list(range(1, 21))
+
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM t').fetchone()[0] == 20
+
+
+def test_write_queue_isolates_failed_write(db_path):
+    writer = WriteQueue(lambda: sqlite3.connect(db_path, check_same_thread=False), max_delay_s=0.05)
+
+    ok = writer.submit(_insert, 'ok')
+    failed = writer.submit(_fail)
+    writer.close()
+
+    assert ok.result(timeout=5) == 1
+
+    with pytest.raises(sqlite3.OperationalError):
+        failed.result(timeout=5)
+
+    with pytest.raises(RuntimeError):
+        writer.submit(_insert, 'late')
+
+
+def test_write_queue_submit_racing_close_never_hangs(db_path):
+    writer = WriteQueue(lambda: sqlite3.connect(db_path, check_same_thread=False), max_delay_s=0.001)
+    futures = []
+    rejected = []
+
+    def submit_many():
+        for i in range(200):
+            try:
+                futures.append(writer.submit(_insert, f'v{i}'))
+
+            except RuntimeError:
+                rejected.append(i)
+
+    threads = [threading.Thread(target=submit_many) for _ in range(4)]
+
+    for thread in threads:
+        thread.start()
+
+    writer.close()
+
+    for thread in threads:
+        thread.join()
+
+    # Every accepted write was committed before the writer stopped
+    assert all(future.result(timeout=1) for future in futures)
+    assert len(futures) + len(rejected) == 800
+
+    with pytest.raises(RuntimeError):
+        writer.submit(_insert, 'late')
+
+
+def test_write_queue_fails_writes_when_writer_cannot_start():
+    opening = threading.Event()
+
+    def connect():
+        opening.wait(5)
+        raise sqlite3.OperationalError('unable to open database file')
+
+    writer = WriteQueue(connect)
+    queued = writer.submit(_insert, 'queued')
+    opening.set()
+    writer._thread.join(1)
+
+    with pytest.raises(sqlite3.OperationalError):
+        queued.result(timeout=1)
+
+    with pytest.raises(sqlite3.OperationalError):
+        writer.submit(_insert, 'later').result(timeout=1)
+
+    writer.close()
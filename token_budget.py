@@ -0,0 +1,150 @@
+from dataclasses import dataclass
+import math
+import re
+import threading
+from typing import Dict, List
+
+# Rough BPE density: Latin text packs ~4 characters into a token, Cyrillic and the rest ~2.5
+LATIN_CHARS_PER_TOKEN = 4.0
+OTHER_CHARS_PER_TOKEN = 2.5
+MESSAGE_OVERHEAD_TOKENS = 4
+MIN_ANSWER_TOKENS = 64
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+_LATIN = re.compile(r'[\x00-\x7f]')
+_WORD = re.compile(r'\S+\s*')
+
+_calibration: dict[str, float] = {}
+_calibration_lock = threading.Lock()
+
+
+@dataclass
+class Budget:
+    messages: List[Dict]
+    prompt_tokens: int
+    max_tokens: int
+    trimmed: bool
+
+
+def _raw_estimate(text: str) -> float:
+    latin = len(_LATIN.findall(text))
+
+    return latin / LATIN_CHARS_PER_TOKEN + (len(text) - latin) / OTHER_CHARS_PER_TOKEN
+
+
+def _content(message: Dict) -> str:
+    # Content may be a list of parts when the prompt carries cache marks
+    content = message['content']
+
+    if isinstance(content, str):
+        return content
+
+    return ''.join(part.get('text', '') for part in content)
+
+
+def ratio(model: str | None) -> float:
+    with _calibration_lock:
+        return _calibration.get(model, 1.0)
+
+
+def estimate_tokens(text: str, model: str | None = None) -> int:
+    return math.ceil(_raw_estimate(text) * ratio(model))
+
+
+def estimate_messages(messages: List[Dict], model: str | None = None) -> int:
+    raw = sum(_raw_estimate(_content(message)) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+    return math.ceil(raw * ratio(model))
+
+
+def calibrate(model: str, messages: List[Dict], prompt_tokens: int | None, alpha: float = 0.2):
+    # Moves the model's correction factor towards the provider-reported prompt size
+    if not prompt_tokens:
+        return
+
+    raw = sum(_raw_estimate(_content(message)) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+    if raw <= 0:
+        return
+
+    observed = min(3.0, max(0.5, prompt_tokens / raw))
+
+    with _calibration_lock:
+        current = _calibration.get(model)
+        _calibration[model] = observed if current is None else current + alpha * (observed - current)
+
+
+def reset_calibration():
+    with _calibration_lock:
+        _calibration.clear()
+
+
+def trim_to_tokens(text: str, max_tokens: int, model: str | None = None) -> str:
+    # Keeps whole words; the estimate is monotonic, so the longest fitting prefix wins
+    if estimate_tokens(text, model) <= max_tokens:
+        return text
+
+    limit = max_tokens / ratio(model)
+    used = 0.0
+    kept = []
+
+    for match in _WORD.finditer(text):
+        cost = _raw_estimate(match.group())
+
+        if used + cost > limit:
+            break
+
+        used += cost
+        kept.append(match.group())
+
+    return ''.join(kept).rstrip() + '…'
+
+
+def clip(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> str:
+    # Cuts at the last whitespace before the limit instead of mid-word
+    text = text.strip()
+
+    if len(text) <= limit:
+        return text
+
+    cut = text[:limit - 1]
+    space = cut.rfind(' ')
+    newline = cut.rfind('\n')
+    boundary = max(space, newline)
+
+    if boundary > limit // 2:
+        cut = cut[:boundary]
+
+    return cut.rstrip() + '…'
+
+
+def answer_cap(model: str | None = None, limit: int = TELEGRAM_MESSAGE_LIMIT) -> int:
+    # Tokens that still fit in one Telegram message even for dense Cyrillic text
+    return max(MIN_ANSWER_TOKENS, int(limit / OTHER_CHARS_PER_TOKEN / ratio(model)))
+
+
+def fit_prompt(
+        messages: List[Dict[str, str]],
+        *,
+        model: str,
+        context_tokens: int,
+        max_answer_tokens: int,
+        max_input_tokens: int
+) -> Budget:
+    # Trims the last user message to its budget, then gives the answer what is left of the context
+    messages = [dict(message) for message in messages]
+    trimmed = False
+
+    fixed = estimate_messages(messages[:-1], model) if len(messages) > 1 else 0
+    room = context_tokens - fixed - MESSAGE_OVERHEAD_TOKENS - MIN_ANSWER_TOKENS
+    input_budget = max(0, min(max_input_tokens, room))
+
+    if messages and messages[-1]['role'] == 'user':
+        content = trim_to_tokens(messages[-1]['content'], input_budget, model)
+        trimmed = content != messages[-1]['content']
+        messages[-1]['content'] = content
+
+    prompt_tokens = estimate_messages(messages, model)
+    max_tokens = min(max_answer_tokens, answer_cap(model), context_tokens - prompt_tokens)
+
+    return Budget(messages, prompt_tokens, max(MIN_ANSWER_TOKENS, max_tokens), trimmed)
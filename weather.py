@@ -0,0 +1,157 @@
+from dataclasses import dataclass
+import threading
+import time
+from typing import Iterable
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache import TTLCache
+from config import logger
+
+OPEN_METEO_URL = 'https://api.open-meteo.com/v1/forecast'
+WEATHER_UNAVAILABLE = 'Не удалось получить погоду.'
+FAILURE_BACKOFF_S = 30.0
+
+
+@dataclass(frozen=True)
+class City:
+    name: str
+    latitude: float
+    longitude: float
+
+
+@dataclass(frozen=True)
+class Reading:
+    temperature: float
+    fetched_at: float
+
+
+# Answers /weather from memory: all cities come from one Open-Meteo request, refreshed ahead of expiry
+class WeatherService:
+    def __init__(
+            self,
+            cities: Iterable[City],
+            *,
+            refresh_s: float,
+            max_stale_s: float,
+            timeout_s: float = 5.0,
+            backoff_s: float = FAILURE_BACKOFF_S
+    ):
+        self.cities = list(cities)
+        self.refresh_s = refresh_s
+        self.timeout_s = timeout_s
+        self.backoff_s = backoff_s
+        self.fetches = 0
+
+        # Readings stay servable until max_stale_s, a refresh is due after refresh_s
+        self._readings = TTLCache(maxsize=max(len(self.cities), 1), ttl_s=max_stale_s)
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self._refresh_lock = threading.Lock()
+        self._failed_at: float | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def fetch(self) -> dict[str, float]:
+        response = self._session.get(
+            OPEN_METEO_URL,
+            params={
+                'latitude': ','.join(str(city.latitude) for city in self.cities),
+                'longitude': ','.join(str(city.longitude) for city in self.cities),
+                'current': 'temperature_2m'
+            },
+            timeout=self.timeout_s
+        )
+        response.raise_for_status()
+        self.fetches += 1
+
+        # One location comes back as an object, several as a list in request order
+        data = response.json()
+        locations = data if isinstance(data, list) else [data]
+
+        return {city.name: location['current']['temperature_2m'] for city, location in zip(self.cities, locations)}
+
+    def _readings_now(self) -> dict[str, Reading | None]:
+        return {city.name: self._readings.get(city.name) for city in self.cities}
+
+    def _due(self, readings: dict[str, Reading | None]) -> bool:
+        now = time.monotonic()
+
+        return any(reading is None or now - reading.fetched_at >= self.refresh_s for reading in readings.values())
+
+    def _backing_off(self) -> bool:
+        return self._failed_at is not None and time.monotonic() - self._failed_at < self.backoff_s
+
+    def refresh(self, wait: bool = False) -> bool:
+        # One fetch at a time: without wait a caller that finds one running leaves it to finish
+        if not self._refresh_lock.acquire(blocking=wait):
+            return False
+
+        try:
+            # Whoever waited behind a fetch gets its readings, or its failure, instead of repeating it
+            if not self._due(self._readings_now()):
+                return True
+
+            if self._backing_off():
+                return False
+
+            started_at = time.monotonic()
+            temperatures = self.fetch()
+
+            for name, temperature in temperatures.items():
+                self._readings.set(name, Reading(temperature, started_at))
+
+            self._failed_at = None
+
+            return True
+
+        except (requests.RequestException, KeyError, TypeError, ValueError) as e:
+            self._failed_at = time.monotonic()
+            logger.warning(f'Weather refresh failed, next try in {self.backoff_s:.0f} s: {e}')
+            return False
+
+        finally:
+            self._refresh_lock.release()
+
+    def report(self) -> str:
+        readings = self._readings_now()
+
+        if None in readings.values():
+            # Cold start or expired readings: wait once, concurrent callers share the fetch.
+            # Right after a failure nobody waits, Open-Meteo gets backoff_s to recover
+            if not self._backing_off():
+                self.refresh(wait=True)
+                readings = self._readings_now()
+
+        elif self._due(readings) and not self._refresh_lock.locked() and not self._backing_off():
+            # Stale but servable: answer now, refresh behind the reply
+            threading.Thread(target=self.refresh, name='weather-refresh', daemon=True).start()
+
+        lines = [f'{name}: сейчас {round(reading.temperature)}°C' for name, reading in readings.items() if reading]
+
+        return '\n'.join(lines) or WEATHER_UNAVAILABLE
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._stop.clear()
+
+        def run():
+            self.refresh()
+
+            while not self._stop.wait(self.refresh_s):
+                self.refresh()
+
+        self._thread = threading.Thread(target=run, name='weather-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self._session.close()
@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+import telebot
+
+from config import logger
+from dispatcher import LaneTeleBot
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+MAX_BODY_BYTES = 1024 * 1024
+
+
+# Telegram webhook endpoint: checks the secret, queues the update and answers 200 at once
+class WebhookServer:
+    def __init__(
+            self,
+            bot: telebot.TeleBot,
+            *,
+            host: str,
+            port: int,
+            path: str,
+            secret_token: str,
+            max_pending: int = 100
+    ):
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+
+        # Lanes keep each chat's updates in order themselves; a plain bot gets one worker for the same reason
+        self._pool = None if isinstance(bot, LaneTeleBot) else ThreadPoolExecutor(max_workers=1, thread_name_prefix='webhook')
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._serving = False
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.send_response(server.handle(self.path, self.headers, self.rfile))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(f'Webhook {self.address_string()}: {format % args}')
+
+        return Handler
+
+    def handle(self, path: str, headers, body) -> int:
+        if path != self.path:
+            return 404
+
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, ''), self.secret_token):
+            logger.warning('Webhook request with a wrong secret token rejected.')
+            return 403
+
+        length = int(headers.get('Content-Length') or 0)
+
+        if length <= 0 or length > MAX_BODY_BYTES:
+            return 400
+
+        # Full queue: a non-2xx answer makes Telegram redeliver the update later
+        if not self._pending.acquire(blocking=False):
+            logger.warning('Webhook queue is full, asking Telegram to retry.')
+            return 503
+
+        try:
+            update = telebot.types.Update.de_json(body.read(length).decode('utf-8'))
+
+        except ValueError as e:
+            self._pending.release()
+            logger.error(f'Webhook update could not be parsed: {e}')
+            return 400
+
+        if self._pool is None:
+            # Queued on the chat's lane before Telegram gets its 200, so updates keep their arrival order
+            self._hand_off(update)
+
+        else:
+            self._pool.submit(self._process, update)
+
+        return 200
+
+    def _hand_off(self, update: telebot.types.Update):
+        futures = []
+
+        try:
+            futures = self.bot.process_new_updates_tracked([update])
+
+        except Exception as e:
+            logger.error(f'Webhook update {update.update_id} failed: {e}')
+
+        finally:
+            # Lanes only queue the handlers: the slot stays taken until they have run, so max_pending
+            # bounds the real backlog. One update's tasks share a chat and a lane, the last one ends last
+            if futures:
+                futures[-1].add_done_callback(lambda future: self._pending.release())
+
+            else:
+                self._pending.release()
+
+    def _process(self, update: telebot.types.Update):
+        try:
+            self.bot.process_new_updates([update])
+
+        except Exception as e:
+            logger.error(f'Webhook update {update.update_id} failed: {e}')
+
+        finally:
+            self._pending.release()
+
+    def serve_forever(self):
+        self._serving = True
+        self._server.serve_forever()
+
+    def stop(self):
+        # shutdown() waits for serve_forever, which never started if registration failed
+        if self._serving:
+            self._server.shutdown()
+            self._serving = False
+
+        self._server.server_close()
+
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
@@ -0,0 +1,162 @@
+from concurrent.futures import Future
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Callable
+
+from config import logger
+
+_STOP = object()
+
+
+# Single writer thread that commits queued mutations in batches (group commit)
+class WriteQueue:
+    def __init__(
+            self,
+            connect: Callable[[], sqlite3.Connection],
+            max_batch: int = 64,
+            max_delay_s: float = 0.01,
+            synchronous: str = 'FULL'
+    ):
+        self.max_batch = max_batch
+        self.max_delay_s = max_delay_s
+        self.synchronous = synchronous
+
+        self._connect = connect
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._closed = False
+        self._error: Exception | None = None
+        # Check-and-put under one lock, so nothing is queued behind _STOP where no one would resolve it
+        self._lock = threading.Lock()
+        self._thread.start()
+
+    def submit(self, op: Callable[..., Any], *args) -> Future:
+        future = Future()
+
+        with self._lock:
+            # A writer that failed to start answers every write with its error instead of leaving it waiting
+            if self._error is not None:
+                future.set_exception(self._error)
+                return future
+
+            if self._closed:
+                raise RuntimeError('Очередь записи остановлена.')
+
+            self._queue.put((op, args, future))
+
+        return future
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+
+            self._closed = True
+            self._queue.put(_STOP)
+
+        self._thread.join()
+
+    def _collect(self) -> tuple[list, bool]:
+        batch = [self._queue.get()]
+
+        if batch[0] is _STOP:
+            return [], True
+
+        deadline = time.monotonic() + self.max_delay_s
+
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+
+            except queue.Empty:
+                break
+
+            if item is _STOP:
+                return batch, True
+
+            batch.append(item)
+
+        return batch, False
+
+    def _commit(self, conn: sqlite3.Connection, batch: list):
+        results = []
+
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+
+            # A savepoint per mutation: one failing write doesn't roll back the rest of the batch
+            for op, args, future in batch:
+                conn.execute('SAVEPOINT write')
+
+                try:
+                    results.append((future, op(conn, *args), None))
+                    conn.execute('RELEASE write')
+
+                except Exception as e:
+                    conn.execute('ROLLBACK TO write')
+                    conn.execute('RELEASE write')
+                    results.append((future, None, e))
+
+            conn.execute('COMMIT')
+
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+
+            logger.error(f'Batch of {len(batch)} writes failed: {e}')
+
+            for _, _, future in batch:
+                future.set_exception(e)
+
+            return
+
+        # Futures resolve only after COMMIT, so callers never see uncommitted ids
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+
+            else:
+                future.set_exception(error)
+
+    def _fail(self, error: Exception):
+        with self._lock:
+            self._closed = True
+            self._error = error
+
+        # Nothing is queued after _closed, so this drains everything that will ever wait on the writer
+        while True:
+            try:
+                item = self._queue.get_nowait()
+
+            except queue.Empty:
+                return
+
+            if item is not _STOP:
+                item[2].set_exception(error)
+
+    def _run(self):
+        try:
+            conn = self._connect()
+            conn.isolation_level = None
+            conn.execute(f'PRAGMA synchronous = {self.synchronous}')
+
+        except Exception as e:
+            logger.error(f'Database writer failed to start: {e}')
+            self._fail(e)
+            return
+
+        try:
+            stop = False
+
+            while not stop:
+                batch, stop = self._collect()
+
+                if batch:
+                    self._commit(conn, batch)
+
+        finally:
+            conn.close()